@@ -0,0 +1,560 @@
+import logging
+import asyncio
+import hmac
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse
+from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from auth import AuthError, verify_init_data, issue_session, verify_session
+from config import APP_ROLE, ROLE_COMBINED, ADMIN_API_TOKEN, WEBAPP_ORIGINS, validate_config
+from database import db, normalize_track_code, DatabaseUnavailable, IdempotencyConflict
+from documents import DOCUMENT_KINDS, render_document, container_labels_to_file
+from events import OrderEventBroker
+from exports import EXPORT_KINDS, EXPORT_FORMATS, EXPORT_MEDIA_TYPES, export_filename, export_to_file, iter_csv
+from response_cache import ResponseCache
+from workers import shutdown as shutdown_workers
+from schemas import (
+    FastJSONResponse, dump_json, UserSummary, OrdersResponse, ExchangeRatesResponse, TrackInfo
+)
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# ------------------------- Глобальные переменные -------------------------
+response_cache = ResponseCache()
+order_events = OrderEventBroker()
+
+# Курсы одинаковы для всех и меняются редко — их можно кэшировать в браузере и CDN
+EXCHANGE_RATES_CACHE_CONTROL = "public, max-age=60"
+# Данные пользователя — только в браузере и с обязательной проверкой ETag
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+# Входит в ETag: при смене формата ответов старые ETag клиентов перестают совпадать
+RESPONSE_FORMAT_VERSION = 1
+
+# Максимум ключей в одном пакетном запросе API
+MAX_BATCH_KEYS = 5000
+# Сколько элементов ответа отправлять одним куском при потоковой отдаче
+BATCH_STREAM_CHUNK = 200
+# Интервал комментариев-пингов в SSE, чтобы прокси не закрывали простаивающие соединения
+SSE_HEARTBEAT_SECONDS = 25
+# Сколько запросов /api обрабатывается одновременно; сверх лимита — сразу 503, а не очередь
+API_MAX_IN_FLIGHT = int(os.getenv("API_MAX_IN_FLIGHT", "64"))
+api_in_flight = 0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск API; в роли combined вместе с ним в этом же процессе работает Telegram-бот"""
+    validate_config()
+    order_events.attach_loop(asyncio.get_running_loop())
+    if APP_ROLE != ROLE_COMBINED:
+        # Бот и воркеры API — разные процессы: изменения доходят до кэшей только через NOTIFY
+        db.notify_changes = True
+    db.start_change_listener()
+
+    telegram_leader = None
+    if APP_ROLE == ROLE_COMBINED:
+        # Telegram-стек импортируем только там, где он нужен: воркеры роли api его не загружают
+        import bot
+        # Если combined-реплик несколько, обновления получает только держатель аренды
+        telegram_leader = asyncio.create_task(bot.run_as_leader(bot.TELEGRAM_LEASE, bot.telegram_polling_job))
+
+    yield
+
+    if telegram_leader:
+        telegram_leader.cancel()
+        await asyncio.gather(telegram_leader, return_exceptions=True)
+    shutdown_workers()
+
+# ------------------------- FastAPI приложение -------------------------
+app = FastAPI(lifespan=lifespan, title="Golden Dragon Bot + API", default_response_class=FastJSONResponse)
+@app.middleware("http")
+async def limit_in_flight(request: Request, call_next):
+    """Backpressure: при перегрузке API быстро отвечает 503, а не копит ожидающие запросы.
+    SSE-ленты не держат БД и в лимит не входят."""
+    global api_in_flight
+    path = request.url.path
+    if not path.startswith("/api/") or path.endswith("/events"):
+        return await call_next(request)
+    if api_in_flight >= API_MAX_IN_FLIGHT:
+        return FastJSONResponse({"detail": "Server is busy"}, status_code=503, headers={"Retry-After": "1"})
+    api_in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        api_in_flight -= 1
+
+# Браузеру доступ только из мини-приложения; серверные клиенты CORS не проверяют.
+# Добавлен после limit_in_flight, значит выполняется снаружи: 503 при перегрузке
+# тоже уходит с CORS-заголовками, и браузер видит Retry-After, а не сетевую ошибку
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=WEBAPP_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type", "If-None-Match", "Idempotency-Key", "X-Admin-Token"],
+    expose_headers=["ETag"],
+)
+
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable(request: Request, exc: DatabaseUnavailable):
+    retry_after = max(1, round(db.health()["retry_after"]))
+    return FastJSONResponse(
+        {"detail": "Database is temporarily unavailable"},
+        status_code=503,
+        headers={"Retry-After": str(retry_after)}
+    )
+
+@app.exception_handler(IdempotencyConflict)
+async def idempotency_conflict(request: Request, exc: IdempotencyConflict):
+    return FastJSONResponse(
+        {"detail": "Idempotency key was already used with a different amount", "keys": exc.keys},
+        status_code=409
+    )
+
+# ------------------------- API ЭНДПОИНТЫ -------------------------
+def invalidate_response_cache(topic, key=None, data=None):
+    """Сбрасывает закэшированные ответы API при изменении данных в БД"""
+    if topic == 'reset':
+        response_cache.clear()
+    elif topic == 'user':
+        response_cache.invalidate(('user', key))
+    elif topic == 'orders':
+        response_cache.invalidate(('user', key), ('orders', key))
+    elif topic == 'exchange_rates':
+        response_cache.invalidate(('exchange_rates',))
+
+def publish_order_event(topic, key=None, data=None):
+    """Передаёт изменения заказов подписчикам live-ленты"""
+    if topic == 'orders' and key:
+        order_events.publish(key, data or {})
+
+db.add_change_listener(invalidate_response_cache)
+db.add_change_listener(publish_order_event)
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+async def cached_json_response(request: Request, key, build, version, cache_control: str) -> Response:
+    """Отдаёт закэшированный JSON или собирает его через await build(); поддерживает If-None-Match -> 304.
+    ETag — версия строк в БД (await version()), а не хэш тела: при промахе кэша (другой воркер,
+    истёкший TTL) совпавший ETag отвечает 304 лёгким запросом версии, без сборки и сериализации ответа."""
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation()
+        try:
+            row_version = await version()
+        except DatabaseUnavailable:
+            # БД недоступна: build() может ответить запасным значением, ETag тогда считается по телу
+            row_version = None
+        etag = response_cache.make_etag(f"{RESPONSE_FORMAT_VERSION}:{row_version}") if row_version else None
+        if etag and etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+        entry = response_cache.set(key, dump_json(await build()), generation, etag)
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+class WebAppAuthRequest(BaseModel):
+    init_data: str
+
+def session_claims(request: Request, token: Optional[str] = None) -> dict:
+    """Claims токена сессии из "Authorization: Bearer ..." (или token — для EventSource, который не шлёт заголовки)"""
+    authorization = request.headers.get("authorization") or ""
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not token:
+        raise HTTPException(status_code=401, detail="Session token required", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return verify_session(token)
+    except AuthError as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+def check_user_access(request: Request, telegram_id: int, token: Optional[str] = None):
+    """Пользователь видит только свои данные, админ — любые"""
+    claims = session_claims(request, token)
+    if claims["sub"] != telegram_id and not claims["adm"]:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+def check_admin_access(request: Request):
+    """Админские операции: X-Admin-Token для серверных интеграций или сессия администратора"""
+    if "x-admin-token" in request.headers:
+        check_admin_token(request)
+    elif not session_claims(request)["adm"]:
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+def track_owner(request: Request) -> Optional[int]:
+    """Чьи заказы видны запросу: None — любые (админ или X-Admin-Token), иначе telegram_id из сессии"""
+    if "x-admin-token" in request.headers:
+        check_admin_token(request)
+        return None
+    claims = session_claims(request)
+    return None if claims["adm"] else claims["sub"]
+
+@app.post("/api/auth/webapp")
+async def api_auth_webapp(body: WebAppAuthRequest):
+    """Обмен initData мини-приложения Telegram на короткоживущий токен сессии.
+    БД читается только здесь: дальше права берутся из подписанного токена."""
+    try:
+        telegram_user = verify_init_data(body.init_data)
+    except AuthError as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    user = await db.read_async('get_user', telegram_user["id"])
+    if not user:
+        raise HTTPException(status_code=404, detail="User not registered")
+    token, claims = issue_session(user["telegram_id"], user["customer_code"], user["is_admin"])
+    return {
+        "token": token,
+        "expires_at": claims["exp"],
+        "telegram_id": claims["sub"],
+        "customer_code": claims["code"],
+        "is_admin": claims["adm"]
+    }
+
+@app.get("/api/user/{telegram_id}", responses={200: {"model": UserSummary}})
+async def api_get_user(telegram_id: int, request: Request):
+    check_user_access(request, telegram_id)
+    async def build():
+        # Чтение в пуле потоков; одновременные промахи кэша по одному ключу — один запрос к БД
+        user = await db.read_async('get_user_summary', telegram_id)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
+        return user
+    async def version():
+        return await db.read_async('get_user_version', telegram_id)
+    return await cached_json_response(request, ('user', telegram_id), build, version, PRIVATE_CACHE_CONTROL)
+
+@app.get("/api/orders/{telegram_id}", responses={200: {"model": OrdersResponse}})
+async def api_get_orders(telegram_id: int, request: Request):
+    check_user_access(request, telegram_id)
+    async def build():
+        return {"orders": await db.read_async('get_user_orders', telegram_id)}
+    async def version():
+        return await db.read_async('get_orders_version', telegram_id)
+    return await cached_json_response(request, ('orders', telegram_id), build, version, PRIVATE_CACHE_CONTROL)
+
+@app.get("/api/orders/{telegram_id}/events")
+async def api_order_events(telegram_id: int, request: Request, token: Optional[str] = None):
+    """Live-лента изменений заказов пользователя (Server-Sent Events).
+    EventSource не умеет заголовки, поэтому токен сессии можно передать в ?token="""
+    check_user_access(request, telegram_id, token)
+    queue = order_events.subscribe(telegram_id)
+
+    async def stream():
+        try:
+            yield b"retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                yield b"event: orders\ndata: " + dump_json(event) + b"\n\n"
+        finally:
+            order_events.unsubscribe(telegram_id, queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/exchange_rates", responses={200: {"model": ExchangeRatesResponse}})
+async def api_get_exchange_rates(request: Request):
+    async def build():
+        return {"rates": await db.read_async('get_exchange_rates_brief')}
+    async def version():
+        return await db.read_async('get_exchange_rates_version')
+    return await cached_json_response(request, ('exchange_rates',), build, version, EXCHANGE_RATES_CACHE_CONTROL)
+
+@app.get("/api/exchange_rates/history")
+async def api_get_exchange_rate_history(
+    request: Request,
+    currency: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    at: Optional[datetime] = None,
+    interval: str = "day"
+):
+    """История курса: версия на момент at, дневные свечи (interval=day) или все изменения (interval=raw).
+    Диапазонные запросы тяжелее остальных — только для вошедших пользователей."""
+    session_claims(request)
+    currency = currency.upper()
+    if at:
+        row = await db.read_async('get_exchange_rate_at', currency, at)
+        if not row:
+            raise HTTPException(status_code=404, detail="Rate not found")
+        return {
+            "code": row["currency_code"],
+            "version": row["id"],
+            "rate": row["rate"],
+            "valid_from": row["valid_from"]
+        }
+
+    end = end or datetime.now(timezone.utc)
+    start = start or end - timedelta(days=30)
+    if interval == "day":
+        candles = await db.read_async('get_exchange_rate_ohlc', currency, start, end)
+        return {
+            "code": currency,
+            "interval": "day",
+            "candles": [{
+                "date": c["day"].date(),
+                "open": c["open"],
+                "high": c["high"],
+                "low": c["low"],
+                "close": c["close"],
+                "changes": c["changes"]
+            } for c in candles]
+        }
+    if interval == "raw":
+        history = await db.read_async('get_exchange_rate_history', currency, start, end)
+        return {
+            "code": currency,
+            "interval": "raw",
+            "history": [{
+                "version": h["id"],
+                "rate": h["rate"],
+                "valid_from": h["valid_from"]
+            } for h in history]
+        }
+    raise HTTPException(status_code=400, detail="interval must be 'day' or 'raw'")
+
+class TrackBatchRequest(BaseModel):
+    track_codes: List[str]
+
+class UsersBatchRequest(BaseModel):
+    telegram_ids: List[int]
+
+def check_batch_size(keys):
+    if not keys:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(keys) > MAX_BATCH_KEYS:
+        raise HTTPException(status_code=413, detail=f"Batch is limited to {MAX_BATCH_KEYS} keys")
+
+def stream_batch_results(items):
+    """Отдаёт {"results": [...]} кусками, не собирая весь JSON в памяти"""
+    def generate():
+        yield b'{"results":['
+        separator = b""
+        chunk = []
+        for item in items:
+            chunk.append(dump_json(item))
+            if len(chunk) >= BATCH_STREAM_CHUNK:
+                yield separator + b",".join(chunk)
+                separator = b","
+                chunk = []
+        if chunk:
+            yield separator + b",".join(chunk)
+        yield b']}'
+    return StreamingResponse(generate(), media_type="application/json")
+
+@app.post("/api/track/batch")
+async def api_track_batch(body: TrackBatchRequest, request: Request):
+    """Статусы пачки трек-кодов одним запросом к БД; для ненайденных — ошибка в элементе.
+    Пользователь получает только свои заказы, чужие трек-коды — как ненайденные."""
+    owner_id = track_owner(request)
+    check_batch_size(body.track_codes)
+    found = await db.read_async('find_track_codes_batch', tuple(body.track_codes), owner_id)
+
+    def items():
+        for code in body.track_codes:
+            row = found.get(normalize_track_code(code))
+            if not row:
+                yield {"key": code, "error": "not_found"}
+                continue
+            yield {"key": code, "data": row}
+    return stream_batch_results(items())
+
+@app.post("/api/users/batch")
+async def api_users_batch(body: UsersBatchRequest, request: Request):
+    """Профили пачки пользователей одним запросом к БД; для ненайденных — ошибка в элементе"""
+    check_admin_access(request)
+    check_batch_size(body.telegram_ids)
+    found = await db.read_async('get_users_batch', tuple(body.telegram_ids))
+
+    def items():
+        for telegram_id in body.telegram_ids:
+            user = found.get(telegram_id)
+            if not user:
+                yield {"key": telegram_id, "error": "not_found"}
+                continue
+            yield {"key": telegram_id, "data": user}
+    return stream_batch_results(items())
+
+@app.get("/api/track/search")
+async def api_search_track(q: str, request: Request, limit: int = 10):
+    """Поиск трек-кодов по префиксу и с учётом опечаток — среди своих заказов (админ ищет по всем)"""
+    owner_id = track_owner(request)
+    rows = await db.read_async('search_track_codes', q, max(1, min(limit, 50)), True, owner_id)
+    return {"results": [{
+        "track_code": row["track_code"],
+        "status": row["status"],
+        "description": row["description"],
+        "date": row["created_date"],
+        "exact": row["exact"],
+        "score": round(row["score"], 3)
+    } for row in rows]}
+
+@app.get("/api/track/{track_code}", responses={200: {"model": TrackInfo}})
+async def api_track_order(track_code: str, request: Request):
+    row = await db.read_async('find_track_code', track_code, track_owner(request))
+    if not row:
+        raise HTTPException(status_code=404, detail="Track code not found")
+    return FastJSONResponse(row)
+
+@app.post("/api/balance/update")
+async def api_update_balance(request: Request):
+    check_admin_access(request)
+    data = await request.json()
+    telegram_id = data.get("telegram_id")
+    amount = data.get("amount")
+    if not telegram_id or not amount:
+        raise HTTPException(status_code=400, detail="Missing telegram_id or amount")
+    idempotency_key = request.headers.get("Idempotency-Key") or data.get("idempotency_key")
+    new_balance, applied = await asyncio.to_thread(
+        db.update_balance, telegram_id, amount,
+        idempotency_key=idempotency_key,
+        reason=data.get("reason") or "api"
+    )
+    if new_balance is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"new_balance": new_balance, "applied": applied}
+
+class BalanceTransaction(BaseModel):
+    telegram_id: int
+    amount: Decimal
+    idempotency_key: Optional[str] = None
+    reason: Optional[str] = None
+
+class BalanceBatchRequest(BaseModel):
+    transactions: List[BalanceTransaction] = []
+
+@app.post("/api/balance/batch")
+async def api_post_balance_batch(body: BalanceBatchRequest, request: Request):
+    """Пакетное проведение операций: {"transactions": [{"telegram_id", "amount", "idempotency_key", "reason"}]}"""
+    check_admin_access(request)
+    for t in body.transactions:
+        if not t.telegram_id or not t.amount:
+            raise HTTPException(status_code=400, detail="Each transaction needs telegram_id and amount")
+    transactions = [t.dict() for t in body.transactions]
+    balances = await asyncio.to_thread(db.post_balance_transactions, transactions)
+    return {"balances": {str(k): v for k, v in balances.items()}}
+
+def check_admin_token(request: Request):
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    token = request.headers.get("X-Admin-Token") or ""
+    if not hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.get("/api/admin/users/search")
+async def api_search_users(q: str, request: Request, limit: int = 20, offset: int = 0):
+    """Поиск клиентов: фрагмент телефона, имя/username с опечатками, префикс кода клиента"""
+    check_admin_access(request)
+    offset = max(0, offset)
+    rows, has_more = await db.read_async('search_users', q, max(1, min(limit, 50)), offset)
+    return FastJSONResponse({"results": rows, "offset": offset, "has_more": has_more})
+
+@app.get("/api/admin/export/{kind}")
+async def api_export(kind: str, request: Request, format: str = "csv"):
+    """Полная выгрузка для бухгалтерии: CSV отдаётся потоком прямо из серверного курсора,
+    XLSX собирается во временный файл (формат требует записи оглавления в конце архива)"""
+    check_admin_token(request)
+    if kind not in EXPORT_KINDS:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be 'csv' or 'xlsx'")
+    headers = {"Content-Disposition": f'attachment; filename="{export_filename(kind, format)}"'}
+    if format == "csv":
+        # Синхронный генератор Starlette итерирует в пуле потоков, не блокируя цикл событий
+        return StreamingResponse(
+            iter_csv(db.export_rows(kind)), media_type=EXPORT_MEDIA_TYPES["csv"], headers=headers
+        )
+    path = await asyncio.to_thread(export_to_file, kind, format)
+    return FileResponse(
+        path, media_type=EXPORT_MEDIA_TYPES["xlsx"], headers=headers,
+        background=BackgroundTask(os.remove, path)
+    )
+
+@app.get("/api/admin/documents/{kind}/{track_code}")
+async def api_document(kind: str, track_code: str, request: Request):
+    """Этикетка (PNG) или счёт (PDF) заказа. Рендеринг идёт в пуле процессов,
+    готовый документ кэшируется до следующего изменения заказа"""
+    check_admin_token(request)
+    if kind not in DOCUMENT_KINDS:
+        raise HTTPException(status_code=404, detail="Unknown document")
+    document = await render_document(kind, track_code)
+    if not document:
+        raise HTTPException(status_code=404, detail="Track code not found")
+    filename, media_type, data = document
+    return Response(
+        content=data, media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/api/admin/containers/{container_code}/labels")
+async def api_container_labels(container_code: str, request: Request):
+    """Этикетки всех заказов контейнера одним PDF"""
+    check_admin_token(request)
+    path, count = await container_labels_to_file(container_code)
+    if not path:
+        raise HTTPException(status_code=404, detail="Container is empty or not found")
+    return FileResponse(
+        path, media_type="application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="labels_{container_code}.pdf"',
+            "X-Label-Count": str(count)
+        },
+        background=BackgroundTask(os.remove, path)
+    )
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "service": "Golden Dragon Bot + API",
+        "database": db.health()["state"],
+        "in_flight": api_in_flight
+    }
+
+@app.get("/")
+async def root():
+    return {
+        "message": "Golden Dragon Bot API",
+        "endpoints": [
+            "/health",
+            "/api/auth/webapp (POST initData -> token)",
+            "/api/user/{telegram_id} (Bearer)",
+            "/api/orders/{telegram_id} (Bearer)",
+            "/api/orders/{telegram_id}/events (SSE, Bearer or ?token=)",
+            "/api/exchange_rates",
+            "/api/exchange_rates/history?currency=USD (Bearer)",
+            "/api/track/{track_code} (Bearer: own orders; admin: any)",
+            "/api/track/search?q= (Bearer: own orders; admin: any)",
+            "/api/track/batch (POST, Bearer: own orders; admin or X-Admin-Token: any)",
+            "/api/users/batch (POST, admin)",
+            "/api/balance/update (POST, admin)",
+            "/api/balance/batch (POST, admin)",
+            "/api/admin/export/{users|orders|balance_transactions}?format=csv|xlsx (X-Admin-Token)",
+            "/api/admin/users/search?q=&limit=&offset= (admin)",
+            "/api/admin/documents/{label|invoice}/{track_code} (X-Admin-Token)",
+            "/api/admin/containers/{container_code}/labels (X-Admin-Token)"
+        ]
+    }
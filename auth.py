@@ -0,0 +1,89 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import parse_qsl
+
+from config import BOT_TOKEN, API_SESSION_SECRET
+from response_cache import TTLCache
+
+# initData старше этого не принимаем: подписанную строку могли перехватить и повторить
+INIT_DATA_MAX_AGE = 24 * 3600
+# Сколько живёт токен сессии; права (is_admin) перечитываются из БД не реже этого
+SESSION_TTL = 15 * 60
+SESSION_CACHE_SIZE = 50000
+
+# Проверенные токены -> claims: повторный запрос не считает HMAC и не ходит в БД
+_sessions = TTLCache(ttl=SESSION_TTL, max_entries=SESSION_CACHE_SIZE)
+
+
+class AuthError(Exception):
+    """Подпись initData или токена сессии не сошлась либо данные устарели"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def verify_init_data(init_data, bot_token=None, max_age=INIT_DATA_MAX_AGE):
+    """Проверяет initData мини-приложения Telegram и возвращает из него словарь user.
+    Подпись — HMAC-SHA256 строки "ключ=значение" по алфавиту с ключом HMAC("WebAppData", токен бота)."""
+    params = dict(parse_qsl(init_data or "", keep_blank_values=True))
+    received = params.pop('hash', '')
+    check_string = "\n".join(f"{key}={value}" for key, value in sorted(params.items()))
+    secret = hmac.new(b"WebAppData", (bot_token or BOT_TOKEN).encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not received or not hmac.compare_digest(expected, received):
+        raise AuthError("Invalid initData signature")
+    try:
+        auth_date = int(params.get('auth_date', 0))
+        user = json.loads(params.get('user') or 'null')
+    except ValueError:
+        raise AuthError("Malformed initData")
+    if time.time() - auth_date > max_age:
+        raise AuthError("initData is expired")
+    if not isinstance(user, dict) or 'id' not in user:
+        raise AuthError("initData has no user")
+    return user
+
+
+def _session_signature(payload):
+    key = API_SESSION_SECRET.encode() if API_SESSION_SECRET else hmac.new(
+        BOT_TOKEN.encode(), b"api-session", hashlib.sha256
+    ).digest()
+    return _b64encode(hmac.new(key, payload.encode(), hashlib.sha256).digest())
+
+
+def issue_session(telegram_id, customer_code, is_admin, ttl=SESSION_TTL):
+    """Выпускает токен сессии "<claims>.<подпись>" и сразу кладёт его в кэш проверенных.
+    Возвращает (токен, claims)."""
+    claims = {'sub': telegram_id, 'code': customer_code, 'adm': bool(is_admin), 'exp': int(time.time()) + ttl}
+    payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    token = f"{payload}.{_session_signature(payload)}"
+    _sessions.set(token, claims)
+    return token, claims
+
+
+def verify_session(token):
+    """Claims токена сессии: telegram_id (sub), код клиента (code), админ (adm), срок (exp).
+    Токен, уже проверенный этим процессом, — один поиск в словаре: без HMAC, JSON и БД."""
+    claims = _sessions.get(token)
+    if claims is None:
+        payload, _, signature = (token or "").partition('.')
+        if not payload or not hmac.compare_digest(_session_signature(payload), signature):
+            raise AuthError("Invalid session token")
+        claims = json.loads(_b64decode(payload))
+        if claims['exp'] > time.time():
+            _sessions.set(token, claims)
+    if claims['exp'] <= time.time():
+        raise AuthError("Session expired")
+    return claims
+
+
+def session_stats():
+    return _sessions.stats()
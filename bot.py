@@ -1,24 +1,30 @@
 import logging
-import os
 import asyncio
-import json
-from contextlib import asynccontextmanager
-from typing import Dict, Any, Optional
-from datetime import datetime
-
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
-
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
+import os
+import re
+import signal
+import threading
+from datetime import date
+
+from telegram import (
+    Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo,
+    InlineQueryResultArticle, InputTextMessageContent
+)
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, InlineQueryHandler,
     ConversationHandler, filters, ContextTypes
 )
 
 # Импортируем конфигурацию и базу данных
 from config import BOT_TOKEN, ADMIN_ACCESS_CODE
-from database import db
+from database import db, normalize_track_code, DatabaseUnavailable, USER_SEARCH_PAGE
+from documents import render_document, container_labels_to_file
+from exports import EXPORT_KINDS, EXPORT_FORMATS, export_filename, export_to_file
+from media import MAX_IMAGE_DOCUMENT_BYTES, resize_photo, send_attachments
+from outbox import PrioritySendLimiter, LANE_BROADCAST, LANE_NOTIFICATION
+from response_cache import TTLCache
+from throttle import InboundThrottle, SerializedUpdateProcessor
+from workers import run_in_process, shutdown as shutdown_workers
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -32,44 +38,163 @@ SELECT_CURRENCY, ENTER_NEW_RATE = range(2, 4)
 SELECT_DELIVERY_METHOD, ENTER_NEW_PRICE, ENTER_NEW_DAYS = range(4, 7)
 SELECT_ORDER_STATUS, BROADCAST_MESSAGE = range(7, 9)
 EXCHANGE_SELECT_FROM, EXCHANGE_SELECT_TO, EXCHANGE_ENTER_AMOUNT = range(9, 12)
+BROADCAST_SEGMENT = 12
 
 # ------------------------- Глобальные переменные -------------------------
 telegram_app = None
+inbound_throttle = InboundThrottle()
+
+# Имя аренды лидерства: обновления Telegram получает только одна реплика
+TELEGRAM_LEASE = "telegram-updates"
+# Как часто резервная реплика пытается захватить аренду
+LEASE_RETRY_SECONDS = 5
+# Как часто лидер проверяет, что аренда всё ещё его
+LEASE_HEARTBEAT_SECONDS = 5
+# Сколько сообщений рассылки одновременно стоят в очереди отправки
+BROADCAST_CONCURRENCY = 50
+# Готовые аудитории рассылки -> фильтры сегмента (см. database.SEGMENT_FILTERS)
+BROADCAST_PRESETS = {
+    "📢 Всем пользователям": {},
+    "👥 Только клиентам с заказами": {'has_orders': True},
+    "👑 Только администраторам": {'admins': True},
+}
+BROADCAST_CUSTOM_SEGMENT = "🎯 Сегмент по фильтрам"
+SEGMENT_HELP = (
+    "🎯 Опишите сегмент, по одному фильтру в строке:\n\n"
+    "статус: В пути, На складе\n"
+    "заказы: есть | нет\n"
+    "последний заказ: 2024-01-01..2024-03-31\n"
+    "доставка: <тип доставки>\n"
+    "баланс: 100..5000\n"
+    "регистрация: 2024-01-01..\n"
+    "админы: да | нет\n\n"
+    "У диапазона можно опустить любую границу. Фильтры объединяются через «и»."
+)
+# Фильтры-диапазоны: поле описания -> (фильтр "от", фильтр "до", разбор значения)
+SEGMENT_RANGES = {
+    'последний заказ': ('last_order_after', 'last_order_before', date.fromisoformat),
+    'регистрация': ('registered_after', 'registered_before', date.fromisoformat),
+    'баланс': ('balance_min', 'balance_max', lambda value: float(value.replace(',', '.'))),
+}
+
+# Инлайн-поиск "@bot <трек-код>": короче этого ключа запрос считается недописанным и не обрабатывается
+INLINE_MIN_QUERY_LENGTH = 4
+# Telegram присылает запрос на каждую нажатую клавишу; ищем только то, что не сменилось за эту паузу
+INLINE_DEBOUNCE_SECONDS = 0.4
+INLINE_RESULTS_LIMIT = 10
+# Сколько живут результаты в кэше процесса и сколько Telegram хранит ответ у себя (для каждого пользователя свой)
+INLINE_CACHE_TTL = 30
+INLINE_CACHE_TIME = 30
+inline_cache = TTLCache(ttl=INLINE_CACHE_TTL, max_entries=5000)
+# Последний инлайн-запрос каждого пользователя, который ещё ждёт паузы в наборе
+_inline_pending = {}
+
+# Сколько последних альбомов помнить, чтобы привязать элементы без подписи к трек-коду
+MEDIA_ALBUMS_REMEMBERED = 20
+
+# Telegram принимает от бота документы до 50 МБ
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+# Кнопки выбора нового статуса заказа в админке
+ORDER_STATUS_BUTTONS = {
+    "🟡 В обработке": "В обработке",
+    "🟢 Доставлен": "Доставлен",
+    "🔴 Отменен": "Отменен",
+    "🚚 В пути": "В пути",
+    "📦 На складе": "На складе"
+}
+STATUS_ICONS = {status: button.split()[0] for button, status in ORDER_STATUS_BUTTONS.items()}
 
 # ------------------------- ОБРАБОТЧИК ОШИБОК -------------------------
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, DatabaseUnavailable):
+        logger.warning(f"БД недоступна: {context.error}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("⚠️ Сервис временно недоступен, попробуйте через минуту.")
+        return
     logger.error("Exception while handling an update:", exc_info=context.error)
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Инициализация и завершение работы бота"""
+async def start_telegram():
+    """Создаёт Telegram-приложение и запускает получение обновлений"""
     global telegram_app
     
-    telegram_app = Application.builder().token(BOT_TOKEN).build()
+    # Все исходящие запросы идут через общую очередь с приоритетами и лимитами Telegram;
+    # входящие обрабатываются параллельно с общим лимитом, но по очереди для каждого пользователя
+    telegram_app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(PrioritySendLimiter())
+        .concurrent_updates(SerializedUpdateProcessor())
+        .build()
+    )
     telegram_app.add_error_handler(error_handler)
     register_handlers(telegram_app)
     await telegram_app.bot.delete_webhook(drop_pending_updates=True)
     await telegram_app.initialize()
     await telegram_app.start()
-    asyncio.create_task(telegram_app.updater.start_polling())
+    await telegram_app.updater.start_polling()
     
     logger.info("✅ Telegram бот запущен и получает обновления")
-    
-    yield
-    
+
+async def stop_telegram():
+    """Останавливает получение обновлений и Telegram-приложение"""
     await telegram_app.updater.stop()
     await telegram_app.stop()
     await telegram_app.shutdown()
+    shutdown_workers()
     logger.info("🛑 Telegram бот остановлен")
 
-# ------------------------- FastAPI приложение -------------------------
-app = FastAPI(lifespan=lifespan, title="Golden Dragon Bot + API")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def run_as_leader(name, job):
+    """Выполняет job() только пока эта реплика держит аренду name.
+
+    Резервные реплики опрашивают аренду каждые LEASE_RETRY_SECONDS; если лидер
+    теряет соединение с арендой, job отменяется, а аренду захватывает другая реплика.
+    """
+    lease = db.lease(name)
+    try:
+        while True:
+            try:
+                acquired = await asyncio.to_thread(lease.try_acquire)
+            except Exception as e:
+                logger.error(f"Не удалось получить аренду {name}: {e}")
+                acquired = False
+            if not acquired:
+                await asyncio.sleep(LEASE_RETRY_SECONDS)
+                continue
+
+            logger.info(f"👑 Аренда {name} получена, запускаем задачу")
+            task = asyncio.create_task(job())
+            try:
+                while not task.done():
+                    await asyncio.wait({task}, timeout=LEASE_HEARTBEAT_SECONDS)
+                    if not task.done() and not await asyncio.to_thread(lease.is_held):
+                        logger.warning(f"⚠️ Аренда {name} потеряна, останавливаем задачу")
+                        task.cancel()
+                        await asyncio.gather(task, return_exceptions=True)
+                        break
+                else:
+                    # Задача завершилась сама: при успехе аренда больше не нужна, при ошибке — перезапуск
+                    try:
+                        task.result()
+                        return
+                    except Exception as e:
+                        logger.error(f"Задача под арендой {name} упала: {e}")
+            finally:
+                if not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                await asyncio.to_thread(lease.release)
+            await asyncio.sleep(LEASE_RETRY_SECONDS)
+    finally:
+        await asyncio.to_thread(lease.release)
+
+async def telegram_polling_job():
+    """Получает обновления Telegram, пока задачу не отменят"""
+    await start_telegram()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stop_telegram()
 
 # ------------------------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ -------------------------
 def get_main_keyboard(is_admin=False):
@@ -189,19 +314,21 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Пополнение баланса"""
     user_id = update.effective_user.id
-    user_data = db.get_user(user_id)
-    if not user_data:
-        await update.message.reply_text("Сначала зарегистрируйтесь через /start")
-        return
-    
     try:
         amount = float(context.args[0])
         if amount <= 0:
             await update.message.reply_text("Сумма должна быть положительной.")
             return
         
-        db.update_balance(user_id, amount)
-        new_balance = user_data['balance'] + amount
+        # update_id уникален для апдейта, поэтому повторная доставка того же сообщения не зачислит сумму дважды
+        new_balance, _ = db.update_balance(
+            user_id, amount,
+            idempotency_key=f"tg-update:{update.update_id}",
+            reason="pay"
+        )
+        if new_balance is None:
+            await update.message.reply_text("Сначала зарегистрируйтесь через /start")
+            return
         await update.message.reply_text(
             f"✅ Баланс пополнен на {amount} руб.\n"
             f"💳 Текущий баланс: {new_balance} руб"
@@ -215,7 +342,7 @@ async def fullfilment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📦 Фулфилмент\n\n"
         "Мы берём на себя всё: приём, хранение, упаковку и отправку ваших заказов.\n"
         "✅ Бесплатное хранение до 7 дней\n"
-        "✅ Фото‑ и видеоотчёт\n"
+        "✅ Фото‑ и видеоотчёт: /photos <трек-код>\n"
         "✅ Интеграция с вашими магазинами\n\n"
         "👤 Менеджер: @fulfilment_manager\n"
         "📱 WhatsApp: +7 999 111 22 33\n\n"
@@ -225,7 +352,7 @@ async def fullfilment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def exchange_rates_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показ курсов валют"""
-    rates = db.get_exchange_rates()
+    rates = await db.read_async('get_exchange_rates')
     if not rates:
         await update.message.reply_text("Курсы валют временно недоступны.")
         return
@@ -382,7 +509,7 @@ async def exchange_currency_start(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("Пожалуйста, сначала зарегистрируйтесь через /start")
         return ConversationHandler.END
 
-    rates = db.get_exchange_rates()
+    rates = await db.read_async('get_exchange_rates')
     if not rates:
         await update.message.reply_text("Курсы валют временно недоступны.")
         return ConversationHandler.END
@@ -585,7 +712,7 @@ async def change_exchange_rate(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("У вас нет доступа.")
         return
     
-    rates = db.get_exchange_rates()
+    rates = await db.read_async('get_exchange_rates')
     keyboard = [[f"{r['flag']} {r['name']} (текущий: {r['rate']} RUB)"] for r in rates] + [["🔙 Назад"]]
     context.user_data['rates'] = rates
     
@@ -757,7 +884,7 @@ async def manage_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard.append(["🔙 Назад"])
     context.user_data['recent_orders'] = orders
     await update.message.reply_text(
-        text + "Выберите заказ для изменения статуса:",
+        text + "Выберите заказ для изменения статуса или введите трек-код (можно частично):",
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
     return SELECT_ORDER_STATUS
@@ -769,6 +896,19 @@ async def select_order_for_status_change(update: Update, context: ContextTypes.D
         return ConversationHandler.END
     track_code = text.split(' - ')[0] if ' - ' in text else text
     orders = context.user_data.get('recent_orders', [])
+    if not any(o['track_code'] == track_code for o in orders):
+        # Заказа нет среди последних — ищем по частичному или неточному трек-коду
+        orders = db.search_track_codes(track_code)
+        if orders and (orders[0]['exact'] or len(orders) == 1):
+            track_code = orders[0]['track_code']
+        elif orders:
+            context.user_data['recent_orders'] = orders
+            keyboard = [[f"{o['track_code']} - {o['status']}"] for o in orders] + [["🔙 Назад"]]
+            await update.message.reply_text(
+                "🔎 Найдено несколько заказов, выберите нужный:",
+                reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            )
+            return SELECT_ORDER_STATUS
     for o in orders:
         if o['track_code'] == track_code:
             context.user_data['selected_order_id'] = o['id']
@@ -796,14 +936,7 @@ async def update_order_status(update: Update, context: ContextTypes.DEFAULT_TYPE
     if text == "🔙 Назад":
         await update.message.reply_text("Отменено.", reply_markup=get_main_keyboard(True))
         return
-    status_map = {
-        "🟡 В обработке": "В обработке",
-        "🟢 Доставлен": "Доставлен",
-        "🔴 Отменен": "Отменен",
-        "🚚 В пути": "В пути",
-        "📦 На складе": "На складе"
-    }
-    new_status = status_map.get(text)
+    new_status = ORDER_STATUS_BUTTONS.get(text)
     if not new_status:
         return
     order_id = context.user_data.get('selected_order_id')
@@ -819,43 +952,83 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not db.is_admin(user_id):
         await update.message.reply_text("У вас нет доступа.")
         return
-    keyboard = [
-        ["📢 Всем пользователям"],
-        ["👥 Только клиентам с заказами"],
-        ["👑 Только администраторам"],
-        ["🔙 Назад"]
-    ]
+    keyboard = [[title] for title in BROADCAST_PRESETS] + [[BROADCAST_CUSTOM_SEGMENT], ["🔙 Назад"]]
     await update.message.reply_text(
         "📢 Рассылка сообщений\n\nВыберите аудиторию:",
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
     return BROADCAST_MESSAGE
 
+def parse_segment(text):
+    """Разбирает описание сегмента от админа (формат — в SEGMENT_HELP) в фильтры для Database.
+    При ошибке бросает ValueError с понятным админу текстом."""
+    segment = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        key, separator, value = line.partition(':')
+        key, value = key.strip().lower(), value.strip()
+        if not separator or not value:
+            raise ValueError(f"Не понял строку: {line.strip()}")
+        if key == 'статус':
+            segment['order_status'] = [status.strip() for status in value.split(',') if status.strip()]
+        elif key in ('заказы', 'админы'):
+            if value.lower() not in ('есть', 'да', 'нет'):
+                raise ValueError(f"{key}: ожидается «да» или «нет»")
+            segment['has_orders' if key == 'заказы' else 'admins'] = value.lower() != 'нет'
+        elif key == 'доставка':
+            segment['delivery_type'] = value
+        elif key in SEGMENT_RANGES:
+            low_filter, high_filter, convert = SEGMENT_RANGES[key]
+            low, _, high = value.partition('..')
+            try:
+                if low.strip():
+                    segment[low_filter] = convert(low.strip())
+                if high.strip():
+                    segment[high_filter] = convert(high.strip())
+            except ValueError:
+                raise ValueError(f"{key}: не понял значение «{value}»")
+        else:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+    if not segment:
+        raise ValueError("Не задано ни одного фильтра")
+    return segment
+
 async def select_broadcast_audience(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     if text == "🔙 Назад":
         await update.message.reply_text("Отменено.", reply_markup=get_main_keyboard(True))
         return ConversationHandler.END
-    cursor = db.conn.cursor()
-    if text == "📢 Всем пользователям":
-        cursor.execute("SELECT COUNT(*) FROM users")
-        count = cursor.fetchone()[0]
-        context.user_data['broadcast_type'] = 'all'
-        context.user_data['recipient_count'] = count
-    elif text == "👥 Только клиентам с заказами":
-        cursor.execute("SELECT COUNT(DISTINCT user_id) FROM track_codes")
-        count = cursor.fetchone()[0]
-        context.user_data['broadcast_type'] = 'with_orders'
-        context.user_data['recipient_count'] = count
-    elif text == "👑 Только администраторам":
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_admin = 1")
-        count = cursor.fetchone()[0]
-        context.user_data['broadcast_type'] = 'admins'
-        context.user_data['recipient_count'] = count
-    else:
+    if text == BROADCAST_CUSTOM_SEGMENT:
+        await update.message.reply_text(
+            SEGMENT_HELP, reply_markup=ReplyKeyboardMarkup([["🔙 Назад"]], resize_keyboard=True)
+        )
+        return BROADCAST_SEGMENT
+    segment = BROADCAST_PRESETS.get(text)
+    if segment is None:
+        return ConversationHandler.END
+    return await confirm_broadcast_audience(update, context, segment, text)
+
+async def select_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if text == "🔙 Назад":
+        await update.message.reply_text("Отменено.", reply_markup=get_main_keyboard(True))
         return ConversationHandler.END
+    try:
+        segment = parse_segment(text)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{SEGMENT_HELP}")
+        return BROADCAST_SEGMENT
+    return await confirm_broadcast_audience(update, context, segment, f"\n{text}")
+
+async def confirm_broadcast_audience(update: Update, context: ContextTypes.DEFAULT_TYPE, segment, title):
+    """Показывает размер выбранного сегмента и ждёт текст рассылки"""
+    count, exact = await asyncio.to_thread(db.count_segment, segment)
+    context.user_data['broadcast_segment'] = segment
+    context.user_data['recipient_count'] = count if exact else f"≈{count}"
     await update.message.reply_text(
-        f"Выбрана аудитория: {text}\nПолучателей: {context.user_data['recipient_count']}\n\nВведите сообщение для рассылки:"
+        f"Выбрана аудитория: {title}\nПолучателей: {context.user_data['recipient_count']}\n\n"
+        f"Введите сообщение для рассылки:"
     )
     return BROADCAST_MESSAGE
 
@@ -864,35 +1037,64 @@ async def send_broadcast_message(update: Update, context: ContextTypes.DEFAULT_T
     if msg == "🔙 Назад":
         await update.message.reply_text("Отменено.", reply_markup=get_main_keyboard(True))
         return ConversationHandler.END
-    broadcast_type = context.user_data.get('broadcast_type')
-    cursor = db.conn.cursor()
-    if broadcast_type == 'all':
-        cursor.execute("SELECT user_id FROM users")
-    elif broadcast_type == 'with_orders':
-        cursor.execute("SELECT DISTINCT user_id FROM track_codes")
-    elif broadcast_type == 'admins':
-        cursor.execute("SELECT user_id FROM users WHERE is_admin = 1")
-    else:
+    segment = context.user_data.pop('broadcast_segment', None)
+    if segment is None:
         await update.message.reply_text("Тип рассылки не выбран.")
         return ConversationHandler.END
-    recipients = cursor.fetchall()
-    sent = 0
-    failed = 0
-    for r in recipients:
-        try:
-            await context.bot.send_message(
-                chat_id=r[0],
-                text=f"📢 Сообщение от Golden Dragon:\n\n{msg}"
-            )
-            sent += 1
-        except:
-            failed += 1
+    # Рассылка идёт в фоне по низкоприоритетной полосе, чтобы не задерживать ответы другим пользователям
+    context.application.create_task(
+        run_broadcast(context.bot, update.effective_chat.id, segment, f"📢 Сообщение от Golden Dragon:\n\n{msg}")
+    )
     await update.message.reply_text(
-        f"📊 Результаты рассылки:\n\n✅ Успешно: {sent}\n❌ Не удалось: {failed}",
+        f"📤 Рассылка запущена: {context.user_data.get('recipient_count')} получателей.\n"
+        f"Результаты придут отдельным сообщением.",
         reply_markup=get_main_keyboard(True)
     )
     return ConversationHandler.END
 
+async def run_broadcast(bot, admin_chat_id, segment, text):
+    """Отправляет рассылку сегменту через полосу LANE_BROADCAST и сообщает админу итог.
+    Получатели читаются из БД пачками, поэтому память не зависит от размера сегмента."""
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send(chat_id):
+        async with semaphore:
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=LANE_BROADCAST)
+                return True
+            except Exception:
+                return False
+
+    sent = failed = 0
+    chunks = db.iter_segment_recipients(segment)
+    # next() в потоке продолжается и после отмены задачи: close() ждёт его, иначе генератор "уже выполняется"
+    chunks_lock = threading.Lock()
+
+    def next_chunk():
+        with chunks_lock:
+            return next(chunks, None)
+
+    def close_chunks():
+        with chunks_lock:
+            chunks.close()
+
+    try:
+        while True:
+            chat_ids = await asyncio.to_thread(next_chunk)
+            if chat_ids is None:
+                break
+            results = await asyncio.gather(*(send(chat_id) for chat_id in chat_ids))
+            sent += sum(results)
+            failed += len(results) - sum(results)
+    finally:
+        # Генератор держит своё соединение с БД: при отмене рассылки (потеря лидерства) или ошибке
+        # оно закрывается сразу, а не когда сборщик мусора доберётся до генератора
+        await asyncio.to_thread(close_chunks)
+    await bot.send_message(
+        chat_id=admin_chat_id,
+        text=f"📊 Результаты рассылки:\n\n✅ Успешно: {sent}\n❌ Не удалось: {failed}"
+    )
+
 async def fix_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     code = db.register_user(
@@ -909,18 +1111,407 @@ async def fix_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def check_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cursor = db.conn.cursor()
     tables = ['users', 'exchange_rates', 'delivery_methods', 'track_codes']
     res = []
-    for t in tables:
-        try:
-            cursor.execute(f"SELECT COUNT(*) FROM {t}")
-            cnt = cursor.fetchone()[0]
-            res.append(f"✅ {t}: {cnt} записей")
-        except:
-            res.append(f"❌ {t}: ошибка")
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        for t in tables:
+            try:
+                cursor.execute(f"SELECT COUNT(*) AS cnt FROM {t}")
+                cnt = cursor.fetchone()['cnt']
+                res.append(f"✅ {t}: {cnt} записей")
+            except:
+                conn.rollback()
+                res.append(f"❌ {t}: ошибка")
     await update.message.reply_text("📊 Проверка БД:\n\n" + "\n".join(res))
 
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метрики входящих и исходящих сообщений и реплики БД (для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    stats = context.bot.rate_limiter.stats()
+    lines = ["📈 Очередь отправки:\n"]
+    for name, lane in stats['lanes'].items():
+        lines.append(
+            f"• {name}: отправлено {lane['sent']}, ошибок {lane['failed']}, в очереди {lane['queued']}, "
+            f"ожидание ср. {lane['avg_wait']:.2f}с / макс. {lane['max_wait']:.2f}с"
+        )
+    lines.append(f"\n⏸ RetryAfter: {stats['retry_after']} (пауза ещё {stats['paused_for']:.1f}с)")
+    lines.append(f"💬 Чатов в лимитере: {stats['tracked_chats']}")
+    inbound = inbound_throttle.stats()
+    processing = context.application.update_processor.stats()
+    lines.append(
+        f"\n📥 Входящие: принято {inbound['accepted']}, ограничено {inbound['throttled']}, "
+        f"сброшено при перегрузке {inbound['shed']}, отброшено в очереди {processing['dropped']}, "
+        f"ответов «попробуйте позже» {inbound['replied']}"
+    )
+    lines.append(
+        f"⚙️ Обработка: сейчас {processing['in_flight']} из {processing['limit']} "
+        f"(макс. {processing['max_in_flight']}), пользователей в очереди {processing['users_waiting']}"
+    )
+    health = db.health()
+    queries = db.query_stats()
+    lines.append(
+        f"🛡 БД: предохранитель {health['state']}, ошибок подряд {health['failures']}, "
+        f"срабатываний {health['opened']}"
+    )
+    lines.append(
+        f"🔁 Запросов к БД: {queries['queries']}, объединено одинаковых чтений: {queries['shared']}"
+    )
+    lines.append(
+        f"🔌 Соединений с БД: свободно {queries['pool']['idle']} из {queries['pool']['size']}, "
+        f"открыто всего {queries['pool']['opened']}"
+    )
+    inline = inline_cache.stats()
+    lines.append(f"🔎 Инлайн-поиск: в кэше {inline['entries']}, попаданий {inline['hits']}, промахов {inline['misses']}")
+    replica = db.replica_status()
+    if replica['configured']:
+        lag = f"{replica['lag']:.1f}с" if replica['lag'] is not None else "нет данных"
+        lines.append(
+            f"🗄 Реплика: отставание {lag}, чтений с реплики {replica['reads']['replica']}, "
+            f"с primary {replica['reads']['primary']}"
+            + (f" (недоступна ещё {replica['down_for']:.0f}с)" if replica['down_for'] else "")
+        )
+    await update.message.reply_text("\n".join(lines))
+
+async def show_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Счётчики пользователей и кнопки выгрузок для бухгалтерии (для админов)"""
+    stats = db.get_statistics()
+    total, admins = stats['total_users'], stats['admin_users']
+    keyboard = [
+        [InlineKeyboardButton(f"📤 {title} ({fmt.upper()})", callback_data=f"export:{kind}:{fmt}")
+         for fmt in EXPORT_FORMATS]
+        for kind, title in EXPORT_KINDS.items()
+    ]
+    await update.message.reply_text(
+        f"👥 Пользователи:\n\nВсего: {total}\nАдминов: {admins}\nОбычных: {total - admins}\n\n"
+        f"🔎 Поиск клиента: /find телефон, имя, username или код\n\n"
+        f"Выгрузки для бухгалтерии:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def customer_search_page(search, offset):
+    """Страница результатов поиска клиентов: (текст, клавиатура листания или None)"""
+    rows, has_more = await db.read_async('search_users', search, USER_SEARCH_PAGE, offset)
+    if not rows:
+        return ("🔎 Ничего не найдено." if not offset else "🔎 Больше результатов нет."), None
+    lines = [f"🔎 «{search}», {offset + 1}–{offset + len(rows)}:\n"]
+    for user in rows:
+        name = " ".join(part for part in (user['first_name'], user['last_name']) if part) or "без имени"
+        username = f" @{user['username']}" if user['username'] else ""
+        lines.append(f"{'👑' if user['is_admin'] else '👤'} {user['customer_code']} — {name}{username}")
+        lines.append(f"    📱 {user['phone_number'] or '—'}  💳 {user['balance']} руб  🆔 {user['telegram_id']}")
+    buttons = []
+    if offset:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"find:{max(0, offset - USER_SEARCH_PAGE)}"))
+    if has_more:
+        buttons.append(InlineKeyboardButton("Дальше ▶️", callback_data=f"find:{offset + USER_SEARCH_PAGE}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def find_customer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/find <телефон, имя, username или код клиента>: поиск клиента (для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    search = " ".join(context.args)
+    if not search:
+        await update.message.reply_text(
+            "Использование: /find запрос\n\nНапример: /find 1122, /find Петров, /find GD-AB12"
+        )
+        return
+    # Строка поиска может не влезть в callback_data (64 байта) — листание берёт её отсюда
+    context.user_data['customer_search'] = search
+    text, markup = await customer_search_page(search, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+async def handle_customer_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание результатов /find"""
+    query = update.callback_query
+    if not db.is_admin(query.from_user.id):
+        await query.answer("У вас нет доступа.", show_alert=True)
+        return
+    search = context.user_data.get('customer_search')
+    if not search:
+        await query.answer("Поиск устарел, повторите /find.", show_alert=True)
+        return
+    await query.answer()
+    text, markup = await customer_search_page(search, int(query.data.split(":")[1]))
+    await query.edit_message_text(text, reply_markup=markup)
+
+async def handle_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Готовит выгрузку в фоновом потоке и отправляет её файлом"""
+    query = update.callback_query
+    if not db.is_admin(query.from_user.id):
+        await query.answer("У вас нет доступа.", show_alert=True)
+        return
+    _, kind, fmt = query.data.split(":")
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        await query.answer("Неизвестная выгрузка.", show_alert=True)
+        return
+    await query.answer("Готовлю файл...")
+    path = None
+    try:
+        path = await asyncio.to_thread(export_to_file, kind, fmt)
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            await query.message.reply_text(
+                f"⚠️ Файл больше 50 МБ — Telegram его не примет. "
+                f"Скачайте выгрузку через API: /api/admin/export/{kind}?format={fmt}"
+            )
+            return
+        with open(path, 'rb') as f:
+            await query.message.reply_document(
+                document=f,
+                filename=export_filename(kind, fmt),
+                caption=f"📤 {EXPORT_KINDS[kind]}",
+                write_timeout=300
+            )
+    except Exception as e:
+        logger.error(f"Export {kind}.{fmt} failed: {e}")
+        await query.message.reply_text("❌ Не удалось подготовить выгрузку.")
+    finally:
+        if path:
+            os.remove(path)
+
+def format_track_card(row):
+    """Карточка статуса заказа для инлайн-ответа"""
+    icon = STATUS_ICONS.get(row['status'], "📦")
+    lines = [f"📦 Трек-код: {row['track_code']}", f"{icon} Статус: {row['status']}"]
+    if row['description']:
+        lines.append(f"📝 {row['description']}")
+    lines.append(f"📅 Добавлен: {row['created_date']:%d.%m.%Y}")
+    return "\n".join(lines)
+
+async def inline_track_lookup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Инлайн-режим: "@bot <трек-код>" в любом чате показывает карточки статуса заказов.
+    Ищутся только заказы самого пользователя: иначе по префиксу можно было бы перебрать чужие посылки."""
+    query = update.inline_query
+    key = normalize_track_code(query.query)
+    if len(key) < INLINE_MIN_QUERY_LENGTH:
+        # Недописанный код: не отвечаем и не ходим в БД, ответим на следующую клавишу
+        return
+    user_id = query.from_user.id
+    cache_key = (user_id, key)
+    rows = inline_cache.get(cache_key)
+    if rows is None:
+        _inline_pending[user_id] = query.id
+        await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+        if _inline_pending.get(user_id) != query.id:
+            # Пользователь продолжил набирать — ответ получит более поздний запрос
+            return
+        del _inline_pending[user_id]
+        rows = inline_cache.get(cache_key)
+        if rows is None:
+            rows = inline_cache.set(cache_key, await db.read_async(
+                'search_track_codes', key, INLINE_RESULTS_LIMIT, False, user_id
+            ))
+    results = [
+        InlineQueryResultArticle(
+            id=str(row['id']),
+            title=f"{STATUS_ICONS.get(row['status'], '📦')} {row['track_code']}",
+            description=f"{row['status']}" + (f" · {row['description']}" if row['description'] else ""),
+            input_message_content=InputTextMessageContent(format_track_card(row))
+        )
+        for row in rows
+    ]
+    # Ответ зависит от пользователя — Telegram кэширует его отдельно для каждого
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+def _remember_album(albums, album_id, track_code):
+    albums[album_id] = track_code
+    while len(albums) > MEDIA_ALBUMS_REMEMBERED:
+        albums.pop(next(iter(albums)))
+
+async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото и видео от сотрудников склада: трек-код в подписи, file_id сохраняется к заказу.
+    У альбома подпись есть только у первого элемента — остальные привязываются по media_group_id."""
+    message = update.message
+    user_id = update.effective_user.id
+    album_id = message.media_group_id
+    if not db.is_admin(user_id):
+        if not album_id:
+            await message.reply_text("Используйте кнопки меню для навигации.")
+        return
+    albums = context.chat_data.setdefault('media_albums', {})
+    track_code = (message.caption or '').strip()
+    # Отвечаем один раз на фото или альбом, а не на каждый его элемент
+    notify = not album_id or bool(track_code)
+    if album_id and track_code:
+        _remember_album(albums, album_id, track_code)
+    elif album_id:
+        if album_id not in albums:
+            _remember_album(albums, album_id, None)
+            await message.reply_text("📸 Укажите трек-код в подписи к первому фото альбома.")
+        track_code = albums[album_id]
+        if not track_code:
+            return
+    elif not track_code:
+        await message.reply_text("📸 Укажите трек-код в подписи к фото или видео.")
+        return
+
+    if message.photo:
+        kind, media = 'photo', message.photo[-1]
+    elif message.video:
+        kind, media = 'video', message.video
+    else:
+        # Картинка файлом: уменьшаем в пуле процессов и один раз загружаем как фото, дальше — только file_id
+        document = message.document
+        if document.file_size and document.file_size > MAX_IMAGE_DOCUMENT_BYTES:
+            await message.reply_text("⚠️ Файл больше 20 МБ — отправьте его как фото.")
+            return
+        if not db.find_track_code(track_code):
+            if notify:
+                await message.reply_text(f"❌ Трек-код {track_code} не найден.")
+            return
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+        try:
+            photo = await run_in_process(resize_photo, bytes(data))
+        except Exception as e:
+            logger.error(f"Не удалось обработать изображение {document.file_name}: {e}")
+            await message.reply_text("❌ Не удалось обработать изображение.")
+            return
+        sent = await message.reply_photo(photo, caption=f"🖼 {track_code}")
+        kind, media = 'photo', sent.photo[-1]
+
+    row = db.add_track_attachment(track_code, kind, media.file_id, media.file_unique_id, user_id)
+    if not notify:
+        return
+    if row is None:
+        await message.reply_text(f"❌ Трек-код {track_code} не найден.")
+        return
+    await message.reply_text(f"✅ Отчёт сохранён к заказу {row['track_code']}.")
+    if row['telegram_id']:
+        try:
+            await context.bot.send_message(
+                chat_id=row['telegram_id'],
+                text=f"📸 Склад добавил фото‑ или видеоотчёт по заказу {row['track_code']}.\n"
+                     f"Посмотреть: /photos {row['track_code']}",
+                rate_limit_args=LANE_NOTIFICATION
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить владельца заказа {row['track_code']}: {e}")
+
+async def show_track_photos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото- и видеоотчёт по заказу: /photos <трек-код> (владельцу заказа и админам)"""
+    if not context.args:
+        await update.message.reply_text("Использование: /photos трек-код")
+        return
+    user_id = update.effective_user.id
+    report = db.get_track_attachments(" ".join(context.args))
+    if not report or (report['owner_id'] != user_id and not db.is_admin(user_id)):
+        await update.message.reply_text("Заказ не найден.")
+        return
+    if not report['attachments']:
+        await update.message.reply_text(f"По заказу {report['track_code']} пока нет фото‑ и видеоотчёта.")
+        return
+    await send_attachments(
+        context.bot, update.effective_chat.id, report['attachments'],
+        caption=f"📸 Отчёт по заказу {report['track_code']}"
+    )
+
+async def send_order_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/label и /invoice <трек-код>: этикетка (PNG) или счёт (PDF) заказа файлом (для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    kind = 'label' if update.message.text.startswith('/label') else 'invoice'
+    if not context.args:
+        await update.message.reply_text(f"Использование: /{kind} трек-код")
+        return
+    document = await render_document(kind, " ".join(context.args))
+    if not document:
+        await update.message.reply_text("Заказ не найден.")
+        return
+    filename, _, data = document
+    await update.message.reply_document(document=data, filename=filename)
+
+async def add_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/addorder <код клиента> <трек-код> [цена] [валюта] [описание]: новый заказ клиента (для админов).
+    Цена фиксируется по курсу валюты (по умолчанию USD), действующему в момент добавления."""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text(
+            "Использование: /addorder код_клиента трек-код [цена] [валюта] [описание]\n\n"
+            "Например: /addorder GD-AB1234 YT7000000001CN 42.5 USD Кроссовки"
+        )
+        return
+    customer_code, track_code, rest = context.args[0].upper(), context.args[1], context.args[2:]
+    price, currency = 0, "USD"
+    if rest:
+        try:
+            price = float(rest[0].replace(',', '.'))
+            rest = rest[1:]
+        except ValueError:
+            pass
+    if rest and re.fullmatch(r'[A-Za-z]{3}', rest[0]):
+        currency, rest = rest[0].upper(), rest[1:]
+    rates = await db.read_async('get_exchange_rates')
+    if currency not in {r['currency_code'] for r in rates}:
+        await update.message.reply_text(f"Курс валюты {currency} не задан.")
+        return
+    user = await db.read_async('get_user_by_customer_code', customer_code)
+    if not user:
+        await update.message.reply_text(f"Клиент {customer_code} не найден.")
+        return
+    ok, message = await asyncio.to_thread(
+        db.add_track_code, user['telegram_id'], track_code, " ".join(rest), price, currency
+    )
+    if not ok:
+        await update.message.reply_text(f"❌ {message}")
+        return
+    await update.message.reply_text(
+        f"✅ Заказ добавлен\n\n📦 {track_code.upper()}\n👤 Клиент: {customer_code}\n💰 Цена: {price} {currency}"
+    )
+
+async def assign_container(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/container <код контейнера> <трек-коды...>: собрать заказы в контейнер (для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Использование: /container код_контейнера трек-код [трек-код ...]")
+        return
+    container_code, track_codes = context.args[0].upper(), context.args[1:]
+    found = await asyncio.to_thread(db.set_track_container, container_code, track_codes)
+    text = f"📦 В контейнер {container_code} добавлено заказов: {len(found)} из {len(track_codes)}."
+    if len(found) < len(track_codes):
+        text += "\nОстальные трек-коды не найдены."
+    await update.message.reply_text(text + f"\nЭтикетки: /labels {container_code}")
+
+async def send_container_labels(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/labels <код контейнера>: этикетки всех заказов контейнера одним PDF (для админов)"""
+    if not db.is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет доступа.")
+        return
+    if not context.args:
+        await update.message.reply_text("Использование: /labels код_контейнера")
+        return
+    container_code = context.args[0].upper()
+    await update.message.reply_text("🖨 Готовлю этикетки...")
+    path, count = await container_labels_to_file(container_code)
+    if not path:
+        await update.message.reply_text(f"В контейнере {container_code} нет заказов.")
+        return
+    try:
+        if os.path.getsize(path) > TELEGRAM_DOCUMENT_LIMIT:
+            await update.message.reply_text(
+                f"⚠️ Файл больше 50 МБ — Telegram его не примет. "
+                f"Скачайте этикетки через API: /api/admin/containers/{container_code}/labels"
+            )
+            return
+        with open(path, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"labels_{container_code}.pdf",
+                caption=f"🏷 Этикетки контейнера {container_code}: {count} шт.",
+                write_timeout=300
+            )
+    finally:
+        os.remove(path)
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     is_admin = db.is_admin(user_id)
@@ -975,11 +1566,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif text == "📢 Сделать рассылку" and is_admin:
         await broadcast_message(update, context)
     elif text == "👥 Пользователи" and is_admin:
-        users = db.get_all_users(include_admins=True)
-        admins = sum(1 for u in users if u['is_admin'])
-        await update.message.reply_text(
-            f"👥 Пользователи:\n\nВсего: {len(users)}\nАдминов: {admins}\nОбычных: {len(users)-admins}"
-        )
+        await show_users(update, context)
+    elif text in ORDER_STATUS_BUTTONS and is_admin:
+        await update_order_status(update, context)
     elif text == "🔙 Назад":
         await update.message.reply_text("Главное меню:", reply_markup=get_main_keyboard(is_admin))
     else:
@@ -991,6 +1580,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------- РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ -------------------------
 def register_handlers(application: Application):
     """Регистрирует все обработчики"""
+    # Группа -1 выполняется первой: флуд отсекается до обработчиков и запросов к БД
+    application.add_handler(TypeHandler(Update, inbound_throttle), group=-1)
     
     conv_registration = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -1043,9 +1634,10 @@ def register_handlers(application: Application):
         entry_points=[MessageHandler(filters.Regex('^📢 Сделать рассылку$'), broadcast_message)],
         states={
             BROADCAST_MESSAGE: [
-                MessageHandler(filters.Regex('^(📢 Всем пользователям|👥 Только клиентам с заказами|👑 Только администраторам)$'), select_broadcast_audience),
+                MessageHandler(filters.Regex('^(📢 Всем пользователям|👥 Только клиентам с заказами|👑 Только администраторам|🎯 Сегмент по фильтрам)$'), select_broadcast_audience),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, send_broadcast_message),
             ],
+            BROADCAST_SEGMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_broadcast_segment)],
         },
         fallbacks=[CommandHandler('cancel', cancel)]
     )
@@ -1054,6 +1646,17 @@ def register_handlers(application: Application):
     application.add_handler(CommandHandler('pay', pay))
     application.add_handler(CommandHandler('fixadmin', fix_admin))
     application.add_handler(CommandHandler('checkdb', check_db))
+    application.add_handler(CommandHandler('metrics', show_metrics))
+    application.add_handler(CommandHandler('photos', show_track_photos))
+    application.add_handler(CommandHandler(['label', 'invoice'], send_order_document))
+    application.add_handler(CommandHandler('addorder', add_order))
+    application.add_handler(CommandHandler('container', assign_container))
+    application.add_handler(CommandHandler('labels', send_container_labels))
+    application.add_handler(CallbackQueryHandler(handle_export, pattern=r'^export:'))
+    application.add_handler(CommandHandler('find', find_customer))
+    application.add_handler(CallbackQueryHandler(handle_customer_search_page, pattern=r'^find:\d+$'))
+    # block=False: пауза в наборе не задерживает следующие обновления этого пользователя
+    application.add_handler(InlineQueryHandler(inline_track_lookup, block=False))
     application.add_handler(conv_registration)
     application.add_handler(conv_admin_reg)
     application.add_handler(conv_exchange)
@@ -1062,107 +1665,26 @@ def register_handlers(application: Application):
     application.add_handler(conv_manage_orders)
     application.add_handler(conv_broadcast)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.IMAGE, handle_media_upload))
     
     logger.info("✅ Все обработчики бота зарегистрированы")
 
-# ------------------------- API ЭНДПОИНТЫ -------------------------
-@app.get("/api/user/{telegram_id}")
-async def api_get_user(telegram_id: int):
-    user = db.get_user(telegram_id)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    orders = db.get_user_track_codes(telegram_id)
-    return {
-        "customer_code": user["customer_code"],
-        "balance": user["balance"],
-        "orders_count": len(orders),
-        "delivered_count": sum(1 for o in orders if o["status"] == "Доставлен"),
-        "first_name": user["first_name"],
-        "phone_number": user["phone_number"]
-    }
-
-@app.get("/api/orders/{telegram_id}")
-async def api_get_orders(telegram_id: int):
-    orders = db.get_user_track_codes(telegram_id)
-    result = []
-    for o in orders:
-        result.append({
-            "track_code": o["track_code"],
-            "description": o["description"],
-            "status": o["status"],
-            "date": str(o["created_date"]) if o["created_date"] else "",
-            "price": float(o["price"]) if o["price"] else 0
-        })
-    return {"orders": result}
-
-@app.get("/api/exchange_rates")
-async def api_get_exchange_rates():
-    rates = db.get_exchange_rates()
-    result = []
-    for r in rates:
-        result.append({
-            "code": r["currency_code"],
-            "rate": r["rate"],
-            "flag": r["flag"],
-            "name": r["name"]
-        })
-    return {"rates": result}
-
-@app.get("/api/track/{track_code}")
-async def api_track_order(track_code: str):
-    cursor = db.conn.cursor()
-    cursor.execute("""
-        SELECT track_code, status, description, created_date, u.customer_code, price
-        FROM track_codes tc
-        LEFT JOIN users u ON tc.user_id = u.id
-        WHERE track_code = %s
-    """, (track_code.upper(),))
-    row = cursor.fetchone()
-    if not row:
-        raise HTTPException(status_code=404, detail="Track code not found")
-    return {
-        "track_code": row["track_code"],
-        "status": row["status"],
-        "description": row["description"],
-        "date": str(row["created_date"]) if row["created_date"] else "",
-        "customer_code": row["customer_code"],
-        "price": float(row["price"]) if row["price"] else 0
-    }
-
-@app.post("/api/balance/update")
-async def api_update_balance(request: Request):
-    data = await request.json()
-    telegram_id = data.get("telegram_id")
-    amount = data.get("amount")
-    if not telegram_id or not amount:
-        raise HTTPException(status_code=400, detail="Missing telegram_id or amount")
-    db.update_balance(telegram_id, amount)
-    user = db.get_user(telegram_id)
-    return {"new_balance": user["balance"]}
-
-@app.get("/health")
-async def health():
-    return {"status": "ok", "service": "Golden Dragon Bot + API"}
-
-@app.get("/")
-async def root():
-    return {
-        "message": "Golden Dragon Bot API",
-        "endpoints": [
-            "/health",
-            "/api/user/{telegram_id}",
-            "/api/orders/{telegram_id}",
-            "/api/exchange_rates",
-            "/api/track/{track_code}",
-            "/api/balance/update (POST)"
-        ]
-    }
-
 # ------------------------- ЗАПУСК -------------------------
-def main():
-    port = int(os.getenv("PORT", 8000))
-    logger.info(f"🚀 Запуск FastAPI на порту {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+async def run_bot():
+    """Роль bot: один процесс получает обновления Telegram и выполняет фоновые задачи, без HTTP"""
+    # Кэши API живут в других процессах — изменения отправляем через NOTIFY
+    db.notify_changes = True
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    leader = asyncio.create_task(run_as_leader(TELEGRAM_LEASE, telegram_polling_job))
+    await stop_event.wait()
+    leader.cancel()
+    await asyncio.gather(leader, return_exceptions=True)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Точка входа — main.py; запуск через bot.py оставлен для совместимости
+    import main
+    main.main()
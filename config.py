@@ -7,8 +7,32 @@ ADMIN_ACCESS_CODE = os.getenv("ADMIN_ACCESS_CODE", "GD-A4333")  # Значени
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")  # или os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-if not BOT_TOKEN:
-    raise ValueError("BOT_TOKEN не задан в переменных окружения")
+# Роль процесса: bot — только Telegram и фоновые задачи, api — только HTTP API
+# (можно несколько воркеров), combined — всё в одном процессе для небольших установок
+ROLE_BOT = "bot"
+ROLE_API = "api"
+ROLE_COMBINED = "combined"
+APP_ROLE = os.getenv("APP_ROLE", ROLE_COMBINED)
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+# Токен для админских маршрутов API (выгрузки); если не задан, они отключены
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN")
+# Процессы для CPU-тяжёлой работы вне цикла событий (обработка фото, рендеринг документов)
+PROCESS_WORKERS = int(os.getenv("PROCESS_WORKERS", "2"))
+# Откуда браузеру разрешено обращаться к API (CORS): мини-приложение Telegram, через запятую
+WEBAPP_ORIGINS = [origin.strip() for origin in os.getenv("WEBAPP_ORIGINS", "https://usmnv.github.io").split(",")
+                  if origin.strip()]
+# Ключ подписи токенов сессии API; если не задан, выводится из BOT_TOKEN
+API_SESSION_SECRET = os.getenv("API_SESSION_SECRET")
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise ValueError("SUPABASE_URL и SUPABASE_KEY должны быть заданы в переменных окружения")
\ No newline at end of file
+
+def validate_config():
+    """Проверяет обязательные переменные окружения.
+    Вызывается при запуске, а не при импорте, чтобы модули можно было импортировать в тестах и утилитах."""
+    if APP_ROLE not in (ROLE_BOT, ROLE_API, ROLE_COMBINED):
+        raise ValueError(f"APP_ROLE должен быть одним из: {ROLE_BOT}, {ROLE_API}, {ROLE_COMBINED}")
+
+    if not BOT_TOKEN:
+        raise ValueError("BOT_TOKEN не задан в переменных окружения")
+
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError("SUPABASE_URL и SUPABASE_KEY должны быть заданы в переменных окружения")
\ No newline at end of file
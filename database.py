@@ -1,133 +1,1892 @@
 import os
+import random
+import re
+import json
+import asyncio
+import select
+import contextlib
+import functools
+import threading
+import time
+from collections import OrderedDict, deque
 import psycopg2
+import psycopg2.errors
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
-import random
-import string
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from resilience import CircuitBreaker
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Рассылать события изменений через LISTEN/NOTIFY (нужно, когда запущено несколько процессов)
+DB_CHANGE_NOTIFY = os.getenv("DB_CHANGE_NOTIFY", "0") == "1"
+CHANGE_CHANNEL = "gdbot_changes"
+CHANGE_LISTENER_KEEPALIVE = 30
+CHANGE_LISTENER_RECONNECT_DELAY = 5
+# Ключей в одном NOTIFY пакетной записи: telegram_id до 15 символов, полезная нагрузка — до 8000 байт
+CHANGE_KEYS_PER_NOTIFY = 400
+
+# Пространство имён advisory locks для аренды лидерства (первый ключ pg_advisory_lock)
+LEASE_LOCK_CLASS = 0x6764  # "gd"
+# TCP keepalive сессии-аренды: если держатель пропал без закрытия соединения,
+# сервер снимет блокировку примерно через idle + interval * count секунд
+LEASE_KEEPALIVE_IDLE = 5
+LEASE_KEEPALIVE_INTERVAL = 2
+LEASE_KEEPALIVE_COUNT = 3
+
+# Нормализованный ключ трек-кода: только A-Z и 0-9 (пробелы, дефисы и регистр не важны).
+# Выражение совпадает с индексами track_codes_track_key_*, менять только вместе с ними.
+TRACK_KEY_SQL = "regexp_replace(upper(tc.track_code), '[^A-Z0-9]', '', 'g')"
+TRACK_SEARCH_LIMIT = 10
+# Нечёткий поиск по триграммам имеет смысл только для достаточно длинных запросов
+TRACK_FUZZY_MIN_LENGTH = 4
+# Порог similarity для опечаток: одна ошибка в 13–14-значном коде даёт ~0.65, две — ~0.5
+TRACK_FUZZY_THRESHOLD = 0.5
+
+# Поиск клиентов: цифры телефона и "имя фамилия username" в нижнем регистре.
+# Выражения совпадают с индексами users_*_trgm_idx, менять только вместе с ними.
+PHONE_KEY_SQL = "regexp_replace(coalesce(u.phone_number, ''), '[^0-9]', '', 'g')"
+NAME_KEY_SQL = "lower(coalesce(u.first_name, '') || ' ' || coalesce(u.last_name, '') || ' ' || coalesce(u.username, ''))"
+USER_SEARCH_PAGE = 10
+# Триграммный индекс работает с запросами от трёх символов
+USER_SEARCH_MIN_LENGTH = 3
+
+# Сколько раз повторять регистрацию при гонке за одинаковый код клиента
+CUSTOMER_CODE_RETRIES = 5
+
+# Реплика для чтения (необязательно): методы только на чтение уходят на неё
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+# При отставании реплики больше чем на столько секунд чтения идут на primary
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_INTERVAL = 2
+# После записи пользователя его чтения столько секунд идут на primary (read-your-writes)
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+# Пауза перед повторным подключением к недоступной реплике
+REPLICA_RETRY_DELAY = 30
+# Пул соединений с репликой: если все заняты, чтение сразу идёт на primary, а не ждёт
+REPLICA_POOL_SIZE = int(os.getenv("REPLICA_POOL_SIZE", os.getenv("DB_POOL_SIZE", "20")))
+# Отставание реплики в секундах: 0, если всё полученное WAL уже применено
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp())
+    END AS lag
+"""
+
+# Выгрузки для бухгалтерии (см. exports.py): строки читаются серверным курсором порциями
+EXPORT_CHUNK_SIZE = 5000
+EXPORT_QUERIES = {
+    'users': """
+        SELECT u.customer_code, u.telegram_id, u.username, u.first_name, u.last_name,
+               u.phone_number, u.balance, u.is_admin, u.registration_date
+        FROM users u
+        ORDER BY u.id
+    """,
+    'orders': """
+        SELECT tc.id, tc.track_code, u.customer_code, tc.description, tc.status, tc.price,
+               h.currency_code, h.rate AS exchange_rate, tc.price * h.rate AS price_rub,
+               tc.created_date, tc.updated_at
+        FROM track_codes tc
+        LEFT JOIN users u ON u.id = tc.user_id
+        LEFT JOIN exchange_rate_history h ON h.id = tc.exchange_rate_id
+        ORDER BY tc.id
+    """,
+    'balance_transactions': """
+        SELECT bt.id, u.customer_code, bt.amount, bt.reason, bt.idempotency_key, bt.created_at
+        FROM balance_transactions bt
+        JOIN users u ON u.id = bt.user_id
+        ORDER BY bt.id
+    """,
+}
+
+# Сегменты рассылок: фильтр -> условие на users u (параметры именованные, см. compile_segment)
+SEGMENT_FILTERS = {
+    'admins': "u.is_admin = %(admins)s",
+    'has_orders': "EXISTS (SELECT 1 FROM track_codes tc WHERE tc.user_id = u.id) = %(has_orders)s",
+    'order_status': """EXISTS (
+        SELECT 1 FROM track_codes tc WHERE tc.user_id = u.id AND tc.status = ANY(%(order_status)s)
+    )""",
+    'delivery_type': """EXISTS (
+        SELECT 1 FROM track_codes tc
+        JOIN delivery_methods dm ON dm.method_code = tc.delivery_method
+        WHERE tc.user_id = u.id AND dm.type = %(delivery_type)s
+    )""",
+    # Дата последнего заказа: верхняя строка индекса track_codes (user_id, created_date DESC)
+    'last_order_after': "(SELECT MAX(tc.created_date) FROM track_codes tc WHERE tc.user_id = u.id) >= %(last_order_after)s",
+    'last_order_before': "(SELECT MAX(tc.created_date) FROM track_codes tc WHERE tc.user_id = u.id) < %(last_order_before)s",
+    'balance_min': "u.balance >= %(balance_min)s",
+    'balance_max': "u.balance <= %(balance_max)s",
+    'registered_after': "u.registration_date >= %(registered_after)s",
+    'registered_before': "u.registration_date < %(registered_before)s",
+}
+# До скольки получателей (по оценке планировщика) сегмент считается точно
+SEGMENT_EXACT_COUNT_LIMIT = 200000
+# Сколько получателей читать из БД за раз при рассылке
+SEGMENT_CHUNK_SIZE = 1000
+# random_page_cost для запросов сегментов. При стандартных 4 (диск с головками) планировщик
+# вместо проверки заказов каждого пользователя сегмента по индексу track_codes (user_id, status)
+# читает всю track_codes в хэш; на SSD проверка по индексу в разы быстрее
+SEGMENT_RANDOM_PAGE_COST = 1.1
+
+
+def compile_segment(segment):
+    """Собирает условие WHERE для users u из фильтров сегмента.
+    Фильтры со значением None пропускаются, пустой сегмент — все пользователи."""
+    conditions, params = [], {}
+    for name, value in segment.items():
+        if name not in SEGMENT_FILTERS:
+            raise ValueError(f"Unknown segment filter: {name}")
+        if value is None:
+            continue
+        conditions.append(SEGMENT_FILTERS[name])
+        params[name] = list(value) if name == 'order_status' else value
+    return " AND ".join(conditions) or "TRUE", params
+
+
+# statement_timeout по классам запросов (мс): чтения для пользователей, записи, отчёты админки
+QUERY_TIMEOUTS = {
+    'read': int(os.getenv("DB_TIMEOUT_READ_MS", "2000")),
+    'write': int(os.getenv("DB_TIMEOUT_WRITE_MS", "5000")),
+    'report': int(os.getenv("DB_TIMEOUT_REPORT_MS", "60000")),
+}
+# Предохранитель: после стольких ошибок соединения/таймаутов подряд БД считается недоступной
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET_SECONDS = int(os.getenv("DB_BREAKER_RESET_SECONDS", "15"))
+# Сколько последних удачных ответов хранить для чтений с запасным значением
+FALLBACK_CACHE_SIZE = 10000
+
+# Пул соединений с primary: каждый вызов метода Database работает на своём соединении
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+# Сколько секунд ждать свободного соединения, прежде чем ответить "БД недоступна"
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# Серверные prepared statements для запросов Database (0 — для pgbouncer в режиме transaction pooling)
+DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "1") == "1"
+
+# Применять миграции при запуске процесса (main.py); иначе: python database.py migrate
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+# Ключ advisory lock, чтобы реплики не применяли миграции одновременно
+MIGRATION_LOCK_KEY = 0x67646d67  # "gdmg"
+
+# Версионированные миграции схемы: (версия, описание, [SQL]).
+# Применённые версии хранятся в schema_migrations; все операторы идемпотентны,
+# поэтому миграции безопасно применять и к базе, созданной до их появления.
+# Новые изменения схемы — только новой миграцией в конце списка.
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone_number TEXT,
+            customer_code TEXT NOT NULL,
+            balance NUMERIC(12, 2) NOT NULL DEFAULT 0,
+            is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+            registration_date TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS track_codes (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users (id),
+            track_code TEXT NOT NULL UNIQUE,
+            description TEXT,
+            status TEXT NOT NULL DEFAULT 'В обработке',
+            price NUMERIC(12, 2) DEFAULT 0,
+            created_date TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS exchange_rates (
+            id SERIAL PRIMARY KEY,
+            currency_code TEXT NOT NULL UNIQUE,
+            name TEXT,
+            flag TEXT,
+            rate NUMERIC(18, 6) NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS delivery_methods (
+            id SERIAL PRIMARY KEY,
+            method_code TEXT NOT NULL UNIQUE,
+            method_name TEXT,
+            type TEXT,
+            icon TEXT,
+            price_per_kg NUMERIC(10, 2),
+            min_days INTEGER,
+            max_days INTEGER,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (2, "exchange rate history", [
+        # История курсов: только INSERT, строки никогда не изменяются
+        """
+        CREATE TABLE IF NOT EXISTS exchange_rate_history (
+            id BIGSERIAL PRIMARY KEY,
+            currency_code TEXT NOT NULL,
+            rate NUMERIC(18, 6) NOT NULL,
+            valid_from TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        # BRIN по времени — компактный индекс для диапазонных отчётов (строки идут по порядку вставки)
+        """
+        CREATE INDEX IF NOT EXISTS exchange_rate_history_valid_from_brin
+        ON exchange_rate_history USING BRIN (valid_from)
+        """,
+        # B-tree для "курс на момент T" с LIMIT 1 (в миграции 11 заменён индексом, покрывающим и id)
+        """
+        CREATE INDEX IF NOT EXISTS exchange_rate_history_currency_valid_from_idx
+        ON exchange_rate_history (currency_code, valid_from DESC) INCLUDE (rate)
+        """,
+        # Начальная точка истории для валют, у которых её ещё нет
+        """
+        INSERT INTO exchange_rate_history (currency_code, rate, valid_from)
+        SELECT er.currency_code, er.rate, COALESCE(er.updated_at, NOW())
+        FROM exchange_rates er
+        WHERE NOT EXISTS (
+            SELECT 1 FROM exchange_rate_history h WHERE h.currency_code = er.currency_code
+        )
+        """,
+        # Версия курса, действовавшая на момент создания заказа
+        """
+        ALTER TABLE track_codes
+        ADD COLUMN IF NOT EXISTS exchange_rate_id BIGINT REFERENCES exchange_rate_history (id)
+        """,
+    ]),
+    (3, "balance ledger", [
+        # Журнал операций с балансом; idempotency_key защищает от повторного зачисления
+        """
+        CREATE TABLE IF NOT EXISTS balance_transactions (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            amount NUMERIC(12, 2) NOT NULL,
+            reason TEXT,
+            idempotency_key TEXT UNIQUE,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS balance_transactions_user_created_idx
+        ON balance_transactions (user_id, created_at DESC)
+        """,
+    ]),
+    (4, "unique customer codes", [
+        # Суффиксы для совпадающих кодов (GD-AB1234 -> GD-AB1234<n>)
+        "CREATE SEQUENCE IF NOT EXISTS customer_code_suffix_seq",
+        # Прежняя регистрация (проверка, затем INSERT) могла создать дубликаты, и без их разбора
+        # уникальные индексы ниже не построить. Лишние строки одного telegram_id сливаются в самую
+        # раннюю: заказы и операции переносятся на неё. Баланс не суммируется — прежний
+        # update_balance начислял сразу во все строки с этим telegram_id.
+        """
+        DO $$
+        DECLARE
+            dup RECORD;
+        BEGIN
+            FOR dup IN
+                SELECT id, telegram_id, customer_code, keep_id
+                FROM (
+                    SELECT id, telegram_id, customer_code,
+                           first_value(id) OVER (PARTITION BY telegram_id ORDER BY id) AS keep_id
+                    FROM users
+                ) u
+                WHERE id <> keep_id
+            LOOP
+                UPDATE track_codes SET user_id = dup.keep_id WHERE user_id = dup.id;
+                UPDATE balance_transactions SET user_id = dup.keep_id WHERE user_id = dup.id;
+                DELETE FROM users WHERE id = dup.id;
+                RAISE WARNING 'telegram_id %: duplicate user % (code %) merged into user %',
+                    dup.telegram_id, dup.id, dup.customer_code, dup.keep_id;
+            END LOOP;
+        END $$
+        """,
+        # Один код у разных клиентов (случайный суффикс прежнего генератора мог совпасть):
+        # самый ранний клиент сохраняет код, остальные получают суффикс из последовательности
+        """
+        DO $$
+        DECLARE
+            dup RECORD;
+            new_code TEXT;
+        BEGIN
+            FOR dup IN
+                SELECT id, telegram_id, customer_code
+                FROM (
+                    SELECT id, telegram_id, customer_code,
+                           row_number() OVER (PARTITION BY customer_code ORDER BY id) AS n
+                    FROM users
+                ) u
+                WHERE n > 1
+                ORDER BY id
+            LOOP
+                LOOP
+                    new_code := dup.customer_code || nextval('customer_code_suffix_seq');
+                    EXIT WHEN NOT EXISTS (SELECT 1 FROM users WHERE customer_code = new_code);
+                END LOOP;
+                UPDATE users SET customer_code = new_code WHERE id = dup.id;
+                RAISE WARNING 'telegram_id %: customer code % is taken, changed to %',
+                    dup.telegram_id, dup.customer_code, new_code;
+            END LOOP;
+        END $$
+        """,
+        # Регистрация идёт через ON CONFLICT (telegram_id), а уникальность кода клиента гарантирует база
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id_uidx ON users (telegram_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_customer_code_uidx ON users (customer_code)",
+    ]),
+    (5, "track code search", [
+        # Поиск по трек-кодам: точное совпадение и префикс — B-tree, опечатки — триграммы
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        """
+        CREATE INDEX IF NOT EXISTS track_codes_track_key_idx
+        ON track_codes ((regexp_replace(upper(track_code), '[^A-Z0-9]', '', 'g')) text_pattern_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS track_codes_track_key_trgm_idx
+        ON track_codes USING GIN ((regexp_replace(upper(track_code), '[^A-Z0-9]', '', 'g')) gin_trgm_ops)
+        """,
+    ]),
+    (6, "indexes for hot queries", [
+        # get_user_track_codes / get_user_orders / счётчики заказов: WHERE user_id ORDER BY created_date DESC
+        """
+        CREATE INDEX IF NOT EXISTS track_codes_user_created_idx
+        ON track_codes (user_id, created_date DESC)
+        """,
+        # get_recent_orders: ORDER BY created_date DESC LIMIT n
+        "CREATE INDEX IF NOT EXISTS track_codes_created_idx ON track_codes (created_date DESC)",
+        # Статистика и сегменты по статусу
+        "CREATE INDEX IF NOT EXISTS track_codes_status_idx ON track_codes (status)",
+        # get_all_users: ORDER BY registration_date DESC; подсчёт админов — маленький частичный индекс
+        "CREATE INDEX IF NOT EXISTS users_registration_date_idx ON users (registration_date DESC)",
+        "CREATE INDEX IF NOT EXISTS users_admins_idx ON users (telegram_id) WHERE is_admin",
+        # Уникальность трек-кода (add_track_code полагается на IntegrityError), если её ещё нет
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1
+                FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = 'track_codes'::regclass
+                  AND i.indisunique AND i.indnatts = 1 AND a.attname = 'track_code'
+            ) THEN
+                CREATE UNIQUE INDEX track_codes_track_code_uidx ON track_codes (track_code);
+            END IF;
+        END $$
+        """,
+    ]),
+    (7, "order delivery method and audience segments", [
+        # Способ доставки заказа — для сегментов рассылки по типу доставки
+        """
+        ALTER TABLE track_codes
+        ADD COLUMN IF NOT EXISTS delivery_method TEXT REFERENCES delivery_methods (method_code)
+        """,
+        # Сегменты: EXISTS по статусу заказов пользователя и диапазон баланса
+        "CREATE INDEX IF NOT EXISTS track_codes_user_status_idx ON track_codes (user_id, status)",
+        "CREATE INDEX IF NOT EXISTS users_balance_idx ON users (balance)",
+    ]),
+    (8, "track attachments", [
+        # Фото- и видеоотчёты склада: храним только file_id Telegram, сами файлы лежат у Telegram
+        """
+        CREATE TABLE IF NOT EXISTS track_attachments (
+            id SERIAL PRIMARY KEY,
+            track_code_id INTEGER NOT NULL REFERENCES track_codes (id) ON DELETE CASCADE,
+            kind TEXT NOT NULL CHECK (kind IN ('photo', 'video')),
+            file_id TEXT NOT NULL,
+            file_unique_id TEXT NOT NULL,
+            uploaded_by BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            UNIQUE (track_code_id, file_unique_id)
+        )
+        """,
+    ]),
+    (9, "containers", [
+        # Контейнер (отправка), в который собран заказ: по нему печатаются этикетки пачкой
+        "ALTER TABLE track_codes ADD COLUMN IF NOT EXISTS container_code TEXT",
+        "CREATE INDEX IF NOT EXISTS track_codes_container_idx ON track_codes (container_code) WHERE container_code IS NOT NULL",
+    ]),
+    (10, "customer search", [
+        # Поиск клиентов поддержкой: фрагмент телефона, имя с опечатками, префикс кода клиента
+        """
+        CREATE INDEX IF NOT EXISTS users_phone_digits_trgm_idx
+        ON users USING GIN ((regexp_replace(coalesce(phone_number, ''), '[^0-9]', '', 'g')) gin_trgm_ops)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS users_search_name_trgm_idx
+        ON users USING GIN ((lower(coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(username, ''))) gin_trgm_ops)
+        """,
+        "CREATE INDEX IF NOT EXISTS users_customer_code_prefix_idx ON users (customer_code text_pattern_ops)",
+    ]),
+    (11, "exchange rate lookup covers version id", [
+        # get_exchange_rate_at возвращает и id версии (его закрепляют заказы): без id в индексе
+        # каждый поиск "курс на момент T" ходит в таблицу, а не обходится index-only scan
+        """
+        CREATE INDEX IF NOT EXISTS exchange_rate_history_currency_valid_from_id_idx
+        ON exchange_rate_history (currency_code, valid_from DESC) INCLUDE (rate, id)
+        """,
+        "DROP INDEX IF EXISTS exchange_rate_history_currency_valid_from_idx",
+    ]),
+    (12, "per-user idempotency keys", [
+        # Ключ идемпотентности уникален в пределах пользователя: один и тот же ключ клиента
+        # (номер платежа в его системе, update_id) у разных пользователей не должен совпадать
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS balance_transactions_user_idempotency_uidx
+        ON balance_transactions (user_id, idempotency_key)
+        """,
+        "ALTER TABLE balance_transactions DROP CONSTRAINT IF EXISTS balance_transactions_idempotency_key_key",
+    ]),
+]
+
+# Данные заказа для счёта и этикетки; version меняется при любом изменении заказа
+ORDER_DOCUMENT_SQL = """
+    SELECT tc.id, tc.track_code, tc.description, tc.status, COALESCE(tc.price, 0) AS price,
+           tc.created_date, tc.updated_at AS version, tc.container_code,
+           dm.method_name AS delivery_method, u.customer_code, u.first_name, u.last_name, u.phone_number,
+           h.currency_code, h.rate AS exchange_rate, tc.price * h.rate AS price_rub
+    FROM track_codes tc
+    LEFT JOIN users u ON tc.user_id = u.id
+    LEFT JOIN exchange_rate_history h ON h.id = tc.exchange_rate_id
+    LEFT JOIN delivery_methods dm ON dm.method_code = tc.delivery_method
+"""
+
+
+def _like_prefix(text):
+    """Префикс для LIKE: спецсимволы шаблона в тексте экранируются"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def compile_user_search(query):
+    """Разбирает строку поиска клиента в (условие WHERE, выражение ранга, параметры) или None.
+
+    Строка из цифр и символов телефона ищется как фрагмент номера (8 и +7 в начале
+    не важны) и как telegram_id; любая другая — как префикс кода клиента и как
+    имя, фамилия или username с опечатками (word_similarity по триграммам).
+    """
+    text = query.strip()
+    digits = re.sub(r'\D', '', text)
+    if digits and not re.search(r'[^\d\s()+\-]', text):
+        if len(digits) == 11 and digits[0] in '78':
+            digits = digits[1:]
+        if len(digits) < USER_SEARCH_MIN_LENGTH:
+            return None
+        params = {'phone': '%' + digits + '%', 'phone_suffix': '%' + digits, 'telegram_id': int(digits[:18])}
+        where = f"u.telegram_id = %(telegram_id)s OR {PHONE_KEY_SQL} LIKE %(phone)s"
+        rank = f"CASE WHEN u.telegram_id = %(telegram_id)s THEN 2 WHEN {PHONE_KEY_SQL} LIKE %(phone_suffix)s THEN 1 ELSE 0 END"
+        return where, rank, params
+    if len(text) < USER_SEARCH_MIN_LENGTH:
+        return None
+    name = text.lower()
+    params = {'code': _like_prefix(text.upper()), 'name': name, 'name_like': '%' + _like_prefix(name)}
+    where = (f"u.customer_code LIKE %(code)s OR {NAME_KEY_SQL} %%> %(name)s "
+             f"OR {NAME_KEY_SQL} LIKE %(name_like)s")
+    rank = f"CASE WHEN u.customer_code LIKE %(code)s THEN 2 ELSE word_similarity(%(name)s, {NAME_KEY_SQL}) END"
+    return where, rank, params
+
+
+def normalize_track_code(track_code):
+    """Приводит трек-код к ключу поиска (см. TRACK_KEY_SQL)"""
+    return re.sub(r'[^A-Z0-9]', '', (track_code or '').upper())
+
+
+# ------------------------- ТАЙМАУТЫ И ПРЕДОХРАНИТЕЛЬ -------------------------
+class DatabaseUnavailable(Exception):
+    """БД недоступна (предохранитель разомкнут), а запасного значения нет"""
+
+
+class IdempotencyConflict(Exception):
+    """Ключ идемпотентности уже использован для операции с другой суммой"""
+
+    def __init__(self, keys):
+        self.keys = keys
+        super().__init__(f"Idempotency key reused with a different amount: {', '.join(keys)}")
+
+
+breaker = CircuitBreaker(DB_BREAKER_THRESHOLD, DB_BREAKER_RESET_SECONDS)
+# Состояние текущего вызова метода Database в этом потоке: таймаут, глубина вложенности, была ли ошибка БД
+_query_context = threading.local()
+
+
+class _DatabaseCursor(RealDictCursor):
+    """Курсор основного соединения и реплики.
+    Добавляет к запросу SET LOCAL statement_timeout класса текущего метода (в том же
+    обращении к серверу) и сообщает предохранителю об успехах и ошибках соединения.
+    Предохранитель следит только за primary: при сбое реплики чтения и так уходят на primary."""
+
+    def execute(self, query, vars=None):
+        timeout = getattr(_query_context, 'timeout', None)
+        if timeout is not None:
+            query = f"SET LOCAL statement_timeout = {timeout}; {query}"
+        watched = getattr(self.connection, 'watched_by_breaker', False)
+        try:
+            result = super().execute(query, vars)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Обрыв соединения или таймаут (QueryCanceled — подкласс OperationalError)
+            _query_context.failed = True
+            if watched:
+                breaker.record_failure()
+            elif self.connection.replica and self.connection.closed:
+                # Соединение с репликой оборвалось — db_call повторит чтение на primary
+                _query_context.replica_lost = True
+            raise
+        if watched:
+            breaker.record_success()
+        with _query_stats_lock:
+            _query_stats['executed'] += 1
+        return result
+
+
+# Счётчик запросов, отправленных на сервер основным курсором (для метрик и бенчмарков)
+_query_stats = {'executed': 0}
+_query_stats_lock = threading.Lock()
+
+
+class _FlightCall:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Объединяет одновременные одинаковые вызовы (single-flight).
+
+    Первый вызов с ключом выполняет функцию, а вызовы с тем же ключом, пришедшие
+    до его завершения, ждут и получают тот же результат или то же исключение.
+    Результат общий для всех ожидающих — изменять его нельзя.
+    do() — для потоков; do_async() — для корутин: общий вызов идёт отдельной
+    задачей, поэтому отмена любого ожидающего (и первого тоже) не отменяет его для остальных.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self.executed += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key, fn):
+        """Как do(), но fn (синхронная) выполняется в пуле потоков и не блокирует цикл событий"""
+        key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(fn))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._flight_done(key, done))
+            self.executed += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _flight_done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Если все ожидающие отменены, исключение иначе попадёт в лог как "never retrieved"
+            task.exception()
+
+    def stats(self):
+        return {'executed': self.executed, 'shared': self.shared}
+
+
+single_flight = SingleFlight()
+_MISSING = object()
+
+
+def db_call(kind, fallback=False, coalesce=False):
+    """Декоратор методов Database.
+
+    kind — класс запроса из QUERY_TIMEOUTS, задаёт statement_timeout. Внешний вызов
+    проходит через предохранитель: пока он разомкнут, метод не обращается к БД.
+    Для fallback=True последний удачный результат запоминается по аргументам и
+    возвращается, если БД недоступна; без запасного значения — DatabaseUnavailable.
+    coalesce=True: одновременные вызовы с одинаковыми аргументами из разных потоков
+    выполняют один запрос (SingleFlight) и получают общий результат. Как и запасное значение,
+    он общий для всех получателей: строки результата не изменяются, а копируются.
+    """
+    timeout = QUERY_TIMEOUTS[kind]
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (method.__name__, args, tuple(sorted(kwargs.items()))) if fallback else None
+            depth = getattr(_query_context, 'depth', 0)
+            # Вложенные вызовы (add_track_code -> get_user) уже пропущены внешним
+            if depth == 0 and not breaker.allow():
+                cached = self._fallback_get(key) if fallback else _MISSING
+                if cached is _MISSING:
+                    raise DatabaseUnavailable(f"{method.__name__}: database is unavailable")
+                return cached
+            if depth == 0 and coalesce and self.coalesce_reads:
+                flight_key = (id(self), method.__name__, args, tuple(sorted(kwargs.items())))
+                return single_flight.do(flight_key, lambda: call(self, args, kwargs, key))
+            return call(self, args, kwargs, key)
+
+        def call(self, args, kwargs, key):
+            depth = getattr(_query_context, 'depth', 0)
+            outer_timeout = getattr(_query_context, 'timeout', None)
+            outer_failed = getattr(_query_context, 'failed', False)
+            # Соединение из пула берётся при первом обращении к self.conn и возвращается внешним вызовом
+            owns_conn = depth == 0 and getattr(_query_context, 'conn', None) is None
+            _query_context.depth, _query_context.timeout, _query_context.failed = depth + 1, timeout, False
+            if owns_conn:
+                _query_context.replica_lost = False
+            try:
+                try:
+                    result = method(self, *args, **kwargs)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    if not (owns_conn and _query_context.replica_lost):
+                        raise
+                if owns_conn and _query_context.replica_lost:
+                    # Реплика оборвала соединение посреди чтения: чтение повторяется на primary
+                    self._replica_failed("connection lost")
+                    self._release_replica()
+                    _query_context.failed = False
+                    result = method(self, *args, **kwargs)
+                failed = _query_context.failed
+            finally:
+                _query_context.failed = outer_failed or _query_context.failed
+                _query_context.depth, _query_context.timeout = depth, outer_timeout
+                if owns_conn:
+                    self._release_conn()
+            if fallback:
+                if not failed:
+                    self._fallback_set(key, result)
+                else:
+                    # Метод проглотил ошибку БД и вернул пустое значение — лучше отдать последнее известное
+                    cached = self._fallback_get(key)
+                    if cached is not _MISSING:
+                        return cached
+            return result
+        return wrapper
+    return decorator
+
+
+# ------------------------- PREPARED STATEMENTS -------------------------
+_PLACEHOLDER_RE = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+def _to_server_placeholders(query):
+    """Переводит плейсхолдеры psycopg2 (%s или %(name)s) в $1, $2... для PREPARE.
+    Возвращает (текст, порядок параметров): число позиционных или список имён."""
+    names = []
+    positional = 0
+
+    def replace(match):
+        nonlocal positional
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+        positional += 1
+        return f"${positional}"
+
+    text = _PLACEHOLDER_RE.sub(replace, query)
+    return text, (names or positional)
+
+
+class _PreparingConnection(psycopg2.extensions.connection):
+    """Соединение, которое помнит, какие запросы реестра на нём уже подготовлены.
+    Prepared statements живут в сессии Postgres, поэтому и учёт ведётся на соединении:
+    после обрыва или замены соединения новый объект начинает с пустого набора."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.prepare_lock = threading.Lock()
+        # Ошибки на этом соединении учитывает предохранитель БД (только primary)
+        self.watched_by_breaker = False
+        self.replica = False
+
+
+class ConnectionPool:
+    """Пул соединений с primary (или с репликой при readonly=True).
+
+    Каждый внешний вызов метода Database берёт своё соединение и возвращает его по
+    завершении, поэтому у потоков нет общей транзакции: откат, ошибка или
+    SET LOCAL одного вызова не задевают чужие записи. Свободные соединения
+    переиспользуются вместе с подготовленными на них statements; незавершённая
+    транзакция при возврате откатывается, оборванные соединения выбрасываются.
+    Если все size соединений заняты, вызов ждёт до timeout секунд.
+    Соединения readonly-пула работают в autocommit и только на чтение: открытые
+    транзакции на реплике мешают применению WAL. Их ошибки не считает предохранитель.
+    """
+
+    def __init__(self, dsn, size, timeout, readonly=False):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.readonly = readonly
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise DatabaseUnavailable(f"No free database connection in {timeout:g}s")
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None or conn.closed:
+                conn = psycopg2.connect(self.dsn, connection_factory=_PreparingConnection, cursor_factory=_DatabaseCursor)
+                if self.readonly:
+                    conn.set_session(readonly=True, autocommit=True)
+                    conn.replica = True
+                else:
+                    conn.watched_by_breaker = True
+                with self._lock:
+                    self.opened += 1
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            if not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+        finally:
+            if not conn.closed:
+                with self._lock:
+                    self._idle.append(conn)
+            self._slots.release()
+
+    def close(self):
+        """Закрывает свободные соединения (занятые вернутся в пул и будут переиспользованы)"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'opened': self.opened}
+
+
+class StatementRegistry:
+    """Реестр запросов Database для серверных PREPARE.
+
+    Запрос регистрируется по имени при первом вызове и на каждом соединении
+    готовится один раз (PREPARE), дальше выполняется через EXECUTE без повторного
+    разбора и планирования. Если сервер потерял statement (DISCARD ALL, пулер,
+    смена схемы под SELECT *), транзакция откатывается и запрос готовится заново.
+    Вызывать только там, где в текущей транзакции нет незафиксированных записей.
+    """
+
+    def __init__(self):
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, query):
+        with self._lock:
+            entry = self._statements.get(name)
+            if entry is None:
+                entry = self._statements[name] = (query, *_to_server_placeholders(query))
+        if entry[0] != query:
+            raise ValueError(f"Statement {name} is already registered with different SQL")
+        return entry[1], entry[2]
+
+    def execute(self, cur, name, query, params=()):
+        conn = cur.connection
+        text, order = self._get(name, query)
+        values = [params[key] for key in order] if isinstance(order, list) else list(params)
+        statement = f"EXECUTE {name}"
+        if values:
+            statement += f" ({', '.join(['%s'] * len(values))})"
+        for attempt in range(2):
+            try:
+                with conn.prepare_lock:
+                    if name not in conn.prepared:
+                        cur.execute(f"PREPARE {name} AS {text}")
+                        conn.prepared.add(name)
+                cur.execute(statement, values)
+                return
+            except (psycopg2.errors.InvalidSqlStatementName,
+                    psycopg2.errors.DuplicatePreparedStatement,
+                    psycopg2.errors.FeatureNotSupported) as e:
+                # FeatureNotSupported здесь — "cached plan must not change result type" после ALTER TABLE
+                stale = not isinstance(e, psycopg2.errors.FeatureNotSupported) or 'cached plan' in str(e)
+                if attempt or not stale:
+                    raise
+                conn.rollback()
+                with conn.prepare_lock:
+                    cur.execute("DEALLOCATE ALL")
+                    conn.prepared.clear()
+
+
+statements = StatementRegistry()
+
+
+# ------------------------- ПРОВЕРКА ПЛАНОВ ЗАПРОСОВ -------------------------
+# Таблицы, где полный просмотр недопустим: на них растут данные
+LARGE_TABLES = {'users', 'track_codes', 'balance_transactions', 'exchange_rate_history'}
+# Методы, которые по смыслу читают всю таблицу: метод -> почему это допустимо
+FULL_SCAN_METHODS = {
+    'get_all_users': "список всех клиентов для админки",
+    'get_statistics': "общие счётчики по таблицам",
+    'export_rows': "выгрузка всей таблицы серверным курсором на отдельном соединении",
+    'get_exchange_rates': "справочник валют из десятка строк",
+    'get_exchange_rates_brief': "справочник валют из десятка строк",
+    'get_exchange_rates_version': "хэш всего справочника валют",
+    'get_delivery_methods': "справочник способов доставки из десятка строк",
+}
+# Методы из FULL_SCAN_METHODS, которые check_query_plans не вызывает
+UNCHECKED_METHODS = {'export_rows'}
+
+
+class _PlanCheckConnection(psycopg2.extensions.connection):
+    """Соединение для check_query_plans: commit/rollback методов Database игнорируются,
+    чтобы тестовые данные жили до конца проверки и были откачены одной транзакцией."""
+    plans = None
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class _PlanCheckCursor(RealDictCursor):
+    """Перед каждым SELECT выполняет EXPLAIN ANALYZE и сохраняет план в соединении.
+    SET LOCAL перед SELECT (в том же запросе) применяется до EXPLAIN — в той же транзакции."""
+
+    def execute(self, query, vars=None):
+        settings, select = re.match(r"((?:\s*SET LOCAL [^;]*;)*)(.*)", query, re.S).groups()
+        if self.connection.plans is not None and select.lstrip().upper().startswith(("SELECT", "WITH")):
+            if settings:
+                super().execute(settings)
+            super().execute("EXPLAIN (ANALYZE, FORMAT JSON) " + select, vars)
+            self.connection.plans.append(self.fetchone()['QUERY PLAN'][0])
+        return super().execute(query, vars)
+
+
+def _plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+class LeaderLease:
+    """Аренда лидерства для фоновых задач, которые должны выполняться в одном экземпляре.
+
+    Держится сессионным advisory lock на отдельном соединении: пока соединение живо,
+    другие реплики не могут захватить ту же аренду. Если процесс-держатель падает,
+    соединение закрывается и блокировка снимается сразу; если пропадает хост —
+    через TCP keepalive за несколько секунд.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._conn = None
+
+    def try_acquire(self):
+        """Пытается захватить аренду без ожидания. Возвращает True, если она наша."""
+        if self.is_held():
+            return True
+        self._close()
+        keepalive_options = (
+            f"-c tcp_keepalives_idle={LEASE_KEEPALIVE_IDLE} "
+            f"-c tcp_keepalives_interval={LEASE_KEEPALIVE_INTERVAL} "
+            f"-c tcp_keepalives_count={LEASE_KEEPALIVE_COUNT}"
+        )
+        conn = psycopg2.connect(
+            DATABASE_URL,
+            application_name=f"lease:{self.name}",
+            keepalives=1,
+            keepalives_idle=LEASE_KEEPALIVE_IDLE,
+            keepalives_interval=LEASE_KEEPALIVE_INTERVAL,
+            keepalives_count=LEASE_KEEPALIVE_COUNT,
+            options=keepalive_options
+        )
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s))", (LEASE_LOCK_CLASS, self.name))
+                acquired = cur.fetchone()[0]
+        except Exception:
+            conn.close()
+            raise
+        if not acquired:
+            conn.close()
+            return False
+        self._conn = conn
+        return True
+
+    def is_held(self):
+        """Проверяет, что соединение с блокировкой живо (заодно служит heartbeat)"""
+        if self._conn is None or self._conn.closed:
+            return False
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except Exception as e:
+            print(f"Lease {self.name} lost: {e}")
+            self._close()
+            return False
+
+    def release(self):
+        """Освобождает аренду (закрытие соединения снимает блокировку)"""
+        self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
 
 class Database:
     def __init__(self):
-        self.conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+        # Пул создаётся при первом запросе, а не при импорте модуля
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._change_listeners = []
+        self._listener_thread = None
+        self.notify_changes = DB_CHANGE_NOTIFY
+        self.use_prepared = DB_PREPARED_STATEMENTS
+        # Реплика и read-your-writes: telegram_id / тема изменений -> до какого момента читать с primary
+        self.use_replica = bool(DATABASE_REPLICA_URL)
+        self._replica_pool = None
+        self._replica_lock = threading.Lock()
+        self._replica_lag = None
+        self._replica_lag_checked = 0.0
+        self._replica_down_until = 0.0
+        self._sticky_users = {}
+        self._sticky_topics = {}
+        self.read_routing = {'replica': 0, 'primary': 0}
+        # Объединять одновременные одинаковые чтения (см. db_call, read_async)
+        self.coalesce_reads = True
+        # Последние удачные ответы чтений с fallback (см. db_call)
+        self._fallback = OrderedDict()
+        self._fallback_lock = threading.Lock()
+
+    @property
+    def conn(self):
+        """Соединение с primary текущего вызова метода Database (или блока connection()).
+        Берётся из пула при первом обращении и принадлежит только этому вызову."""
+        conn = getattr(_query_context, 'conn', None)
+        if conn is None:
+            if not getattr(_query_context, 'depth', 0):
+                raise RuntimeError("Database.conn is available only inside a Database method or db.connection()")
+            conn = _query_context.conn = self._checkout()
+        return conn
+
+    def _checkout(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(DATABASE_URL, DB_POOL_SIZE, DB_POOL_TIMEOUT)
+        try:
+            return self._pool.getconn()
+        except psycopg2.OperationalError:
+            _query_context.failed = True
+            breaker.record_failure()
+            raise
+
+    def _release_conn(self):
+        conn = getattr(_query_context, 'conn', None)
+        if conn is not None:
+            _query_context.conn = None
+            self._pool.putconn(conn)
+        self._release_replica()
+
+    def _release_replica(self):
+        conn = getattr(_query_context, 'replica_conn', None)
+        if conn is not None:
+            _query_context.replica_conn = None
+            self._replica_pool.putconn(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Соединение с primary из пула на время блока — для кода вне методов Database
+        (миграции, утилиты). Методы Database, вызванные внутри блока, работают на нём же."""
+        conn = getattr(_query_context, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        _query_context.conn = self._checkout()
+        try:
+            yield _query_context.conn
+        finally:
+            self._release_conn()
+
+    def close(self):
+        """Закрывает свободные соединения пулов (например, перед запуском дочерних процессов)"""
+        if self._pool is not None:
+            self._pool.close()
+        if self._replica_pool is not None:
+            self._replica_pool.close()
+
+    # ------------------------- ЗАПАСНЫЕ ЗНАЧЕНИЯ -------------------------
+    def _fallback_get(self, key):
+        with self._fallback_lock:
+            return self._fallback.get(key, _MISSING)
+
+    def _fallback_set(self, key, value):
+        with self._fallback_lock:
+            self._fallback[key] = value
+            self._fallback.move_to_end(key)
+            while len(self._fallback) > FALLBACK_CACHE_SIZE:
+                self._fallback.popitem(last=False)
+
+    def health(self):
+        """Состояние предохранителя БД для /health и /metrics"""
+        return breaker.stats()
+
+    def query_stats(self):
+        """Сколько запросов ушло на сервер, сколько вызовов получили чужой результат и состояние пула"""
+        pool = self._pool.stats() if self._pool is not None else {'size': DB_POOL_SIZE, 'idle': 0, 'opened': 0}
+        return {'queries': _query_stats['executed'], **single_flight.stats(), 'pool': pool}
+
+    async def read_async(self, method, *args):
+        """Вызывает метод чтения method в пуле потоков, не блокируя цикл событий.
+        Каждый вызов работает на своём соединении из пула (см. ConnectionPool).
+        Одинаковые одновременные вызовы из корутин объединяются в один и получают одни и те же
+        объекты строк — результат только для чтения: нужна изменённая копия — dict(row)."""
+        fn = functools.partial(getattr(self, method), *args)
+        if not self.coalesce_reads:
+            return await asyncio.to_thread(fn)
+        # Ключ как в db_call: у разных экземпляров Database (проверки, бенчмарки) свои результаты
+        return await single_flight.do_async((id(self), method, args), fn)
+
+    # ------------------------- РЕПЛИКА ДЛЯ ЧТЕНИЯ -------------------------
+    def _replica(self):
+        """Соединение с репликой текущего вызова метода Database или None, если реплика
+        не настроена, недоступна, отстаёт или все её соединения заняты.
+        Берётся из пула реплики и возвращается вместе с соединением primary (см. _release_conn)."""
+        conn = getattr(_query_context, 'replica_conn', None)
+        if conn is not None:
+            return conn
+        if not self.use_replica or time.monotonic() < self._replica_down_until:
+            return None
+        if self._replica_pool is None:
+            with self._pool_lock:
+                if self._replica_pool is None:
+                    self._replica_pool = ConnectionPool(DATABASE_REPLICA_URL, REPLICA_POOL_SIZE, 0, readonly=True)
+        try:
+            conn = self._replica_pool.getconn()
+        except DatabaseUnavailable:
+            return None
+        except psycopg2.Error as e:
+            self._replica_failed(e)
+            return None
+        try:
+            fresh = self._replica_fresh(conn)
+        except psycopg2.Error as e:
+            # Проверка не дошла до чтений метода — повторять их на primary не нужно
+            _query_context.replica_lost = False
+            conn.close()
+            self._replica_pool.putconn(conn)
+            self._replica_failed(e)
+            return None
+        if not fresh:
+            self._replica_pool.putconn(conn)
+            return None
+        _query_context.replica_conn = conn
+        return conn
+
+    def _replica_fresh(self, conn):
+        """Не отстаёт ли реплика. Отставание проверяет раз в REPLICA_LAG_CHECK_INTERVAL
+        один поток (на своём соединении), остальные берут последнее измеренное значение."""
+        now = time.monotonic()
+        if now - self._replica_lag_checked >= REPLICA_LAG_CHECK_INTERVAL and self._replica_lock.acquire(blocking=False):
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(REPLICA_LAG_SQL)
+                    lag = cur.fetchone()['lag']
+                self._replica_lag = float(lag) if lag is not None else None
+                self._replica_lag_checked = now
+            finally:
+                self._replica_lock.release()
+        return self._replica_lag is not None and self._replica_lag <= REPLICA_MAX_LAG
+
+    def _replica_failed(self, error):
+        """Реплика не отвечает: чтения REPLICA_RETRY_DELAY секунд идут на primary.
+        Закрываются только свободные соединения — занятые вернутся в пул и будут проверены заново."""
+        print(f"Replica unavailable, reading from primary: {error}")
+        self._replica_down_until = time.monotonic() + REPLICA_RETRY_DELAY
+        self._replica_lag, self._replica_lag_checked = None, 0.0
+        self._replica_pool.close()
+
+    def _replica_ready(self):
+        """Можно ли сейчас читать с реплики — для кода со своим соединением (выгрузки, рассылки)"""
+        if getattr(_query_context, 'replica_conn', None) is not None:
+            return True
+        ready = self._replica() is not None
+        self._release_replica()
+        return ready
+
+    def _read_conn(self, telegram_id=None, topic=None):
+        """Соединение для метода только на чтение: реплика, если она свежая и читаемые
+        данные недавно не менялись (запись пользователя telegram_id или темы topic), иначе primary"""
+        now = time.monotonic()
+        sticky = now < self._sticky_topics.get('reset', 0)
+        if telegram_id is not None:
+            sticky = sticky or now < self._sticky_users.get(telegram_id, 0)
+        if topic is not None:
+            sticky = sticky or now < self._sticky_topics.get(topic, 0)
+        conn = None if sticky else self._replica()
+        self.read_routing['replica' if conn else 'primary'] += 1
+        return conn or self.conn
+
+    def _mark_written(self, topic, key=None):
+        """Запоминает запись, чтобы следующие чтения этих данных шли на primary"""
+        if not self.use_replica:
+            return
+        until = time.monotonic() + REPLICA_STICKY_SECONDS
+        if key is not None and topic in ('user', 'orders'):
+            if len(self._sticky_users) > 10000:
+                now = time.monotonic()
+                self._sticky_users = {k: v for k, v in self._sticky_users.items() if v > now}
+            self._sticky_users[key] = until
+        else:
+            self._sticky_topics[topic] = until
+
+    def replica_status(self):
+        """Состояние реплики для метрик"""
+        return {
+            'configured': bool(DATABASE_REPLICA_URL),
+            'enabled': self.use_replica,
+            'lag': self._replica_lag,
+            'down_for': max(0.0, self._replica_down_until - time.monotonic()),
+            'reads': dict(self.read_routing),
+            'pool': self._replica_pool.stats() if self._replica_pool is not None else None,
+        }
+
+    # ------------------------- МИГРАЦИИ -------------------------
+    def migrate(self):
+        """Применяет недостающие миграции из MIGRATIONS, каждую в своей транзакции.
+        Возвращает список применённых версий.
+        Вызывается явно при запуске, а не из методов Database: построение индексов на
+        больших таблицах не должно попадать под statement_timeout запроса."""
+        applied = []
+        outer_timeout, _query_context.timeout = getattr(_query_context, 'timeout', None), None
+        with self.connection() as conn:
+            # Без ограничения в 50 сообщений, как у стандартного списка psycopg2
+            saved_notices, conn.notices = conn.notices, deque()
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_migrations (
+                            version INTEGER PRIMARY KEY,
+                            name TEXT NOT NULL,
+                            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                        )
+                    """)
+                    self.conn.commit()
+                    conn.notices.clear()
+                    for version, name, statements in MIGRATIONS:
+                        # Блокировка до конца транзакции: параллельная реплика дождётся и увидит версию применённой
+                        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+                        cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+                        if cur.fetchone():
+                            self.conn.commit()
+                            continue
+                        # Без NOTICE вида "already exists, skipping" от IF NOT EXISTS
+                        cur.execute("SET LOCAL client_min_messages = warning")
+                        for statement in statements:
+                            cur.execute(statement)
+                            # RAISE WARNING миграций (например, об изменённых кодах клиентов) — в лог
+                            while conn.notices:
+                                print(f"Migration {version}: {conn.notices.popleft().strip()}")
+                        cur.execute(
+                            "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                            (version, name)
+                        )
+                        self.conn.commit()
+                        applied.append(version)
+                        print(f"Migration {version} applied: {name}")
+                return applied
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error in migrate: {e}")
+                raise e
+            finally:
+                _query_context.timeout = outer_timeout
+                conn.notices = saved_notices
+
+    def get_migration_status(self):
+        """Возвращает [(версия, описание, время применения или None)] по всем миграциям"""
+        with self.connection():
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("SELECT to_regclass('schema_migrations') AS t")
+                    done = {}
+                    if cur.fetchone()['t']:
+                        cur.execute("SELECT version, applied_at FROM schema_migrations")
+                        done = {row['version']: row['applied_at'] for row in cur.fetchall()}
+                    return [(version, name, done.get(version)) for version, name, _ in MIGRATIONS]
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error in get_migration_status: {e}")
+                raise e
 
     def _execute_query(self, query, params=None, fetchone=False, fetchall=False):
         """Вспомогательный метод для выполнения запросов с обработкой ошибок"""
+        with self.connection():
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute(query, params or ())
+                    if fetchone:
+                        return cur.fetchone()
+                    if fetchall:
+                        return cur.fetchall()
+                    self.conn.commit()
+                    return None
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Database error: {e}")
+                raise e
+
+    def _execute(self, cur, name, query, params=()):
+        """Выполняет запрос через реестр prepared statements (или напрямую, если он выключен)"""
+        if self.use_prepared and isinstance(cur.connection, _PreparingConnection):
+            statements.execute(cur, name, query, params)
+        else:
+            cur.execute(query, params)
+
+    # ------------------------- СОБЫТИЯ ИЗМЕНЕНИЙ -------------------------
+    def add_change_listener(self, callback):
+        """Подписывает callback(topic, key, data) на изменения данных.
+        topic: 'user' и 'orders' (key = telegram_id), 'exchange_rates', 'delivery_methods' (key = None),
+        'reset' — события могли быть потеряны, подписчику стоит сбросить своё состояние.
+        data — подробности изменения (например, новый статус заказа) или None."""
+        self._change_listeners.append(callback)
+
+    def _emit_change(self, topic, key=None, data=None):
+        """Публикует изменение: через NOTIFY всем процессам или напрямую подписчикам этого процесса"""
+        self._mark_written(topic, key)
+        if self.notify_changes:
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("SELECT pg_notify(%s, %s)", (
+                        CHANGE_CHANNEL,
+                        json.dumps({'topic': topic, 'key': key, 'data': data}, default=str)
+                    ))
+                    self.conn.commit()
+                return
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error in _emit_change: {e}")
+        self._dispatch_change(topic, key, data)
+
+    def _emit_changes(self, topic, keys, data=None):
+        """Публикует изменение многих ключей одной темы одним запросом: NOTIFY на пачку ключей,
+        а не на каждый (полезная нагрузка NOTIFY ограничена 8000 байт — ключи делятся на части)"""
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self._mark_written(topic, key)
+        if self.notify_changes:
+            payloads = [
+                json.dumps({'topic': topic, 'keys': keys[i:i + CHANGE_KEYS_PER_NOTIFY], 'data': data}, default=str)
+                for i in range(0, len(keys), CHANGE_KEYS_PER_NOTIFY)
+            ]
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+                                (CHANGE_CHANNEL, payloads))
+                    self.conn.commit()
+                return
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error in _emit_changes: {e}")
+        for key in keys:
+            self._dispatch_change(topic, key, data)
+
+    def _dispatch_change(self, topic, key=None, data=None):
+        """Оповещает подписчиков процесса; ошибки подписчиков не ломают запись"""
+        # Запись могла быть сделана другим процессом — её читатели здесь тоже идут на primary
+        self._mark_written(topic, key)
+        for callback in self._change_listeners:
+            try:
+                callback(topic, key, data)
+            except Exception as e:
+                print(f"Error in change listener: {e}")
+
+    def start_change_listener(self):
+        """Запускает фоновый поток LISTEN, который доставляет события NOTIFY подписчикам процесса"""
+        if not self.notify_changes or self._listener_thread:
+            return
+        self._listener_thread = threading.Thread(
+            target=self._listen_changes, name="db-change-listener", daemon=True
+        )
+        self._listener_thread.start()
+
+    def _listen_changes(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+                # Пока соединения не было, события могли потеряться
+                self._dispatch_change('reset')
+                while True:
+                    if select.select([conn], [], [], CHANGE_LISTENER_KEEPALIVE) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        payload = json.loads(notify.payload)
+                        for key in payload['keys'] if 'keys' in payload else [payload.get('key')]:
+                            self._dispatch_change(payload['topic'], key, payload.get('data'))
+            except Exception as e:
+                print(f"Error in _listen_changes: {e}")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(CHANGE_LISTENER_RECONNECT_DELAY)
+
+    def lease(self, name):
+        """Возвращает аренду лидерства с именем name (см. LeaderLease)"""
+        return LeaderLease(name)
+
+    def check_query_plans(self, seed_users=200000):
+        """Проверяет, что читающие методы Database используют индексы.
+
+        В отдельной транзакции заполняет таблицы seed_users пользователями (по 3 заказа,
+        по записи в журнале баланса и истории курса на каждого), выполняет ANALYZE, затем
+        вызывает методы и снимает EXPLAIN ANALYZE с каждого их SELECT. В конце транзакция
+        откатывается — данные в базе не меняются. Возвращает [(метод, ok, описание)].
+        Полный просмотр допустим только у методов из FULL_SCAN_METHODS (с причиной в описании).
+        """
+        conn = psycopg2.connect(
+            DATABASE_URL, connection_factory=_PlanCheckConnection, cursor_factory=_PlanCheckCursor
+        )
+        # Методы Database в этом потоке работают на проверочном соединении, а не на пуле
+        saved_replica, _query_context.conn = self.use_replica, conn
+        self.use_replica = False
+        results = []
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(query, params or ())
-                if fetchone:
-                    return cur.fetchone()
-                if fetchall:
-                    return cur.fetchall()
-                self.conn.commit()
-                return None
-        except Exception as e:
-            self.conn.rollback()
-            print(f"Database error: {e}")
-            raise e
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO users (telegram_id, username, first_name, phone_number, customer_code, registration_date)
+                    SELECT 900000000000 + g, 'chk' || left(md5(g::text), 9), 'Check', '+7900' || lpad(g::text, 7, '0'),
+                           'GD-CHK' || g, NOW() - g * INTERVAL '1 minute'
+                    FROM generate_series(1, %(n)s) g
+                """, {'n': seed_users})
+                cur.execute("""
+                    INSERT INTO track_codes (user_id, track_code, description, status, price, created_date, container_code)
+                    SELECT u.id, 'CK' || upper(left(md5(u.id || ':' || k), 11)) || 'CN',
+                           'check', (ARRAY['В обработке', 'В пути', 'На складе', 'Доставлен'])[1 + (u.id + k) %% 4],
+                           10, NOW() - (u.telegram_id - 900000000000) * INTERVAL '1 minute' - k * INTERVAL '1 second',
+                           CASE WHEN k = 1 THEN 'CHK-' || (u.telegram_id %% 1000) END
+                    FROM users u, generate_series(1, 3) k
+                    WHERE u.telegram_id BETWEEN 900000000001 AND 900000000000 + %(n)s
+                """, {'n': seed_users})
+                cur.execute("""
+                    INSERT INTO balance_transactions (user_id, amount, reason)
+                    SELECT id, 100, 'check' FROM users WHERE telegram_id BETWEEN 900000000001 AND 900000000000 + %(n)s
+                """, {'n': seed_users})
+                cur.execute("""
+                    INSERT INTO exchange_rate_history (currency_code, rate, valid_from)
+                    SELECT 'CHK', 90 + g %% 10, NOW() - g * INTERVAL '1 minute'
+                    FROM generate_series(1, %(n)s) g
+                """, {'n': seed_users})
+                cur.execute("ANALYZE users, track_codes, balance_transactions, exchange_rate_history")
+
+                telegram_id = 900000000000 + seed_users // 2
+                # Трек-коды и имена пользователей случайные, как в жизни: у последовательных номеров
+                # почти все триграммы общие, и нечёткий поиск честно совпадал бы со всей таблицей
+                cur.execute("""
+                    SELECT tc.track_code, u.username FROM track_codes tc JOIN users u ON tc.user_id = u.id
+                    WHERE u.telegram_id = %s ORDER BY tc.id LIMIT 1
+                """, (telegram_id,))
+                probe = cur.fetchone()
+                track_code, username = probe['track_code'], probe['username']
+            now = datetime.now()
+            # Сегменты рассылок, какие собирает админ: узкие по дате регистрации, балансу и статусу заказов
+            segments = [
+                {'admins': True},
+                {'registered_after': now - timedelta(days=1)},
+                {'balance_min': 1000},
+                {'order_status': ['В пути'], 'registered_after': now - timedelta(days=7)},
+                {'has_orders': True, 'last_order_after': now - timedelta(days=1),
+                 'registered_after': now - timedelta(days=3)},
+            ]
+            checks = [
+                ('get_user', lambda: self.get_user(telegram_id)),
+                ('get_user_summary', lambda: self.get_user_summary(telegram_id)),
+                ('get_user_version', lambda: self.get_user_version(telegram_id)),
+                ('get_orders_version', lambda: self.get_orders_version(telegram_id)),
+                ('get_user_by_customer_code', lambda: self.get_user_by_customer_code(f"GD-CHK{seed_users // 2}")),
+                ('get_users_batch', lambda: self.get_users_batch([telegram_id, telegram_id + 1])),
+                ('get_user_track_codes', lambda: self.get_user_track_codes(telegram_id)),
+                ('get_user_orders', lambda: self.get_user_orders(telegram_id)),
+                ('get_recent_orders', lambda: self.get_recent_orders()),
+                ('find_track_code', lambda: self.find_track_code(track_code.lower())),
+                ('find_track_codes_batch', lambda: self.find_track_codes_batch([track_code, 'CK00000000000CN'])),
+                ('search_track_codes', lambda: self.search_track_codes(track_code[:-3])),
+                ('search_track_codes', lambda: self.search_track_codes(track_code[:-3], owner_id=telegram_id)),
+                ('search_users', lambda: self.search_users(str(seed_users // 2).zfill(7))),
+                ('search_users', lambda: self.search_users(username)),
+                ('search_users', lambda: self.search_users(f"GD-CHK{seed_users // 2}")),
+                ('get_balance_transactions', lambda: self.get_balance_transactions(telegram_id)),
+                ('get_exchange_rate_at', lambda: self.get_exchange_rate_at('CHK', now)),
+                ('get_exchange_rate_history', lambda: self.get_exchange_rate_history('CHK', now.replace(hour=0), now)),
+                ('get_exchange_rate_ohlc', lambda: self.get_exchange_rate_ohlc('CHK', now.replace(day=1), now)),
+                ('get_exchange_rates', lambda: self.get_exchange_rates()),
+                ('get_exchange_rates_brief', lambda: self.get_exchange_rates_brief()),
+                ('get_exchange_rates_version', lambda: self.get_exchange_rates_version()),
+                ('get_delivery_methods', lambda: self.get_delivery_methods()),
+                ('get_delivery_methods', lambda: self.get_delivery_methods('auto')),
+                ('get_track_attachments', lambda: self.get_track_attachments(track_code.lower())),
+                ('get_order_document', lambda: self.get_order_document(track_code)),
+                ('get_container_documents', lambda: self.get_container_documents('CHK-1')),
+                ('is_admin', lambda: self.is_admin(telegram_id)),
+                ('get_statistics', lambda: self.get_statistics()),
+                ('get_all_users', lambda: self.get_all_users()),
+            ]
+            for segment in segments:
+                checks.append(('count_segment', lambda segment=segment: self.count_segment(segment)))
+                checks.append(('iter_segment_recipients', lambda segment=segment: self._segment_page(
+                    conn, *compile_segment(segment), 0, SEGMENT_CHUNK_SIZE)))
+            for method, call in checks:
+                conn.plans = []
+                call()
+                results.append((method, *self._judge_plans(method, conn.plans)))
+                conn.plans = None
+            for method in sorted(UNCHECKED_METHODS):
+                results.append((method, True, f"not planned: {FULL_SCAN_METHODS[method]}"))
+            return results
+        finally:
+            _query_context.conn, self.use_replica = None, saved_replica
+            psycopg2.extensions.connection.rollback(conn)
+            conn.close()
+
+    @staticmethod
+    def _judge_plans(method, plans):
+        if not plans:
+            return False, "no SELECT executed"
+        used, seq_scans, total_ms = set(), set(), 0.0
+        for plan in plans:
+            total_ms += plan.get('Execution Time', 0.0)
+            for node in _plan_nodes(plan['Plan']):
+                if node.get('Index Name'):
+                    used.add(node['Index Name'])
+                if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in LARGE_TABLES:
+                    seq_scans.add(node['Relation Name'])
+        ok = not seq_scans or method in FULL_SCAN_METHODS
+        detail = f"{total_ms:.2f} ms; indexes: {', '.join(sorted(used)) or '-'}"
+        if seq_scans:
+            detail += f"; seq scan: {', '.join(sorted(seq_scans))}"
+        if method in FULL_SCAN_METHODS:
+            detail += f"; full scan allowed: {FULL_SCAN_METHODS[method]}"
+        return ok, detail
 
     # ------------------------- ГЕНЕРАЦИЯ КОДА -------------------------
     def generate_customer_code(self, first_name, phone_number):
-        """Генерирует код клиента: GD + первые 2 буквы имени + последние 4 цифры телефона"""
+        """Базовый код клиента: GD + первые 2 буквы имени + последние 4 цифры телефона.
+        Если код занят, register_user добавляет к нему суффикс из customer_code_suffix_seq."""
         letters = (first_name[:2] if first_name and len(first_name) >= 2 else "GD").upper()
-        digits = ''.join(filter(str.isdigit, phone_number))
+        digits = ''.join(filter(str.isdigit, phone_number or ""))
         last_digits = digits[-4:] if len(digits) >= 4 else digits.zfill(4)
-        code = f"GD-{letters}{last_digits}"
-        
-        with self.conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) as cnt FROM users WHERE customer_code = %s", (code,))
-            if cur.fetchone()['cnt'] == 0:
-                return code
-            else:
-                return f"GD-{letters}{last_digits}{random.choice(string.digits)}"
+        return f"GD-{letters}{last_digits}"
 
     # ------------------------- ПОЛЬЗОВАТЕЛИ -------------------------
+    @db_call('write')
     def register_user(self, user_id, username, first_name, last_name, phone_number, is_admin=False):
-        """Регистрирует нового пользователя или обновляет существующего"""
-        try:
-            user = self.get_user(user_id)
-            if user:
+        """Регистрирует нового пользователя или обновляет существующего одним запросом.
+        Возвращает код клиента (для существующего пользователя — прежний)."""
+        base_code = self.generate_customer_code(first_name, phone_number)
+        force_suffix = False
+        for attempt in range(CUSTOMER_CODE_RETRIES):
+            try:
                 with self.conn.cursor() as cur:
                     cur.execute("""
-                        UPDATE users 
-                        SET username = %s, first_name = %s, last_name = %s, phone_number = %s, is_admin = %s
-                        WHERE telegram_id = %s
-                    """, (username, first_name, last_name, phone_number, is_admin, user_id))
+                        INSERT INTO users (telegram_id, username, first_name, last_name, phone_number, customer_code, is_admin)
+                        VALUES (%(telegram_id)s, %(username)s, %(first_name)s, %(last_name)s, %(phone_number)s,
+                            CASE
+                                WHEN %(force_suffix)s OR EXISTS (SELECT 1 FROM users WHERE customer_code = %(code)s)
+                                THEN %(code)s || nextval('customer_code_suffix_seq')
+                                ELSE %(code)s
+                            END,
+                            %(is_admin)s)
+                        ON CONFLICT (telegram_id) DO UPDATE
+                        SET username = EXCLUDED.username,
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name,
+                            phone_number = EXCLUDED.phone_number,
+                            is_admin = EXCLUDED.is_admin
+                        RETURNING customer_code
+                    """, {
+                        'telegram_id': user_id,
+                        'username': username,
+                        'first_name': first_name,
+                        'last_name': last_name,
+                        'phone_number': phone_number,
+                        'code': base_code,
+                        'force_suffix': force_suffix,
+                        'is_admin': is_admin,
+                    })
+                    result = cur.fetchone()
                     self.conn.commit()
-                return user['customer_code']
-            
-            customer_code = self.generate_customer_code(first_name, phone_number)
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO users (telegram_id, username, first_name, last_name, phone_number, customer_code, is_admin)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING customer_code
-                """, (user_id, username, first_name, last_name, phone_number, customer_code, is_admin))
-                self.conn.commit()
-                result = cur.fetchone()
-                return result['customer_code']
-        except Exception as e:
-            self.conn.rollback()
-            print(f"Error in register_user: {e}")
-            raise e
+                    self._emit_change('user', user_id)
+                    return result['customer_code']
+            except psycopg2.errors.UniqueViolation as e:
+                self.conn.rollback()
+                # Параллельная регистрация заняла тот же код — повторяем с суффиксом из последовательности
+                if e.diag.constraint_name != 'users_customer_code_uidx' or attempt == CUSTOMER_CODE_RETRIES - 1:
+                    print(f"Error in register_user: {e}")
+                    raise e
+                force_suffix = True
+            except Exception as e:
+                self.conn.rollback()
+                print(f"Error in register_user: {e}")
+                raise e
 
+    @db_call('read', fallback=True, coalesce=True)
     def get_user(self, telegram_id):
         """Возвращает пользователя по telegram_id"""
+        conn = self._read_conn(telegram_id)
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user", "SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
                 return cur.fetchone()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_user: {e}")
             return None
 
+    @db_call('read', fallback=True, coalesce=True)
+    def get_user_summary(self, telegram_id):
+        """Профиль пользователя со счётчиками заказов (для API) одним запросом"""
+        conn = self._read_conn(telegram_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user_summary", """
+                    SELECT u.customer_code, u.balance,
+                           COUNT(tc.id) AS orders_count,
+                           COUNT(tc.id) FILTER (WHERE tc.status = 'Доставлен') AS delivered_count,
+                           u.first_name, u.phone_number
+                    FROM users u
+                    LEFT JOIN track_codes tc ON tc.user_id = u.id
+                    WHERE u.telegram_id = %s
+                    GROUP BY u.id
+                """, (telegram_id,))
+                return cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_user_summary: {e}")
+            return None
+
+    @db_call('read')
+    def get_users_batch(self, telegram_ids):
+        """Возвращает {telegram_id: профиль со счётчиками заказов} одним запросом"""
+        if not telegram_ids:
+            return {}
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_users_batch", """
+                    SELECT u.telegram_id, u.customer_code, u.balance, u.first_name, u.phone_number,
+                           COUNT(tc.id) AS orders_count,
+                           COUNT(tc.id) FILTER (WHERE tc.status = 'Доставлен') AS delivered_count
+                    FROM users u
+                    LEFT JOIN track_codes tc ON tc.user_id = u.id
+                    WHERE u.telegram_id = ANY(%s)
+                    GROUP BY u.id
+                """, (list(telegram_ids),))
+                return {row['telegram_id']: row for row in cur.fetchall()}
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_users_batch: {e}")
+            raise e
+
+    # Версии данных ответов API для ETag: md5 от xmin строк, из которых собран ответ.
+    # xmin меняется при каждом UPDATE строки и совпадает на реплике; в отличие от MAX(updated_at)
+    # его не обгонит транзакция, начавшаяся раньше, а закоммиченная позже.
+    @db_call('read', coalesce=True)
+    def get_user_version(self, telegram_id):
+        """Версия профиля (строка пользователя и его заказы — в профиле их счётчики) или None"""
+        conn = self._read_conn(telegram_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user_version", """
+                    SELECT md5(u.xmin::text || ':' || COALESCE(string_agg(tc.id || '.' || tc.xmin, ',' ORDER BY tc.id), ''))
+                           AS version
+                    FROM users u
+                    LEFT JOIN track_codes tc ON tc.user_id = u.id
+                    WHERE u.telegram_id = %s
+                    GROUP BY u.id
+                """, (telegram_id,))
+                row = cur.fetchone()
+                return row['version'] if row else None
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_user_version: {e}")
+            return None
+
+    @db_call('read', coalesce=True)
+    def get_orders_version(self, telegram_id):
+        """Версия списка заказов пользователя (закреплённые версии курса не меняются)"""
+        conn = self._read_conn(telegram_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_orders_version", """
+                    SELECT md5(COALESCE(string_agg(tc.id || '.' || tc.xmin, ',' ORDER BY tc.id), '')) AS version
+                    FROM users u
+                    JOIN track_codes tc ON tc.user_id = u.id
+                    WHERE u.telegram_id = %s
+                """, (telegram_id,))
+                return cur.fetchone()['version']
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_orders_version: {e}")
+            return None
+
+    @db_call('read')
     def get_user_by_customer_code(self, customer_code):
         """Возвращает пользователя по коду клиента"""
+        conn = self._read_conn()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT * FROM users WHERE customer_code = %s", (customer_code,))
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user_by_customer_code",
+                              "SELECT * FROM users WHERE customer_code = %s", (customer_code,))
                 return cur.fetchone()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_user_by_customer_code: {e}")
             return None
 
+    @db_call('read')
+    def search_users(self, query, limit=USER_SEARCH_PAGE, offset=0):
+        """Поиск клиентов для поддержки (см. compile_user_search): лучшие совпадения первыми.
+        Возвращает (строки страницы, есть ли следующая страница)."""
+        compiled = compile_user_search(query)
+        if compiled is None:
+            return [], False
+        where, rank, params = compiled
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT u.telegram_id, u.customer_code, u.first_name, u.last_name, u.username,
+                           u.phone_number, u.balance, u.is_admin, u.registration_date
+                    FROM users u
+                    WHERE {where}
+                    ORDER BY {rank} DESC, u.id
+                    LIMIT %(limit)s OFFSET %(offset)s
+                """, {**params, 'limit': limit + 1, 'offset': offset})
+                rows = cur.fetchall()
+            return rows[:limit], len(rows) > limit
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in search_users: {e}")
+            return [], False
+
     def is_admin(self, telegram_id):
         """Проверяет, является ли пользователь администратором"""
         try:
             user = self.get_user(telegram_id)
             return user and user.get('is_admin', False)
+        except DatabaseUnavailable:
+            return False
         except Exception as e:
-            self.conn.rollback()
             print(f"Error in is_admin: {e}")
             return False
 
-    def update_balance(self, telegram_id, amount):
-        """Обновляет баланс пользователя (положительное или отрицательное значение)"""
+    @db_call('write')
+    def update_balance(self, telegram_id, amount, idempotency_key=None, reason=None):
+        """Изменяет баланс пользователя (положительное или отрицательное значение).
+        Запись в журнал и изменение баланса выполняются одним запросом.
+        Возвращает (новый баланс, applied); при повторе с тем же idempotency_key (ключи
+        уникальны в пределах пользователя) баланс не меняется и applied = False; если сумма
+        повтора другая — IdempotencyConflict. Если пользователь не найден — (None, False)."""
         try:
             with self.conn.cursor() as cur:
-                cur.execute("UPDATE users SET balance = balance + %s WHERE telegram_id = %s", (amount, telegram_id))
+                cur.execute("""
+                    WITH tx AS (
+                        INSERT INTO balance_transactions (user_id, amount, reason, idempotency_key)
+                        SELECT id, %s, %s, %s FROM users WHERE telegram_id = %s
+                        ON CONFLICT (user_id, idempotency_key) DO NOTHING
+                        RETURNING user_id, amount
+                    )
+                    UPDATE users
+                    SET balance = users.balance + tx.amount
+                    FROM tx
+                    WHERE users.id = tx.user_id
+                    RETURNING users.balance
+                """, (amount, reason, idempotency_key, telegram_id))
+                row = cur.fetchone()
+                if row:
+                    self.conn.commit()
+                    self._emit_change('user', telegram_id)
+                    return row['balance'], True
+                # Повтор операции (или пользователя нет) — возвращаем текущий баланс.
+                # Повтор с тем же ключом, но другой суммой — ошибка клиента, а не повтор
+                self._execute(cur, "get_balance_replay", """
+                    SELECT u.balance, bt.amount <> %s::numeric(12, 2) AS conflict
+                    FROM users u
+                    LEFT JOIN balance_transactions bt ON bt.user_id = u.id AND bt.idempotency_key = %s
+                    WHERE u.telegram_id = %s
+                """, (amount, idempotency_key, telegram_id))
+                row = cur.fetchone()
                 self.conn.commit()
+                if row and row['conflict']:
+                    raise IdempotencyConflict([idempotency_key])
+                return (row['balance'] if row else None), False
+        except IdempotencyConflict:
+            raise
         except Exception as e:
             self.conn.rollback()
             print(f"Error in update_balance: {e}")
             raise e
 
+    @db_call('write')
+    def post_balance_transactions(self, transactions):
+        """Проводит пачку операций за один запрос.
+        transactions — список словарей с ключами telegram_id, amount и необязательными
+        idempotency_key, reason. Возвращает {telegram_id: новый баланс} для пользователей,
+        чей баланс изменился (повторы и неизвестные пользователи пропускаются).
+        Если ключ повторён с другой суммой — IdempotencyConflict, и ни одна операция пачки не проводится."""
+        if not transactions:
+            return {}
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("""
+                    WITH data AS (
+                        SELECT *
+                        FROM unnest(%s::bigint[], %s::numeric[], %s::text[], %s::text[])
+                             AS d(telegram_id, amount, idempotency_key, reason)
+                    ),
+                    tx AS (
+                        INSERT INTO balance_transactions (user_id, amount, reason, idempotency_key)
+                        SELECT u.id, d.amount, d.reason, d.idempotency_key
+                        FROM data d
+                        JOIN users u ON u.telegram_id = d.telegram_id
+                        ON CONFLICT (user_id, idempotency_key) DO NOTHING
+                        RETURNING user_id, amount
+                    ),
+                    totals AS (
+                        SELECT user_id, SUM(amount) AS amount FROM tx GROUP BY user_id
+                    )
+                    UPDATE users
+                    SET balance = users.balance + totals.amount
+                    FROM totals
+                    WHERE users.id = totals.user_id
+                    RETURNING users.telegram_id, users.balance
+                """, (
+                    [t['telegram_id'] for t in transactions],
+                    [t['amount'] for t in transactions],
+                    [t.get('idempotency_key') for t in transactions],
+                    [t.get('reason') for t in transactions],
+                ))
+                rows = cur.fetchall()
+                # Ключи, под которыми в журнале (включая только что записанное) другая сумма:
+                # повтор с изменённой суммой или один ключ дважды в пачке — пачка не проводится целиком
+                cur.execute("""
+                    SELECT DISTINCT d.idempotency_key
+                    FROM unnest(%s::bigint[], %s::numeric[], %s::text[]) AS d(telegram_id, amount, idempotency_key)
+                    JOIN users u ON u.telegram_id = d.telegram_id
+                    JOIN balance_transactions bt ON bt.user_id = u.id AND bt.idempotency_key = d.idempotency_key
+                    WHERE bt.amount <> d.amount::numeric(12, 2)
+                """, (
+                    [t['telegram_id'] for t in transactions],
+                    [t['amount'] for t in transactions],
+                    [t.get('idempotency_key') for t in transactions],
+                ))
+                conflicts = [row['idempotency_key'] for row in cur.fetchall()]
+                if conflicts:
+                    self.conn.rollback()
+                    raise IdempotencyConflict(conflicts)
+                self.conn.commit()
+            self._emit_changes('user', [row['telegram_id'] for row in rows])
+            return {row['telegram_id']: row['balance'] for row in rows}
+        except IdempotencyConflict:
+            raise
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error in post_balance_transactions: {e}")
+            raise e
+
+    @db_call('read')
+    def get_balance_transactions(self, telegram_id, limit=50):
+        """Возвращает последние операции по балансу пользователя"""
+        conn = self._read_conn(telegram_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_balance_transactions", """
+                    SELECT bt.id, bt.amount, bt.reason, bt.created_at
+                    FROM balance_transactions bt
+                    JOIN users u ON u.id = bt.user_id
+                    WHERE u.telegram_id = %s
+                    ORDER BY bt.created_at DESC
+                    LIMIT %s
+                """, (telegram_id, limit))
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_balance_transactions: {e}")
+            return []
+
     # ------------------------- ТРЕК-КОДЫ -------------------------
-    def add_track_code(self, telegram_id, track_code, description="", price=0):
-        """Добавляет трек-код для пользователя (для админов)"""
+    @db_call('write')
+    def add_track_code(self, telegram_id, track_code, description="", price=0, currency_code="USD",
+                       delivery_method=None):
+        """Добавляет трек-код для пользователя (для админов).
+        Цена фиксируется по версии курса currency_code, действующей в момент добавления."""
         try:
             user = self.get_user(telegram_id)
             if not user:
                 return False, "Пользователь не найден"
             
             with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO track_codes (user_id, track_code, description, price)
-                    VALUES (%s, %s, %s, %s)
-                """, (user['id'], track_code.upper(), description, price))
+                self._execute(cur, "add_track_code", """
+                    INSERT INTO track_codes (user_id, track_code, description, price, exchange_rate_id, delivery_method)
+                    VALUES (%s, %s, %s, %s, (
+                        SELECT id FROM exchange_rate_history
+                        WHERE currency_code = %s
+                        ORDER BY valid_from DESC
+                        LIMIT 1
+                    ), %s)
+                """, (user['id'], track_code.upper(), description, price, currency_code, delivery_method))
                 self.conn.commit()
+            self._emit_change('orders', telegram_id, {'track_code': track_code.upper(), 'status': None})
             return True, "Трек-код добавлен"
         except psycopg2.IntegrityError:
             self.conn.rollback()
@@ -137,45 +1896,85 @@ class Database:
             print(f"Error in add_track_code: {e}")
             return False, str(e)
 
+    @db_call('read')
     def get_user_track_codes(self, telegram_id):
         """Возвращает все трек-коды пользователя"""
+        conn = self._read_conn(telegram_id)
         try:
             user = self.get_user(telegram_id)
             if not user:
                 return []
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    SELECT id, track_code, description, status, created_date, price
-                    FROM track_codes
-                    WHERE user_id = %s
-                    ORDER BY created_date DESC
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user_track_codes", """
+                    SELECT tc.id, tc.track_code, tc.description, tc.status, tc.created_date, tc.price,
+                           h.rate AS exchange_rate
+                    FROM track_codes tc
+                    LEFT JOIN exchange_rate_history h ON h.id = tc.exchange_rate_id
+                    WHERE tc.user_id = %s
+                    ORDER BY tc.created_date DESC
                 """, (user['id'],))
                 return cur.fetchall()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_user_track_codes: {e}")
             return []
 
+    @db_call('read', coalesce=True)
+    def get_user_orders(self, telegram_id):
+        """Заказы пользователя в формате API: цена в рублях по зафиксированному курсу"""
+        conn = self._read_conn(telegram_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_user_orders", """
+                    SELECT tc.track_code, tc.description, tc.status, tc.created_date AS date,
+                           COALESCE(tc.price, 0) AS price,
+                           h.rate AS exchange_rate,
+                           tc.price * h.rate AS price_rub
+                    FROM users u
+                    JOIN track_codes tc ON tc.user_id = u.id
+                    LEFT JOIN exchange_rate_history h ON h.id = tc.exchange_rate_id
+                    WHERE u.telegram_id = %s
+                    ORDER BY tc.created_date DESC
+                """, (telegram_id,))
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_user_orders: {e}")
+            return []
+
+    @db_call('write')
     def update_track_code_status(self, track_code_id, new_status):
-        """Обновляет статус трек-кода"""
+        """Обновляет статус трек-кода. Возвращает трек-код, новый статус и telegram_id владельца."""
         try:
             with self.conn.cursor() as cur:
-                cur.execute("""
+                self._execute(cur, "update_track_code_status", """
                     UPDATE track_codes
                     SET status = %s, updated_at = NOW()
                     WHERE id = %s
+                    RETURNING id, track_code, status, updated_at,
+                              (SELECT telegram_id FROM users WHERE users.id = track_codes.user_id) AS telegram_id
                 """, (new_status, track_code_id))
+                row = cur.fetchone()
                 self.conn.commit()
+            if row and row['telegram_id']:
+                self._emit_change('orders', row['telegram_id'], {
+                    'track_code': row['track_code'],
+                    'status': row['status'],
+                    'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None
+                })
+            return row
         except Exception as e:
             self.conn.rollback()
             print(f"Error in update_track_code_status: {e}")
             raise e
 
+    @db_call('read', coalesce=True)
     def get_recent_orders(self, limit=20):
         """Возвращает последние заказы (для админки)"""
+        conn = self._read_conn()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
+            with conn.cursor() as cur:
+                self._execute(cur, "get_recent_orders", """
                     SELECT tc.id, tc.track_code, tc.status, tc.created_date, u.customer_code, tc.price
                     FROM track_codes tc
                     LEFT JOIN users u ON tc.user_id = u.id
@@ -184,98 +1983,517 @@ class Database:
                 """, (limit,))
                 return cur.fetchall()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_recent_orders: {e}")
             return []
 
+    @db_call('read', coalesce=True)
+    def find_track_code(self, track_code, owner_id=None):
+        """Ищет трек-код по точному совпадению (без учёта регистра, пробелов и дефисов).
+        owner_id — только среди заказов этого пользователя (telegram_id)."""
+        key = normalize_track_code(track_code)
+        if not key:
+            return None
+        owner_filter = "AND u.telegram_id = %s" if owner_id is not None else ""
+        conn = self._read_conn(owner_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "find_track_code" if owner_id is None else "find_own_track_code", f"""
+                    SELECT tc.track_code, tc.status, tc.description, tc.created_date AS date,
+                           u.customer_code, COALESCE(tc.price, 0) AS price
+                    FROM track_codes tc
+                    LEFT JOIN users u ON tc.user_id = u.id
+                    WHERE {TRACK_KEY_SQL} = %s {owner_filter}
+                    LIMIT 1
+                """, (key,) if owner_id is None else (key, owner_id))
+                return cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in find_track_code: {e}")
+            return None
+
+    @db_call('read')
+    def find_track_codes_batch(self, track_codes, owner_id=None):
+        """Точный поиск пачки трек-кодов одним запросом. Возвращает {нормализованный ключ: строка}.
+        owner_id — только среди заказов этого пользователя (telegram_id)."""
+        keys = list({normalize_track_code(code) for code in track_codes} - {''})
+        if not keys:
+            return {}
+        owner_filter = "AND u.telegram_id = %s" if owner_id is not None else ""
+        conn = self._read_conn(owner_id)
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "find_track_codes_batch" if owner_id is None else "find_own_track_codes_batch", f"""
+                    SELECT {TRACK_KEY_SQL} AS track_key,
+                           tc.track_code, tc.status, tc.description, tc.created_date AS date,
+                           u.customer_code, COALESCE(tc.price, 0) AS price
+                    FROM track_codes tc
+                    LEFT JOIN users u ON tc.user_id = u.id
+                    WHERE {TRACK_KEY_SQL} = ANY(%s) {owner_filter}
+                """, (keys,) if owner_id is None else (keys, owner_id))
+                return {row.pop('track_key'): row for row in cur.fetchall()}
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in find_track_codes_batch: {e}")
+            raise e
+
+    @db_call('read')
+    def search_track_codes(self, query, limit=TRACK_SEARCH_LIMIT, fuzzy=True, owner_id=None):
+        """Ищет трек-коды по точному совпадению, префиксу и (если fuzzy) по похожести.
+        Результаты упорядочены: точное совпадение, префикс, затем по убыванию similarity;
+        похожие коды ищутся, только если точного совпадения нет и префиксу нашлось меньше limit.
+        owner_id — искать только среди заказов этого пользователя (telegram_id)."""
+        key = normalize_track_code(query)
+        if not key:
+            return []
+        fuzzy = fuzzy and len(key) >= TRACK_FUZZY_MIN_LENGTH
+        owner_filter = "AND u.telegram_id = %(owner_id)s" if owner_id is not None else ""
+        columns = "tc.id, tc.track_code, tc.status, tc.description, tc.created_date, u.customer_code, tc.price"
+        params = {'key': key, 'prefix': key + '%', 'limit': limit, 'owner_id': owner_id}
+        conn = self._read_conn(owner_id)
+        try:
+            with conn.cursor() as cur:
+                # Точное совпадение и префикс — диапазон B-tree, миллисекунды на любой таблице
+                cur.execute(f"""
+                    SELECT {columns}, {TRACK_KEY_SQL} = %(key)s AS exact, similarity({TRACK_KEY_SQL}, %(key)s) AS score
+                    FROM track_codes tc
+                    LEFT JOIN users u ON tc.user_id = u.id
+                    WHERE {TRACK_KEY_SQL} LIKE %(prefix)s {owner_filter}
+                    ORDER BY exact DESC, score DESC, tc.created_date DESC
+                    LIMIT %(limit)s
+                """, params)
+                rows = cur.fetchall()
+                if not fuzzy or len(rows) >= limit or (rows and rows[0]['exact']):
+                    return rows
+                # Опечатки — по триграммам, если точного совпадения нет, а по префиксу нашлось меньше limit.
+                # Префиксы перевозчиков (YT…CN, LP…) общие у сотен тысяч кодов: при пороге по умолчанию (0.3)
+                # индекс отдаёт их все на перепроверку, TRACK_FUZZY_THRESHOLD оставляет коды с 1–2 опечатками
+                cur.execute(f"""
+                    SET LOCAL pg_trgm.similarity_threshold = {TRACK_FUZZY_THRESHOLD};
+                    SELECT {columns}, FALSE AS exact, similarity({TRACK_KEY_SQL}, %(key)s) AS score
+                    FROM track_codes tc
+                    LEFT JOIN users u ON tc.user_id = u.id
+                    WHERE {TRACK_KEY_SQL} %% %(key)s AND {TRACK_KEY_SQL} NOT LIKE %(prefix)s {owner_filter}
+                    ORDER BY score DESC, tc.created_date DESC
+                    LIMIT %(fuzzy_limit)s
+                """, {**params, 'fuzzy_limit': limit - len(rows)})
+                return rows + cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in search_track_codes: {e}")
+            return []
+
+    @db_call('write')
+    def add_track_attachment(self, track_code, kind, file_id, file_unique_id, uploaded_by=None):
+        """Сохраняет file_id фото или видео к трек-коду; повторная загрузка того же файла игнорируется.
+        Возвращает трек-код и telegram_id владельца или None, если трек-код не найден."""
+        key = normalize_track_code(track_code)
+        if not key:
+            return None
+        try:
+            with self.conn.cursor() as cur:
+                # Типы параметров явно: PREPARE выводит их сам, а в списке SELECT внутри CTE вывод
+                # зависит от версии сервера и может оставить text там, где колонка bigint
+                self._execute(cur, "add_track_attachment", f"""
+                    WITH target AS (
+                        SELECT tc.id, tc.track_code, u.telegram_id
+                        FROM track_codes tc
+                        LEFT JOIN users u ON tc.user_id = u.id
+                        WHERE {TRACK_KEY_SQL} = %s::text
+                        LIMIT 1
+                    ), saved AS (
+                        INSERT INTO track_attachments (track_code_id, kind, file_id, file_unique_id, uploaded_by)
+                        SELECT id, %s::text, %s::text, %s::text, %s::bigint FROM target
+                        ON CONFLICT (track_code_id, file_unique_id) DO NOTHING
+                    )
+                    SELECT track_code, telegram_id FROM target
+                """, (key, kind, file_id, file_unique_id, uploaded_by))
+                row = cur.fetchone()
+                self.conn.commit()
+            return row
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error in add_track_attachment: {e}")
+            raise e
+
+    @db_call('read')
+    def get_track_attachments(self, track_code):
+        """Трек-код, telegram_id владельца и вложения в порядке загрузки. None, если трек-код не найден."""
+        key = normalize_track_code(track_code)
+        if not key:
+            return None
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_track_attachments", f"""
+                    SELECT tc.track_code, u.telegram_id AS owner_id, a.kind, a.file_id
+                    FROM track_codes tc
+                    LEFT JOIN users u ON tc.user_id = u.id
+                    LEFT JOIN track_attachments a ON a.track_code_id = tc.id
+                    WHERE {TRACK_KEY_SQL} = %s
+                    ORDER BY a.id
+                """, (key,))
+                rows = cur.fetchall()
+            if not rows:
+                return None
+            return {
+                'track_code': rows[0]['track_code'],
+                'owner_id': rows[0]['owner_id'],
+                'attachments': [{'kind': row['kind'], 'file_id': row['file_id']} for row in rows if row['file_id']],
+            }
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_track_attachments: {e}")
+            return None
+
+    @db_call('read')
+    def get_order_document(self, track_code):
+        """Данные заказа для счёта и этикетки (см. ORDER_DOCUMENT_SQL) или None"""
+        key = normalize_track_code(track_code)
+        if not key:
+            return None
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_order_document", f"{ORDER_DOCUMENT_SQL} WHERE {TRACK_KEY_SQL} = %s LIMIT 1", (key,))
+                return cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_order_document: {e}")
+            return None
+
+    @db_call('report')
+    def get_container_documents(self, container_code):
+        """Данные всех заказов контейнера для пачки этикеток, по порядку трек-кодов"""
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_container_documents",
+                              f"{ORDER_DOCUMENT_SQL} WHERE tc.container_code = %s ORDER BY tc.track_code",
+                              (container_code.upper(),))
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_container_documents: {e}")
+            return []
+
+    @db_call('write')
+    def set_track_container(self, container_code, track_codes):
+        """Собирает заказы в контейнер. Возвращает список найденных трек-кодов.
+        updated_at меняется — этикетки и счета этих заказов будут отрисованы заново."""
+        keys = list({normalize_track_code(code) for code in track_codes} - {''})
+        if not keys:
+            return []
+        try:
+            with self.conn.cursor() as cur:
+                self._execute(cur, "set_track_container", f"""
+                    UPDATE track_codes tc
+                    SET container_code = %s, updated_at = NOW()
+                    WHERE {TRACK_KEY_SQL} = ANY(%s)
+                    RETURNING tc.track_code
+                """, (container_code.upper(), keys))
+                rows = cur.fetchall()
+                self.conn.commit()
+            return [row['track_code'] for row in rows]
+        except Exception as e:
+            self.conn.rollback()
+            print(f"Error in set_track_container: {e}")
+            raise e
+
     # ------------------------- КУРСЫ ВАЛЮТ -------------------------
+    @db_call('read', fallback=True, coalesce=True)
     def get_exchange_rates(self):
         """Возвращает все курсы валют"""
+        conn = self._read_conn(topic='exchange_rates')
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT * FROM exchange_rates ORDER BY currency_code")
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rates", "SELECT * FROM exchange_rates ORDER BY currency_code")
                 return cur.fetchall()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_exchange_rates: {e}")
             return []
 
+    @db_call('write')
     def update_exchange_rate(self, currency_code, rate):
-        """Обновляет курс валюты"""
+        """Обновляет курс валюты и добавляет новую версию в историю.
+        Возвращает id версии курса (None, если валюта не найдена)."""
         try:
             with self.conn.cursor() as cur:
                 cur.execute("""
+                    WITH version AS (
+                        INSERT INTO exchange_rate_history (currency_code, rate)
+                        SELECT currency_code, %s FROM exchange_rates WHERE currency_code = %s
+                        RETURNING id, valid_from
+                    )
                     UPDATE exchange_rates
-                    SET rate = %s, updated_at = NOW()
+                    SET rate = %s, updated_at = version.valid_from
+                    FROM version
                     WHERE currency_code = %s
-                """, (rate, currency_code))
+                    RETURNING version.id
+                """, (rate, currency_code, rate, currency_code))
+                row = cur.fetchone()
                 self.conn.commit()
+            self._emit_change('exchange_rates')
+            return row['id'] if row else None
         except Exception as e:
             self.conn.rollback()
             print(f"Error in update_exchange_rate: {e}")
             raise e
 
+    @db_call('read', fallback=True, coalesce=True)
+    def get_exchange_rates_brief(self):
+        """Курсы валют в формате API"""
+        conn = self._read_conn(topic='exchange_rates')
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rates_brief", """
+                    SELECT currency_code AS code, rate, flag, name
+                    FROM exchange_rates
+                    ORDER BY currency_code
+                """)
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_exchange_rates_brief: {e}")
+            return []
+
+    @db_call('read', coalesce=True)
+    def get_exchange_rates_version(self):
+        """Версия таблицы курсов для ETag (см. get_user_version)"""
+        conn = self._read_conn(topic='exchange_rates')
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rates_version", """
+                    SELECT md5(COALESCE(string_agg(id || '.' || xmin, ',' ORDER BY id), '')) AS version
+                    FROM exchange_rates
+                """)
+                return cur.fetchone()['version']
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_exchange_rates_version: {e}")
+            return None
+
+    @db_call('read')
+    def get_exchange_rate_at(self, currency_code, at):
+        """Возвращает версию курса, действовавшую в момент at"""
+        conn = self._read_conn(topic='exchange_rates')
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rate_at", """
+                    SELECT id, currency_code, rate, valid_from
+                    FROM exchange_rate_history
+                    WHERE currency_code = %s AND valid_from <= %s
+                    ORDER BY valid_from DESC
+                    LIMIT 1
+                """, (currency_code, at))
+                return cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_exchange_rate_at: {e}")
+            return None
+
+    @db_call('read')
+    def get_exchange_rate_history(self, currency_code, start, end):
+        """Возвращает все изменения курса в интервале [start, end)"""
+        conn = self._read_conn(topic='exchange_rates')
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rate_history", """
+                    SELECT id, currency_code, rate, valid_from
+                    FROM exchange_rate_history
+                    WHERE currency_code = %s AND valid_from >= %s AND valid_from < %s
+                    ORDER BY valid_from
+                """, (currency_code, start, end))
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_exchange_rate_history: {e}")
+            return []
+
+    @db_call('read')
+    def get_exchange_rate_ohlc(self, currency_code, start, end):
+        """Возвращает дневные свечи (open/high/low/close) курса в интервале [start, end)"""
+        conn = self._read_conn(topic='exchange_rates')
+        try:
+            with conn.cursor() as cur:
+                self._execute(cur, "get_exchange_rate_ohlc", """
+                    SELECT date_trunc('day', valid_from) AS day,
+                           (array_agg(rate ORDER BY valid_from))[1] AS open,
+                           MAX(rate) AS high,
+                           MIN(rate) AS low,
+                           (array_agg(rate ORDER BY valid_from DESC))[1] AS close,
+                           COUNT(*) AS changes
+                    FROM exchange_rate_history
+                    WHERE currency_code = %s AND valid_from >= %s AND valid_from < %s
+                    GROUP BY day
+                    ORDER BY day
+                """, (currency_code, start, end))
+                return cur.fetchall()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in get_exchange_rate_ohlc: {e}")
+            return []
+
     # ------------------------- МЕТОДЫ ДОСТАВКИ -------------------------
+    @db_call('read', fallback=True, coalesce=True)
     def get_delivery_methods(self, delivery_type=None):
         """Возвращает способы доставки (можно фильтровать по типу)"""
+        conn = self._read_conn(topic='delivery_methods')
         try:
-            with self.conn.cursor() as cur:
+            with conn.cursor() as cur:
                 if delivery_type:
-                    cur.execute("""
+                    self._execute(cur, "get_delivery_methods_by_type", """
                         SELECT * FROM delivery_methods 
                         WHERE type = %s 
                         ORDER BY method_code
                     """, (delivery_type,))
                 else:
-                    cur.execute("SELECT * FROM delivery_methods ORDER BY method_code")
+                    self._execute(cur, "get_delivery_methods", "SELECT * FROM delivery_methods ORDER BY method_code")
                 return cur.fetchall()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_delivery_methods: {e}")
             return []
 
+    @db_call('write')
     def update_delivery_price(self, method_code, price_per_kg):
         """Обновляет цену доставки"""
         try:
             with self.conn.cursor() as cur:
-                cur.execute("""
+                self._execute(cur, "update_delivery_price", """
                     UPDATE delivery_methods
                     SET price_per_kg = %s, updated_at = NOW()
                     WHERE method_code = %s
                 """, (price_per_kg, method_code))
                 self.conn.commit()
+            self._emit_change('delivery_methods')
         except Exception as e:
             self.conn.rollback()
             print(f"Error in update_delivery_price: {e}")
             raise e
 
+    @db_call('write')
     def update_delivery_days(self, method_code, min_days, max_days):
         """Обновляет сроки доставки"""
         try:
             with self.conn.cursor() as cur:
-                cur.execute("""
+                self._execute(cur, "update_delivery_days", """
                     UPDATE delivery_methods
                     SET min_days = %s, max_days = %s, updated_at = NOW()
                     WHERE method_code = %s
                 """, (min_days, max_days, method_code))
                 self.conn.commit()
+            self._emit_change('delivery_methods')
         except Exception as e:
             self.conn.rollback()
             print(f"Error in update_delivery_days: {e}")
             raise e
 
+    # ------------------------- СЕГМЕНТЫ РАССЫЛОК -------------------------
+    @db_call('report')
+    def count_segment(self, segment):
+        """Размер сегмента: (число, точное ли оно).
+        Сначала берётся оценка планировщика (EXPLAIN без выполнения); точный COUNT
+        выполняется, только если сегмент не больше SEGMENT_EXACT_COUNT_LIMIT."""
+        where, params = compile_segment(segment)
+        query = f"SELECT u.id FROM users u WHERE {where}"
+        conn = self._read_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+                estimate = int(cur.fetchone()['QUERY PLAN'][0]['Plan']['Plan Rows'])
+                if estimate > SEGMENT_EXACT_COUNT_LIMIT:
+                    return estimate, False
+                cur.execute(f"""
+                    SET LOCAL random_page_cost = {SEGMENT_RANDOM_PAGE_COST};
+                    SELECT COUNT(*) AS cnt FROM users u WHERE {where}
+                """, params)
+                return cur.fetchone()['cnt'], True
+        except Exception as e:
+            conn.rollback()
+            print(f"Error in count_segment: {e}")
+            raise e
+
+    def iter_segment_recipients(self, segment, chunk_size=SEGMENT_CHUNK_SIZE):
+        """Генератор telegram_id получателей сегмента пачками (списками) по chunk_size.
+        Пачки читаются keyset-пагинацией по users.id, а не курсором: рассылка идёт
+        часами, и держать всё это время открытую транзакцию нельзя. Чтение идёт через
+        отдельное соединение в режиме autocommit и только для чтения (с реплики, если она
+        доступна), как в export_rows: каждая пачка — свой короткий запрос, общее соединение
+        не занято. Соединение закрывается, когда генератор исчерпан или закрыт."""
+        where, params = compile_segment(segment)
+        dsn = DATABASE_REPLICA_URL if self._replica_ready() else DATABASE_URL
+        conn = psycopg2.connect(dsn, application_name="broadcast", cursor_factory=RealDictCursor)
+        try:
+            conn.set_session(readonly=True, autocommit=True)
+            last_id = 0
+            while True:
+                rows = self._segment_page(conn, where, params, last_id, chunk_size)
+                if not rows:
+                    return
+                last_id = rows[-1]['id']
+                yield [row['telegram_id'] for row in rows]
+        except Exception as e:
+            print(f"Error in iter_segment_recipients: {e}")
+            raise e
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _segment_page(conn, where, params, after_id, chunk_size):
+        """Пачка получателей сегмента после users.id = after_id (см. iter_segment_recipients)"""
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SET LOCAL random_page_cost = {SEGMENT_RANDOM_PAGE_COST};
+                SELECT u.id, u.telegram_id
+                FROM users u
+                WHERE {where} AND u.id > %(after_id)s
+                ORDER BY u.id
+                LIMIT %(chunk_size)s
+            """, {**params, 'after_id': after_id, 'chunk_size': chunk_size})
+            return cur.fetchall()
+
+    # ------------------------- ВЫГРУЗКИ -------------------------
+    def export_rows(self, kind, chunk_size=EXPORT_CHUNK_SIZE):
+        """Генератор выгрузки kind (см. EXPORT_QUERIES): сначала кортеж названий колонок, затем строки.
+
+        Строки читаются именованным (серверным) курсором по chunk_size за раз, поэтому
+        память не зависит от размера таблицы. Курсор живёт на отдельном соединении
+        (с реплики, если она доступна): долгая выгрузка не держит транзакцию на общем
+        соединении. Соединение закрывается, когда генератор исчерпан или закрыт.
+        """
+        query = EXPORT_QUERIES[kind]
+        dsn = DATABASE_REPLICA_URL if self._replica_ready() else DATABASE_URL
+        conn = psycopg2.connect(dsn, application_name=f"export:{kind}")
+        try:
+            conn.set_session(readonly=True)
+            with conn.cursor(name=f"export_{kind}") as cur:
+                cur.itersize = chunk_size
+                cur.execute(query)
+                rows = cur.fetchmany(chunk_size)
+                yield tuple(column.name for column in cur.description)
+                while rows:
+                    yield from rows
+                    rows = cur.fetchmany(chunk_size)
+        finally:
+            conn.close()
+
     # ------------------------- СТАТИСТИКА -------------------------
+    @db_call('report', coalesce=True)
     def get_statistics(self):
         """Возвращает статистику (для админки)"""
+        conn = self._read_conn()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) as cnt FROM users")
+            with conn.cursor() as cur:
+                self._execute(cur, "count_users", "SELECT COUNT(*) as cnt FROM users")
                 total_users = cur.fetchone()['cnt']
-                cur.execute("SELECT COUNT(*) as cnt FROM users WHERE is_admin = TRUE")
+                self._execute(cur, "count_admins", "SELECT COUNT(*) as cnt FROM users WHERE is_admin = TRUE")
                 admin_users = cur.fetchone()['cnt']
-                cur.execute("SELECT COUNT(*) as cnt FROM track_codes")
+                self._execute(cur, "count_track_codes", "SELECT COUNT(*) as cnt FROM track_codes")
                 total_track_codes = cur.fetchone()['cnt']
-                cur.execute("SELECT COUNT(*) as cnt FROM track_codes WHERE status = 'Доставлен'")
+                self._execute(cur, "count_delivered",
+                              "SELECT COUNT(*) as cnt FROM track_codes WHERE status = 'Доставлен'")
                 delivered = cur.fetchone()['cnt']
                 return {
                     'total_users': total_users,
@@ -284,7 +2502,7 @@ class Database:
                     'delivered_track_codes': delivered
                 }
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_statistics: {e}")
             return {
                 'total_users': 0,
@@ -293,18 +2511,372 @@ class Database:
                 'delivered_track_codes': 0
             }
 
+    @db_call('report')
     def get_all_users(self, include_admins=False):
         """Возвращает всех пользователей (для админки)"""
+        conn = self._read_conn()
         try:
-            with self.conn.cursor() as cur:
+            with conn.cursor() as cur:
                 if include_admins:
-                    cur.execute("SELECT * FROM users ORDER BY registration_date DESC")
+                    self._execute(cur, "get_all_users", "SELECT * FROM users ORDER BY registration_date DESC")
                 else:
-                    cur.execute("SELECT * FROM users WHERE is_admin = FALSE ORDER BY registration_date DESC")
+                    self._execute(cur, "get_customers",
+                                  "SELECT * FROM users WHERE is_admin = FALSE ORDER BY registration_date DESC")
                 return cur.fetchall()
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             print(f"Error in get_all_users: {e}")
             return []
 
-db = Database()
\ No newline at end of file
+db = Database()
+
+
+def _main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Миграции и проверка индексов базы Golden Dragon")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="применить недостающие миграции")
+    sub.add_parser("status", help="показать применённые миграции")
+    check = sub.add_parser("check-indexes", help="EXPLAIN ANALYZE методов на тестовых данных (откатываются)")
+    check.add_argument("--seed", type=int, default=200000, help="сколько тестовых пользователей создать")
+    registration = sub.add_parser("check-registration",
+                                  help="параллельная регистрация клиентов с одинаковым кодом (удаляются после проверки)")
+    registration.add_argument("--users", type=int, default=2000)
+    registration.add_argument("--threads", type=int, default=32)
+    herd = sub.add_parser("bench-herd", help="число запросов к БД при одновременных одинаковых чтениях")
+    herd.add_argument("--callers", type=int, default=500)
+    search = sub.add_parser("bench-search", help="задержка search_users на тестовых клиентах (откатываются)")
+    search.add_argument("--seed", type=int, default=1000000, help="сколько тестовых клиентов создать")
+    search.add_argument("--repeat", type=int, default=20)
+    batch = sub.add_parser("bench-batch",
+                           help="пакетные find_track_codes_batch/get_users_batch против поштучных вызовов (откатываются)")
+    batch.add_argument("--keys", type=int, default=1000)
+    batch.add_argument("--repeat", type=int, default=5)
+    track_search = sub.add_parser("bench-track-search",
+                                  help="задержка search_track_codes на тестовых трек-кодах (откатываются)")
+    track_search.add_argument("--seed", type=int, default=3000000, help="сколько тестовых трек-кодов создать")
+    track_search.add_argument("--repeat", type=int, default=20)
+    bench = sub.add_parser("bench-prepared", help="сравнить get_user/get_user_track_codes с PREPARE и без")
+    bench.add_argument("--iterations", type=int, default=5000)
+    bench.add_argument("--telegram-id", type=int, help="пользователь для запросов (по умолчанию — с наибольшим числом заказов)")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        applied = db.migrate()
+        print(f"Applied: {applied or 'nothing, schema is up to date'}")
+    elif args.command == "status":
+        for version, name, applied_at in db.get_migration_status():
+            print(f"{version:>3}  {'applied ' + str(applied_at) if applied_at else 'pending':<45} {name}")
+    elif args.command == "check-indexes":
+        failed = 0
+        for method, ok, detail in db.check_query_plans(args.seed):
+            failed += not ok
+            print(f"{'OK  ' if ok else 'FAIL'} {method:<28} {detail}")
+        raise SystemExit(1 if failed else 0)
+    elif args.command == "check-registration":
+        raise SystemExit(0 if _check_registration(args.users, args.threads) else 1)
+    elif args.command == "bench-prepared":
+        _bench_prepared(args.iterations, args.telegram_id)
+    elif args.command == "bench-herd":
+        _bench_herd(args.callers)
+    elif args.command == "bench-search":
+        _bench_search(args.seed, args.repeat)
+    elif args.command == "bench-batch":
+        _bench_batch(args.keys, args.repeat)
+    elif args.command == "bench-track-search":
+        _bench_track_search(args.seed, args.repeat)
+
+
+def _check_registration(users, threads):
+    """Регистрирует users клиентов с одним именем и одинаковыми последними цифрами телефона
+    (все претендуют на один код клиента) из threads потоков; половину — дважды одновременно.
+    Проверяет, что у каждого клиента одна строка, коды уникальны, а повторная регистрация
+    вернула тот же код. Тестовые клиенты удаляются в конце. Возвращает True, если всё верно."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    first_id = 910000000000
+    telegram_ids = list(range(first_id, first_id + users))
+    calls = telegram_ids + telegram_ids[::2]
+    random.shuffle(calls)
+    returned, errors = {}, []
+    lock = threading.Lock()
+
+    def register(telegram_id):
+        try:
+            code = db.register_user(telegram_id, f"check_{telegram_id}", "Проверка", None, "+7 999 000-12-34")
+        except Exception as e:
+            with lock:
+                errors.append(f"{telegram_id}: {e}")
+            return
+        with lock:
+            returned.setdefault(telegram_id, set()).add(code)
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(register, calls))
+        elapsed = time.perf_counter() - started
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT telegram_id, customer_code FROM users WHERE telegram_id >= %s AND telegram_id < %s",
+                        (first_id, first_id + users))
+            stored = {}
+            for row in cur.fetchall():
+                stored.setdefault(row['telegram_id'], []).append(row['customer_code'])
+    finally:
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM users WHERE telegram_id >= %s AND telegram_id < %s", (first_id, first_id + users))
+            conn.commit()
+
+    codes = [code for rows in stored.values() for code in rows]
+    problems = errors[:5]
+    if len(stored) != users or len(codes) != users:
+        problems.append(f"{len(codes)} rows for {len(stored)} of {users} users")
+    if len(set(codes)) != len(codes):
+        problems.append(f"{len(codes) - len(set(codes))} duplicate customer codes")
+    mismatched = [t for t, codes_seen in returned.items() if codes_seen != set(stored.get(t, []))]
+    if mismatched:
+        problems.append(f"{len(mismatched)} users got a code different from the stored one")
+    print(f"{len(calls)} registrations of {users} users in {threads} threads: {elapsed:.2f}s, "
+          f"{len(set(codes))} unique codes, {len(errors)} errors")
+    for problem in problems:
+        print(f"FAIL {problem}")
+    return not problems
+
+
+def _bench_herd(callers):
+    """Синтетический thundering herd: callers одновременных get_exchange_rates из потоков
+    и get_exchange_rates_brief из корутин; печатает, сколько запросов дошло до БД"""
+    db.get_exchange_rates()  # соединение и prepared statements готовы заранее
+
+    def thread_herd():
+        barrier = threading.Barrier(callers)
+
+        def caller():
+            barrier.wait()
+            db.get_exchange_rates()
+
+        threads = [threading.Thread(target=caller) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    async def async_herd():
+        await asyncio.gather(*(db.read_async('get_exchange_rates_brief') for _ in range(callers)))
+
+    for name, run in (("threads", thread_herd), ("asyncio", lambda: asyncio.run(async_herd()))):
+        for coalesce in (False, True):
+            db.coalesce_reads = coalesce
+            before = db.query_stats()['queries']
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            queries = db.query_stats()['queries'] - before
+            print(f"{name:<8} coalesce={'on ' if coalesce else 'off'} {callers} calls -> "
+                  f"{queries} DB queries in {elapsed * 1000:.0f} ms")
+    db.coalesce_reads = True
+
+
+def _bench_prepared(iterations, telegram_id=None):
+    """Пропускная способность горячих чтений с prepared statements и без них"""
+    if telegram_id is None:
+        with db.connection() as conn, conn.cursor() as cur:
+            cur.execute("""
+                SELECT u.telegram_id FROM users u JOIN track_codes tc ON tc.user_id = u.id
+                GROUP BY u.id ORDER BY COUNT(*) DESC LIMIT 1
+            """)
+            row = cur.fetchone()
+        if not row:
+            raise SystemExit("No users with orders to benchmark")
+        telegram_id = row['telegram_id']
+    for method in (db.get_user, db.get_user_track_codes):
+        for use_prepared in (False, True):
+            db.use_prepared = use_prepared
+            method(telegram_id)  # прогрев: PREPARE и кэш плана
+            started = time.perf_counter()
+            for _ in range(iterations):
+                method(telegram_id)
+            elapsed = time.perf_counter() - started
+            print(f"{method.__name__:<22} prepared={'on ' if use_prepared else 'off'} "
+                  f"{iterations / elapsed:>9.0f} calls/s  {elapsed / iterations * 1e6:>8.1f} us/call")
+    db.use_prepared = DB_PREPARED_STATEMENTS
+
+
+# Тестовые клиенты bench-search: имена повторяются, как у настоящих клиентов
+BENCH_FIRST_NAMES = ['Иван', 'Пётр', 'Анна', 'Мария', 'Алексей', 'Ольга', 'Дмитрий', 'Елена', 'Сергей', 'Наталья', 'Wei', 'Li']
+BENCH_LAST_NAMES = ['Петров', 'Иванова', 'Смирнов', 'Кузнецова', 'Попов', 'Соколова',
+                    'Лебедев', 'Козлова', 'Новиков', 'Морозова', 'Zhang', 'Wang']
+
+
+def _bench_search(seed_users, repeat):
+    """Задержка search_users на seed_users тестовых клиентах; данные откатываются одной транзакцией"""
+    conn = psycopg2.connect(DATABASE_URL, connection_factory=_PlanCheckConnection, cursor_factory=_PlanCheckCursor)
+    saved_replica, _query_context.conn = db.use_replica, conn
+    db.use_replica = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, first_name, last_name, phone_number, customer_code)
+                SELECT 900000000000 + g, 'user_' || left(md5(g::text), 8),
+                       (%(first)s::text[])[1 + g %% 12], (%(last)s::text[])[1 + (g / 12) %% 12],
+                       '+79' || lpad(((g::bigint * 7919) %% 1000000000)::text, 9, '0'), 'GD-BN' || g
+                FROM generate_series(1, %(n)s) g
+            """, {'n': seed_users, 'first': BENCH_FIRST_NAMES, 'last': BENCH_LAST_NAMES})
+            cur.execute("ANALYZE users")
+            probe = seed_users // 2
+            cur.execute("SELECT phone_number, username FROM users WHERE telegram_id = %s", (900000000000 + probe,))
+            row = cur.fetchone()
+        queries = [
+            ("phone, full (8...)", '8' + row['phone_number'][2:]),
+            ("phone, last 4 digits", row['phone_number'][-4:]),
+            ("phone, 7 digits", row['phone_number'][-7:]),
+            ("customer code prefix", f"GD-BN{probe // 10}"),
+            ("username prefix", row['username'][:8]),
+            ("name with typo", "Иван Петрав"),
+            ("last name only", "Смирнов"),
+        ]
+        for title, query in queries:
+            conn.plans = []
+            rows, _ = db.search_users(query)
+            used = {node['Index Name'] for plan in conn.plans for node in _plan_nodes(plan['Plan'])
+                    if node.get('Index Name')}
+            conn.plans = None
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                db.search_users(query)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f"{title:<22} {query!r:<20} p50 {timings[len(timings) // 2]:>8.2f} ms  "
+                  f"p95 {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:>8.2f} ms  "
+                  f"found {len(rows)}  indexes: {', '.join(sorted(used)) or '-'}")
+    finally:
+        _query_context.conn, db.use_replica = None, saved_replica
+        psycopg2.extensions.connection.rollback(conn)
+        conn.close()
+
+
+def _bench_batch(keys, repeat):
+    """Время и число запросов к БД: keys поштучных find_track_code/get_user (как keys вызовов
+    /api/track/{code} и /api/user/{id}) против одного пакетного запроса (/api/track/batch,
+    /api/users/batch). Тестовые клиенты и заказы откатываются одной транзакцией."""
+    conn = psycopg2.connect(DATABASE_URL, connection_factory=_PreparingConnection, cursor_factory=_DatabaseCursor)
+    saved_replica, _query_context.conn = db.use_replica, conn
+    db.use_replica = False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, first_name, phone_number, customer_code)
+                SELECT 900000000000 + g, 'batch_' || g, 'Batch', '+7900' || lpad(g::text, 7, '0'), 'GD-BB' || g
+                FROM generate_series(1, %(n)s) g
+            """, {'n': keys})
+            cur.execute("""
+                INSERT INTO track_codes (user_id, track_code, description, status, price)
+                SELECT id, 'BB' || lpad((telegram_id - 900000000000)::text, 10, '0') || 'CN', 'batch', 'В пути', 10
+                FROM users WHERE telegram_id BETWEEN 900000000001 AND 900000000000 + %(n)s
+            """, {'n': keys})
+            cur.execute("ANALYZE users, track_codes")
+        telegram_ids = [900000000000 + g for g in range(1, keys + 1)]
+        track_codes = ['BB' + str(g).zfill(10) + 'CN' for g in range(1, keys + 1)]
+        cases = [
+            ("track", lambda: [db.find_track_code(code) for code in track_codes],
+             lambda: db.find_track_codes_batch(track_codes)),
+            ("users", lambda: [db.get_user(telegram_id) for telegram_id in telegram_ids],
+             lambda: db.get_users_batch(telegram_ids)),
+        ]
+        for name, per_item, batch in cases:
+            for mode, call in (("per item", per_item), ("batch", batch)):
+                call()  # прогрев: PREPARE и кэш плана
+                timings = []
+                before = _query_stats['executed']
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    call()
+                    timings.append(time.perf_counter() - started)
+                queries = (_query_stats['executed'] - before) // repeat
+                best = min(timings)
+                print(f"{name:<6} {mode:<9} {keys} keys: {best * 1000:>8.1f} ms  {queries:>5} DB queries  "
+                      f"{keys / best:>9.0f} keys/s")
+    finally:
+        _query_context.conn, db.use_replica = None, saved_replica
+        psycopg2.extensions.connection.rollback(conn)
+        conn.close()
+
+
+# Форматы тестовых трек-кодов bench-track-search: буквы перевозчика + цифры нужной длины.
+# Цифры — g * нечётное не кратное 5 число по модулю 10^длина: уникальны и без общих триграмм соседей
+BENCH_TRACK_FORMATS = [('YT', 10, 'CN'), ('LP', 14, ''), ('SF', 13, ''), ('JT', 13, ''), ('', 12, '')]
+
+
+def _bench_track_search(seed_tracks, repeat):
+    """Задержка search_track_codes на seed_tracks тестовых трек-кодах (по 10 на клиента);
+    данные откатываются одной транзакцией"""
+    conn = psycopg2.connect(DATABASE_URL, connection_factory=_PlanCheckConnection, cursor_factory=_PlanCheckCursor)
+    saved_replica, _query_context.conn = db.use_replica, conn
+    db.use_replica = False
+    try:
+        with conn.cursor() as cur:
+            started = time.perf_counter()
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, first_name, phone_number, customer_code)
+                SELECT 900000000000 + g, 'bench_' || g, 'Bench', '+7900' || lpad(g::text, 7, '0'), 'GD-TB' || g
+                FROM generate_series(1, %(n)s) g
+            """, {'n': max(1, seed_tracks // 10)})
+            cur.execute("""
+                INSERT INTO track_codes (user_id, track_code, description, status, price, created_date)
+                SELECT u.id, f.prefix || lpad(((g * 2654435761) %% (10 ^ f.length)::bigint)::text, f.length, '0')
+                             || f.suffix,
+                       'bench', 'В пути', 10, NOW() - g * INTERVAL '1 second'
+                FROM generate_series(1::bigint, %(n)s) g
+                JOIN unnest(%(prefixes)s::text[], %(lengths)s::int[], %(suffixes)s::text[])
+                     WITH ORDINALITY f(prefix, length, suffix, n) ON f.n = 1 + g %% %(formats)s
+                JOIN users u ON u.telegram_id = 900000000000 + 1 + (g - 1) / 10
+            """, {
+                'n': seed_tracks, 'formats': len(BENCH_TRACK_FORMATS),
+                'prefixes': [f[0] for f in BENCH_TRACK_FORMATS],
+                'lengths': [f[1] for f in BENCH_TRACK_FORMATS],
+                'suffixes': [f[2] for f in BENCH_TRACK_FORMATS],
+            })
+            cur.execute("ANALYZE users, track_codes")
+            print(f"seeded {seed_tracks} track codes in {time.perf_counter() - started:.1f}s")
+            probe = 900000000000 + 1 + seed_tracks // 20
+            cur.execute("""
+                SELECT tc.track_code FROM track_codes tc JOIN users u ON tc.user_id = u.id
+                WHERE u.telegram_id = %s AND tc.track_code LIKE 'YT%%' LIMIT 1
+            """, (probe,))
+            code = cur.fetchone()['track_code']
+        typo = code[:6] + ('0' if code[6] != '0' else '1') + code[7:]
+        queries = [
+            ("exact", code, None),
+            ("exact, pasted", f" {code[:4].lower()} {code[4:8]}-{code[8:]} ", None),
+            ("prefix, 8 chars", code[:8], None),
+            ("prefix, 4 chars", code[:4], None),
+            ("one digit typo", typo, None),
+            ("not found", "ZZ0000000000ZZ", None),
+            ("own orders, prefix", code[:8], probe),
+            ("own orders, typo", typo, probe),
+        ]
+        for title, query, owner_id in queries:
+            conn.plans = []
+            rows = db.search_track_codes(query, owner_id=owner_id)
+            used = {node['Index Name'] for plan in conn.plans for node in _plan_nodes(plan['Plan'])
+                    if node.get('Index Name')}
+            conn.plans = None
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                db.search_track_codes(query, owner_id=owner_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            print(f"{title:<20} {query!r:<24} p50 {timings[len(timings) // 2]:>8.2f} ms  "
+                  f"p95 {timings[min(len(timings) - 1, int(len(timings) * 0.95))]:>8.2f} ms  "
+                  f"found {len(rows)}  indexes: {', '.join(sorted(used)) or '-'}")
+    finally:
+        _query_context.conn, db.use_replica = None, saved_replica
+        psycopg2.extensions.connection.rollback(conn)
+        conn.close()
+
+
+if __name__ == "__main__":
+    _main()
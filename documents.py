@@ -0,0 +1,145 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from database import db
+from rendering import LABEL_DPI, PdfWriter, render_invoice_pdf, render_label_pages, render_label_png
+from response_cache import TTLCache
+from workers import run_in_process, shutdown as shutdown_workers
+
+# Документы по заказу: вид -> (функция рендеринга, расширение, тип содержимого)
+DOCUMENT_KINDS = {
+    'label': (render_label_png, 'png', "image/png"),
+    'invoice': (render_invoice_pdf, 'pdf', "application/pdf"),
+}
+# Готовые документы в памяти процесса по (вид, трек-код, хэш данных документа)
+RENDER_CACHE_SIZE = 500
+RENDER_CACHE_TTL = 3600
+# Сколько этикеток рендерит одна задача пула при печати контейнера
+LABEL_BATCH_CHUNK = 100
+
+render_cache = TTLCache(ttl=RENDER_CACHE_TTL, max_entries=RENDER_CACHE_SIZE)
+
+
+def document_version(order):
+    """Хэш всех полей, которые попадают в документ: заказа, клиента, способа доставки и курса.
+    updated_at заказа не меняется, когда клиент меняет телефон или меняется способ доставки."""
+    content = repr(sorted(dict(order).items()))
+    return hashlib.md5(content.encode()).hexdigest()
+
+
+async def render_document(kind, track_code):
+    """Документ kind по заказу: (имя файла, тип содержимого, байты) или None, если заказ не найден.
+    Версия документа — хэш его данных (document_version): пока они не менялись, документ берётся из кэша."""
+    render, extension, media_type = DOCUMENT_KINDS[kind]
+    order = await db.read_async('get_order_document', track_code)
+    if not order:
+        return None
+    key = (kind, order['track_code'], document_version(order))
+    data = render_cache.get(key)
+    if data is None:
+        # Рендеринг занимает сотни миллисекунд CPU — в цикле событий он остановил бы все обработчики
+        data = render_cache.set(key, await run_in_process(render, dict(order)))
+    return f"{kind}_{order['track_code']}.{extension}", media_type, data
+
+
+async def render_labels_file(orders, path):
+    """Пишет этикетки orders одним PDF в path.
+    Части пачки рендерятся параллельно во всех процессах пула, страницы пишутся по порядку по мере готовности."""
+    chunks = [orders[i:i + LABEL_BATCH_CHUNK] for i in range(0, len(orders), LABEL_BATCH_CHUNK)]
+    tasks = [asyncio.ensure_future(run_in_process(render_label_pages, chunk)) for chunk in chunks]
+    try:
+        with open(path, 'wb') as f:
+            writer = PdfWriter(f, LABEL_DPI)
+            for task in tasks:
+                for page in await task:
+                    writer.add_page(page)
+            writer.close()
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def container_labels_to_file(container_code):
+    """Этикетки всех заказов контейнера во временном PDF: (путь, число этикеток).
+    Если в контейнере нет заказов — (None, 0). Файл удаляет вызывающий."""
+    orders = await db.read_async('get_container_documents', container_code)
+    if not orders:
+        return None, 0
+    fd, path = tempfile.mkstemp(prefix=f"labels_{container_code}_", suffix=".pdf")
+    os.close(fd)
+    try:
+        await render_labels_file([dict(order) for order in orders], path)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, len(orders)
+
+
+def _sample_orders(count):
+    now = datetime.now(timezone.utc)
+    return [{
+        'id': n, 'track_code': f"YT{7000000000 + n}CN", 'description': "Кроссовки, 2 пары, коробка 40×30×20",
+        'status': "На складе", 'price': Decimal("42.50"), 'created_date': now, 'version': now,
+        'container_code': "CNT-BENCH", 'delivery_method': "Авто карго", 'customer_code': f"GD-AB{n:04d}",
+        'first_name': "Иван", 'last_name': "Петров", 'phone_number': "+79991112233",
+        'currency_code': "USD", 'exchange_rate': Decimal("92.5"), 'price_rub': Decimal("3931.25"),
+    } for n in range(count)]
+
+
+def _bench(labels):
+    """Пропускная способность рендеринга на синтетических заказах (БД не нужна)"""
+    orders = _sample_orders(labels)
+
+    started = time.perf_counter()
+    pages = render_label_pages(orders)
+    serial = time.perf_counter() - started
+    print(f"serial, 1 process:    {labels} labels in {serial:.2f}s ({labels / serial:.0f} labels/s), "
+          f"{sum(len(page[3]) for page in pages) / labels / 1024:.1f} KiB/page")
+
+    async def pooled():
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        os.close(fd)
+        try:
+            await run_in_process(render_label_pages, orders[:1])  # процессы пула запущены заранее
+            started = time.perf_counter()
+            await render_labels_file(orders, path)
+            elapsed = time.perf_counter() - started
+            print(f"pool, one PDF file:   {labels} labels in {elapsed:.2f}s ({labels / elapsed:.0f} labels/s), "
+                  f"file {os.path.getsize(path) / 1024 / 1024:.1f} MiB")
+
+            started = time.perf_counter()
+            for order in orders[:50]:
+                await run_in_process(render_label_png, order)
+            print(f"single label PNG:     {(time.perf_counter() - started) / 50 * 1000:.0f} ms")
+            started = time.perf_counter()
+            for order in orders[:20]:
+                await run_in_process(render_invoice_pdf, order)
+            print(f"single invoice PDF:   {(time.perf_counter() - started) / 20 * 1000:.0f} ms")
+        finally:
+            os.remove(path)
+            shutdown_workers()
+
+    asyncio.run(pooled())
+
+
+def _main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Счета и этикетки заказов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("bench", help="скорость рендеринга этикеток: в одном процессе и в пуле")
+    bench.add_argument("--labels", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        _bench(args.labels)
+
+
+if __name__ == "__main__":
+    _main()
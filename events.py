@@ -0,0 +1,59 @@
+import asyncio
+
+
+class OrderEventBroker:
+    """Pub/sub событий по заказам внутри процесса.
+
+    Подписка — это asyncio.Queue на telegram_id пользователя, поэтому простаивающий
+    подписчик стоит одну очередь и одну ожидающую корутину. publish() можно вызывать
+    из любого потока (например, из потока LISTEN/NOTIFY): доставка в очереди
+    всегда выполняется в цикле событий.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._loop = None
+
+    def attach_loop(self, loop):
+        self._loop = loop
+
+    def subscribe(self, telegram_id):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(telegram_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, telegram_id, queue):
+        queues = self._subscribers.get(telegram_id)
+        if not queues:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[telegram_id]
+
+    def subscriber_count(self):
+        return sum(len(queues) for queues in self._subscribers.values())
+
+    def publish(self, telegram_id, event):
+        if self._loop is None or telegram_id not in self._subscribers:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._deliver(telegram_id, event)
+        else:
+            self._loop.call_soon_threadsafe(self._deliver, telegram_id, event)
+
+    def _deliver(self, telegram_id, event):
+        for queue in list(self._subscribers.get(telegram_id, ())):
+            if queue.full():
+                # Медленный клиент: выбрасываем самое старое событие, а не копим память
+                try:
+                    queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass
+            queue.put_nowait(event)
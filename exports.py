@@ -0,0 +1,92 @@
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from database import db
+
+# Выгрузки для бухгалтерии: вид -> название листа / подпись кнопки
+EXPORT_KINDS = {
+    'users': "Клиенты и балансы",
+    'orders': "Заказы",
+    'balance_transactions': "Операции по балансу",
+}
+EXPORT_FORMATS = ('csv', 'xlsx')
+EXPORT_MEDIA_TYPES = {
+    'csv': "text/csv; charset=utf-8",
+    'xlsx': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+# Сколько строк CSV собирать в буфере перед отдачей куска
+CSV_FLUSH_ROWS = 1000
+# Лимит строк на листе Excel (вместе с заголовком); дальше выгрузка продолжается на новом листе
+XLSX_MAX_ROWS = 1048576
+
+
+def iter_csv(rows):
+    """Кодирует строки выгрузки в CSV кусками байт.
+    BOM в начале нужен, чтобы Excel открыл UTF-8 с кириллицей без мастера импорта."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff'.encode()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % CSV_FLUSH_ROWS == 0:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _xlsx_value(value):
+    # Excel не хранит часовые пояса: время остаётся в поясе сессии БД
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return value.replace(tzinfo=None)
+    return value
+
+
+def write_xlsx(rows, path, title):
+    """Пишет строки выгрузки в XLSX построчно (write-only режим openpyxl не держит лист в памяти)"""
+    # openpyxl нужен только для выгрузок — импортируем при первом использовании
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    rows = iter(rows)
+    header = next(rows)
+    sheet, sheet_rows, sheet_number = None, XLSX_MAX_ROWS, 0
+    for row in rows:
+        if sheet_rows >= XLSX_MAX_ROWS:
+            sheet_number += 1
+            sheet = workbook.create_sheet(title if sheet_number == 1 else f"{title} ({sheet_number})")
+            sheet.append(header)
+            sheet_rows = 1
+        sheet.append([_xlsx_value(value) for value in row])
+        sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet(title).append(header)
+    workbook.save(path)
+
+
+def export_filename(kind, fmt):
+    return f"{kind}_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+
+
+def export_to_file(kind, fmt):
+    """Выгружает kind во временный файл формата fmt и возвращает путь к нему.
+    Файл удаляет вызывающий. Блокирующая функция: из async-кода вызывать через asyncio.to_thread."""
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export {kind}.{fmt}")
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix=f".{fmt}")
+    try:
+        if fmt == 'csv':
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter_csv(db.export_rows(kind)):
+                    f.write(chunk)
+        else:
+            os.close(fd)
+            write_xlsx(db.export_rows(kind), path, EXPORT_KINDS[kind])
+    except Exception:
+        os.remove(path)
+        raise
+    return path
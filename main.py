@@ -0,0 +1,41 @@
+import logging
+import os
+
+from config import APP_ROLE, API_WORKERS, ROLE_BOT, ROLE_API, validate_config
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Точка входа намеренно лёгкая: тяжёлые модули (telegram, FastAPI, uvicorn)
+# импортируются только для выбранной роли. Воркеры uvicorn при spawn
+# заново импортируют главный модуль, поэтому здесь не должно быть ничего лишнего.
+
+def main():
+    validate_config()
+
+    from database import DB_AUTO_MIGRATE, db
+    if DB_AUTO_MIGRATE:
+        # Схема обновляется один раз при запуске, до первого запроса и до старта воркеров uvicorn;
+        # если миграция не проходит, процесс не стартует, а не падает на каждом запросе
+        db.migrate()
+        db.close()
+
+    if APP_ROLE == ROLE_BOT:
+        import asyncio
+        import bot
+        logger.info("🚀 Запуск в роли bot (только Telegram)")
+        asyncio.run(bot.run_bot())
+        return
+
+    import uvicorn
+    port = int(os.getenv("PORT", 8000))
+    # В роли combined бот стартует внутри API, поэтому воркер может быть только один
+    workers = API_WORKERS if APP_ROLE == ROLE_API else 1
+    logger.info(f"🚀 Запуск FastAPI на порту {port} (роль {APP_ROLE}, воркеров: {workers})")
+    uvicorn.run("api:app", host="0.0.0.0", port=port, workers=workers)
+
+if __name__ == "__main__":
+    main()
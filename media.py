@@ -0,0 +1,52 @@
+import io
+
+from telegram import InputMediaPhoto, InputMediaVideo
+
+# Telegram принимает в одном альбоме от 2 до 10 фото/видео
+MEDIA_GROUP_LIMIT = 10
+# Картинки, присланные файлом, уменьшаются до этого размера по длинной стороне и сохраняются как фото
+PHOTO_MAX_SIDE = 2560
+PHOTO_JPEG_QUALITY = 85
+# Bot API скачивает файлы до 20 МБ
+MAX_IMAGE_DOCUMENT_BYTES = 20 * 1024 * 1024
+
+
+def resize_photo(data, max_side=PHOTO_MAX_SIDE, quality=PHOTO_JPEG_QUALITY):
+    """Уменьшает изображение до max_side по длинной стороне и перекодирует в JPEG.
+    CPU-тяжёлая функция: вызывать через workers.run_in_process, а не в цикле событий."""
+    # Pillow нужен только процессам пула — импортируем при первом использовании
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def media_batches(attachments, size=MEDIA_GROUP_LIMIT):
+    return [attachments[i:i + size] for i in range(0, len(attachments), size)]
+
+
+def _input_media(attachment, caption=None):
+    media_class = InputMediaVideo if attachment['kind'] == 'video' else InputMediaPhoto
+    return media_class(attachment['file_id'], caption=caption)
+
+
+async def send_attachments(bot, chat_id, attachments, caption=None, **kwargs):
+    """Отправляет вложения по сохранённым file_id, без повторной загрузки файлов.
+    Альбомы уходят пачками по MEDIA_GROUP_LIMIT через send_media_group; подпись — у первого элемента."""
+    for number, batch in enumerate(media_batches(attachments)):
+        batch_caption = caption if number == 0 else None
+        if len(batch) == 1:
+            attachment = batch[0]
+            send = bot.send_video if attachment['kind'] == 'video' else bot.send_photo
+            await send(chat_id, attachment['file_id'], caption=batch_caption, **kwargs)
+        else:
+            await bot.send_media_group(chat_id, [
+                _input_media(attachment, batch_caption if index == 0 else None)
+                for index, attachment in enumerate(batch)
+            ], **kwargs)
@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета исходящих сообщений (меньше — важнее).
+# Передаются в методы бота через rate_limit_args, по умолчанию — LANE_INTERACTIVE.
+LANE_INTERACTIVE = 0
+LANE_NOTIFICATION = 1
+LANE_BROADCAST = 2
+LANE_NAMES = {
+    LANE_INTERACTIVE: "interactive",
+    LANE_NOTIFICATION: "notification",
+    LANE_BROADCAST: "broadcast",
+}
+
+# Лимиты Telegram: ~30 сообщений/с на бота, ~1/с в личный чат, ~20/мин в группу
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+MAX_RETRIES = 3
+# Чаты без активности дольше этого времени удаляются из таблицы корзин
+CHAT_BUCKET_IDLE_SECONDS = 120
+
+
+class TokenBucket:
+    """Корзина токенов с резервированием: reserve() сразу списывает токен
+    и возвращает, сколько секунд подождать до отправки."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        now = time.monotonic()
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self):
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class PrioritySendLimiter(BaseRateLimiter):
+    """Единая очередь исходящих запросов бота с полосами приоритета.
+
+    Запросы с chat_id сначала ждут свою корзину чата, затем встают в общую очередь,
+    откуда диспетчер выпускает их по глобальной корзине в порядке полос: ответы
+    пользователям идут раньше уведомлений, уведомления — раньше рассылок.
+    RetryAfter от Telegram приостанавливает всю очередь и запрос повторяется.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, max_retries=MAX_RETRIES):
+        self._global = TokenBucket(global_rate, GLOBAL_BURST)
+        self._chats = {}
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0.0
+        self.max_retries = max_retries
+        self._metrics = {
+            name: {"sent": 0, "failed": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in LANE_NAMES.values()
+        }
+        self._retry_after_count = 0
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # answerCallbackQuery, answerInlineQuery и т.п. не считаются сообщениями в чат
+            return await callback(*args, **kwargs)
+
+        lane = rate_limit_args if rate_limit_args in LANE_NAMES else LANE_INTERACTIVE
+        metrics = self._metrics[LANE_NAMES[lane]]
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            await self._acquire(lane, chat_id)
+            waited = time.monotonic() - started
+            metrics["wait_total"] += waited
+            metrics["wait_max"] = max(metrics["wait_max"], waited)
+            try:
+                result = await callback(*args, **kwargs)
+                metrics["sent"] += 1
+                return result
+            except RetryAfter as e:
+                self._retry_after_count += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+                logger.warning(f"Telegram RetryAfter {e.retry_after}s ({endpoint}, полоса {LANE_NAMES[lane]})")
+                if attempt == self.max_retries:
+                    metrics["failed"] += 1
+                    raise
+            except Exception:
+                metrics["failed"] += 1
+                raise
+
+    async def _acquire(self, lane, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            rate = GROUP_CHAT_RATE if isinstance(chat_id, str) or chat_id < 0 else PRIVATE_CHAT_RATE
+            bucket = self._chats[chat_id] = TokenBucket(rate, CHAT_BURST)
+        delay = bucket.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (lane, next(self._sequence), future))
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                self._prune_chats()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.delay()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                # Отправитель отменён, пока ждал очереди
+                continue
+            self._global.reserve()
+            future.set_result(None)
+
+    def _prune_chats(self):
+        now = time.monotonic()
+        idle = [chat_id for chat_id, bucket in self._chats.items()
+                if now - bucket.updated > CHAT_BUCKET_IDLE_SECONDS]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def stats(self):
+        """Метрики очереди для админов"""
+        depth = {name: 0 for name in LANE_NAMES.values()}
+        for lane, _, future in self._queue:
+            if not future.done():
+                depth[LANE_NAMES[lane]] += 1
+        lanes = {}
+        for name, m in self._metrics.items():
+            handled = m["sent"] + m["failed"]
+            lanes[name] = {
+                "sent": m["sent"],
+                "failed": m["failed"],
+                "queued": depth[name],
+                "avg_wait": m["wait_total"] / handled if handled else 0.0,
+                "max_wait": m["wait_max"],
+            }
+        return {
+            "lanes": lanes,
+            "retry_after": self._retry_after_count,
+            "paused_for": max(0.0, self._paused_until - time.monotonic()),
+            "tracked_chats": len(self._chats),
+        }
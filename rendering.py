@@ -0,0 +1,214 @@
+import functools
+import io
+import os
+import textwrap
+import zlib
+
+# Этот модуль импортируют процессы пула (workers.run_in_process): здесь только рисование, без БД и Telegram
+
+# Шрифт с кириллицей; в образе ставится пакетом fonts-dejavu-core
+RENDER_FONT = os.getenv("RENDER_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+RENDER_FONT_BOLD = os.getenv("RENDER_FONT_BOLD", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+COMPANY_NAME = "Golden Dragon Cargo"
+# Этикетка 100×150 мм (4×6") для термопринтера 203 dpi, однобитная
+LABEL_SIZE = (812, 1218)
+LABEL_DPI = 203
+LABEL_QR_SIZE = 480
+LABEL_QR_TOP = 270
+LABEL_CLIENT_TOP = LABEL_QR_TOP + LABEL_QR_SIZE + 30
+# Счёт — A4 при 150 dpi, оттенки серого
+INVOICE_SIZE = (1240, 1754)
+INVOICE_DPI = 150
+MARGIN = 40
+
+
+@functools.lru_cache(maxsize=None)
+def _font(size, bold=False):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.truetype(RENDER_FONT_BOLD if bold else RENDER_FONT, size)
+    except OSError:
+        # Без TTF-шрифта кириллица не отрисуется, но документ всё равно получится
+        return ImageFont.load_default()
+
+
+def _fit_font(draw, text, width, size, bold=False):
+    """Самый крупный шрифт не больше size, которым text помещается в width"""
+    while size > 12 and draw.textlength(text, font=_font(size, bold)) > width:
+        size -= 4
+    return _font(size, bold)
+
+
+def _qr_image(data, size):
+    import qrcode
+    from PIL import Image
+
+    # Фиксированная маска: перебор всех восьми — самая дорогая часть построения QR, а читается код и так
+    qr = qrcode.QRCode(border=1, error_correction=qrcode.constants.ERROR_CORRECT_M, mask_pattern=0)
+    qr.add_data(data)
+    qr.make(fit=True)
+    # Масштабируем без сглаживания: модули QR остаются чёткими квадратами
+    return qr.make_image().get_image().convert('1').resize((size, size), Image.NEAREST)
+
+
+def _text(value):
+    return "—" if value in (None, "") else str(value)
+
+
+@functools.lru_cache(maxsize=1)
+def _label_template():
+    """Неизменная часть этикетки рисуется один раз на процесс, дальше копируется"""
+    from PIL import Image, ImageDraw
+
+    width, _ = LABEL_SIZE
+    image = Image.new('1', LABEL_SIZE, 1)
+    draw = ImageDraw.Draw(image)
+    draw.text((MARGIN, MARGIN), COMPANY_NAME, font=_font(44, True), fill=0)
+    draw.line((MARGIN, 110, width - MARGIN, 110), fill=0, width=4)
+    draw.text((MARGIN, 130), "Трек-код", font=_font(28), fill=0)
+    draw.line((MARGIN, LABEL_CLIENT_TOP, width - MARGIN, LABEL_CLIENT_TOP), fill=0, width=4)
+    draw.text((MARGIN, LABEL_CLIENT_TOP + 20), "Клиент", font=_font(28), fill=0)
+    return image
+
+
+def draw_label(order):
+    """Этикетка заказа: трек-код крупно, QR с трек-кодом, код клиента, доставка и контейнер"""
+    from PIL import ImageDraw
+
+    width, height = LABEL_SIZE
+    image = _label_template().copy()
+    draw = ImageDraw.Draw(image)
+    draw.text((MARGIN, 165), order['track_code'],
+              font=_fit_font(draw, order['track_code'], width - 2 * MARGIN, 72, True), fill=0)
+    image.paste(_qr_image(order['track_code'], LABEL_QR_SIZE), ((width - LABEL_QR_SIZE) // 2, LABEL_QR_TOP))
+    y = LABEL_CLIENT_TOP
+    draw.text((MARGIN, y + 55), _text(order['customer_code']), font=_font(80, True), fill=0)
+    y += 170
+    for caption, value in (("Доставка", order['delivery_method']), ("Контейнер", order['container_code'])):
+        draw.text((MARGIN, y), f"{caption}: {_text(value)}", font=_font(34), fill=0)
+        y += 50
+    for line in textwrap.wrap(_text(order['description']), 40)[:3]:
+        draw.text((MARGIN, y), line, font=_font(30), fill=0)
+        y += 40
+    draw.text((MARGIN, height - MARGIN - 30), f"Принят: {order['created_date']:%d.%m.%Y}", font=_font(28), fill=0)
+    return image
+
+
+def draw_invoice(order):
+    """Счёт по заказу: стоимость в валюте по зафиксированному курсу и в рублях"""
+    from PIL import Image, ImageDraw
+
+    width, _ = INVOICE_SIZE
+    margin = MARGIN * 2
+    image = Image.new('L', INVOICE_SIZE, 255)
+    draw = ImageDraw.Draw(image)
+    draw.text((margin, margin), COMPANY_NAME, font=_font(56, True), fill=0)
+    # Дата счёта — дата приёма заказа, а не последнего изменения: повторно выданный счёт совпадает с первым
+    draw.text((margin, margin + 90), f"Счёт № {order['id']} от {order['created_date']:%d.%m.%Y}", font=_font(40), fill=0)
+    draw.line((margin, 260, width - margin, 260), fill=0, width=3)
+    client = " ".join(part for part in (order['first_name'], order['last_name']) if part)
+    currency = order['currency_code'] or "USD"
+    rows = [
+        ("Клиент", f"{_text(order['customer_code'])} {client}".strip()),
+        ("Телефон", _text(order['phone_number'])),
+        ("Трек-код", order['track_code']),
+        ("Описание", _text(order['description'])),
+        ("Доставка", _text(order['delivery_method'])),
+        ("Статус", _text(order['status'])),
+        ("Дата приёма", f"{order['created_date']:%d.%m.%Y}"),
+        ("Стоимость", f"{order['price']} {currency}"),
+        ("Курс", f"{_text(order['exchange_rate'])} руб/{currency}"),
+    ]
+    y = 300
+    for caption, value in rows:
+        draw.text((margin, y), caption, font=_font(30), fill=90)
+        for line in textwrap.wrap(value, 48) or ["—"]:
+            draw.text((margin + 300, y), line, font=_font(30), fill=0)
+            y += 44
+        y += 16
+    draw.line((margin, y, width - margin, y), fill=0, width=3)
+    total = f"{order['price_rub']:.2f} руб" if order['price_rub'] is not None else "—"
+    draw.text((margin, y + 30), "Итого к оплате", font=_font(40, True), fill=0)
+    draw.text((margin + 600, y + 30), total, font=_font(40, True), fill=0)
+    return image
+
+
+def encode_page(image):
+    """Сжимает страницу для PdfWriter: (ширина, высота, бит на пиксель, данные FlateDecode)"""
+    return image.width, image.height, 1 if image.mode == '1' else 8, zlib.compress(image.tobytes(), 6)
+
+
+class PdfWriter:
+    """Минимальный потоковый PDF: каждая страница — одно растровое изображение во весь лист.
+
+    Страницы пишутся в файл сразу, поэтому пачка из тысяч этикеток не держится
+    в памяти целиком (Pillow для многостраничного PDF требует все страницы сразу).
+    """
+
+    def __init__(self, fileobj, dpi):
+        self.fileobj = fileobj
+        self.dpi = dpi
+        self.position = 0
+        # Объекты 1 и 2 — каталог и дерево страниц, их тела пишутся в close()
+        self.offsets = [None, None]
+        self.pages = []
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+
+    def _object(self, header, stream=None, object_id=None):
+        if object_id is None:
+            self.offsets.append(None)
+            object_id = len(self.offsets)
+        self.offsets[object_id - 1] = self.position
+        self._write(f"{object_id} 0 obj\n".encode() + header.encode())
+        if stream is not None:
+            self._write(b"\nstream\n" + stream + b"\nendstream")
+        self._write(b"\nendobj\n")
+        return object_id
+
+    def add_page(self, page):
+        """Добавляет страницу — результат encode_page"""
+        width, height, bits, data = page
+        width_pt, height_pt = width * 72 / self.dpi, height * 72 / self.dpi
+        image_id = self._object(
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray "
+            f"/BitsPerComponent {bits} /Filter /FlateDecode /Length {len(data)} >>", data
+        )
+        content = f"q {width_pt:.2f} 0 0 {height_pt:.2f} 0 0 cm /Im Do Q".encode()
+        content_id = self._object(f"<< /Length {len(content)} >>", content)
+        self.pages.append(self._object(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {width_pt:.2f} {height_pt:.2f}] "
+            f"/Resources << /XObject << /Im {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ))
+
+    def close(self):
+        self._object("<< /Type /Catalog /Pages 2 0 R >>", object_id=1)
+        kids = " ".join(f"{page} 0 R" for page in self.pages)
+        self._object(f"<< /Type /Pages /Kids [{kids}] /Count {len(self.pages)} >>", object_id=2)
+        xref = self.position
+        self._write(f"xref\n0 {len(self.offsets) + 1}\n0000000000 65535 f \n".encode())
+        self._write("".join(f"{offset:010d} 00000 n \n" for offset in self.offsets).encode())
+        self._write(f"trailer\n<< /Size {len(self.offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+
+
+def render_label_png(order):
+    output = io.BytesIO()
+    draw_label(order).save(output, 'PNG', dpi=(LABEL_DPI, LABEL_DPI))
+    return output.getvalue()
+
+
+def render_invoice_pdf(order):
+    output = io.BytesIO()
+    writer = PdfWriter(output, INVOICE_DPI)
+    writer.add_page(encode_page(draw_invoice(order)))
+    writer.close()
+    return output.getvalue()
+
+
+def render_label_pages(orders):
+    """Сжатые страницы этикеток для пачки; части пачки рендерятся в разных процессах пула"""
+    return [encode_page(draw_label(order)) for order in orders]
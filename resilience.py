@@ -0,0 +1,63 @@
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Предохранитель: после threshold ошибок подряд размыкается на reset_timeout секунд.
+
+    Пока он разомкнут, allow() возвращает False и вызывающий код не ждёт заведомо
+    недоступный сервис. По истечении reset_timeout пропускается один пробный вызов:
+    успех замыкает предохранитель, ошибка размыкает его снова.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_count = 0
+        self._changed_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if time.monotonic() - self._changed_at < self.reset_timeout:
+                return False
+            # Пробный вызов; если он так и не отчитался, через reset_timeout пропустим следующий
+            self.state = HALF_OPEN
+            self._changed_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                self.state = OPEN
+                self.opened_count += 1
+                self._changed_at = time.monotonic()
+
+    def retry_after(self):
+        """Через сколько секунд будет пробный вызов (0, если предохранитель замкнут)"""
+        with self._lock:
+            if self.state == CLOSED:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._changed_at))
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opened": self.opened_count,
+            "retry_after": self.retry_after(),
+        }
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Кэш сериализованных ответов API в памяти процесса.
+
+    Хранит готовые байты ответа и ETag по ключу вида ('user', telegram_id).
+    ETag строится из версии данных (make_etag), а если её нет — из самого тела.
+    Записи сбрасываются через invalidate() при изменении данных и, на всякий
+    случай, по TTL. Счётчик поколений не даёт положить в кэш ответ, собранный
+    до любой инвалидации, но сохраняемый после неё.
+    """
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_etag(version):
+        """ETag из версии данных (str) или из тела ответа (bytes)"""
+        if isinstance(version, str):
+            version = version.encode()
+        return '"' + hashlib.sha1(version).hexdigest()[:20] + '"'
+
+    def get(self, key):
+        """Возвращает (etag, body) или None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            etag, body, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return etag, body
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def set(self, key, body, generation=None, etag=None):
+        """Сохраняет ответ и возвращает (etag, body); без etag он считается по телу.
+        Если после generation была инвалидация, ответ не кэшируется."""
+        etag = etag or self.make_etag(body)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return etag, body
+            self._entries[key] = (etag, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag, body
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+class TTLCache:
+    """Небольшой кэш произвольных значений в памяти процесса: запись живёт ttl секунд,
+    при переполнении вытесняется самая давно использованная."""
+
+    def __init__(self, ttl=30, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
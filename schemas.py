@@ -0,0 +1,246 @@
+from datetime import datetime
+from decimal import Decimal
+from typing import List, Optional
+
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def _json_default(obj):
+    # orjson сам сериализует datetime/date/UUID, но не Decimal из NUMERIC-колонок
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dump_json(content) -> bytes:
+    """Сериализует ответ API напрямую из строк БД (RealDictRow — подкласс dict)"""
+    return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON-ответ через orjson без промежуточного jsonable_encoder"""
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+
+# ------------------------- МОДЕЛИ ОТВЕТОВ -------------------------
+# Маршруты возвращают строки БД как есть (без проверки моделью — она дорогая на горячих путях),
+# поэтому модели подключаются через responses=, а не response_model=: они только описывают формат
+# для OpenAPI. Запросы Database этих маршрутов выбирают ровно поля модели — новые колонки
+# в SELECT * к клиентам не попадут, а при изменении запроса модель правится вместе с ним.
+
+class UserSummary(BaseModel):
+    customer_code: str
+    balance: float
+    orders_count: int
+    delivered_count: int
+    first_name: Optional[str]
+    phone_number: Optional[str]
+
+
+class Order(BaseModel):
+    track_code: str
+    description: Optional[str]
+    status: Optional[str]
+    date: Optional[datetime]
+    price: float
+    exchange_rate: Optional[float]
+    price_rub: Optional[float]
+
+
+class OrdersResponse(BaseModel):
+    orders: List[Order]
+
+
+class ExchangeRate(BaseModel):
+    code: str
+    rate: float
+    flag: Optional[str]
+    name: Optional[str]
+
+
+class ExchangeRatesResponse(BaseModel):
+    rates: List[ExchangeRate]
+
+
+class TrackInfo(BaseModel):
+    track_code: str
+    status: Optional[str]
+    description: Optional[str]
+    date: Optional[datetime]
+    customer_code: Optional[str]
+    price: float
+
+
+# ------------------------- БЕНЧМАРК -------------------------
+def _sample_rows(orders):
+    """Строки в том виде, в каком их отдаёт RealDictCursor: Decimal из NUMERIC, datetime из TIMESTAMPTZ"""
+    from datetime import timezone
+    now = datetime.now(timezone.utc)
+    user = {'customer_code': "GD-AB1234", 'balance': Decimal("1520.50"), 'orders_count': orders,
+            'delivered_count': orders // 2, 'first_name': "Иван", 'phone_number': "+79991112233"}
+    order_rows = [{
+        'track_code': f"YT{7000000000 + n}CN", 'description': "Кроссовки, 2 пары", 'status': "В пути",
+        'date': now, 'price': Decimal("42.50"), 'exchange_rate': Decimal("92.5"), 'price_rub': Decimal("3931.25"),
+    } for n in range(orders)]
+    rates = [{'code': code, 'rate': Decimal("92.5"), 'flag': "🇺🇸", 'name': name}
+             for code, name in (("USD", "Доллар"), ("CNY", "Юань"), ("EUR", "Евро"), ("KZT", "Тенге"))]
+    return user, order_rows, rates
+
+
+def _legacy_response(content):
+    """Прежний путь: словари собираются вручную через float()/str(), затем jsonable_encoder и json.dumps"""
+    from fastapi.encoders import jsonable_encoder
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def _bench_serialization(iterations, orders):
+    """Скорость одной сериализации ответов /api/user, /api/orders и /api/exchange_rates (БД не нужна)"""
+    import time
+
+    user, order_rows, rates = _sample_rows(orders)
+    cases = [
+        ("/api/user/{id}", lambda: _legacy_response({
+            'customer_code': user['customer_code'], 'balance': float(user['balance']),
+            'orders_count': user['orders_count'], 'delivered_count': user['delivered_count'],
+            'first_name': user['first_name'], 'phone_number': user['phone_number'],
+        }), lambda: FastJSONResponse(user).body),
+        (f"/api/orders/{{id}}, {orders} orders", lambda: _legacy_response({'orders': [{
+            'track_code': o['track_code'], 'description': o['description'], 'status': o['status'],
+            'date': str(o['date']), 'price': float(o['price']), 'exchange_rate': float(o['exchange_rate']),
+            'price_rub': float(o['price_rub']),
+        } for o in order_rows]}), lambda: FastJSONResponse({'orders': order_rows}).body),
+        ("/api/exchange_rates", lambda: _legacy_response({'rates': [{
+            'code': r['code'], 'rate': float(r['rate']), 'flag': r['flag'], 'name': r['name'],
+        } for r in rates]}), lambda: FastJSONResponse({'rates': rates}).body),
+    ]
+    for name, legacy, fast in cases:
+        results = []
+        for render in (legacy, fast):
+            render()
+            started = time.perf_counter()
+            for _ in range(iterations):
+                render()
+            results.append(iterations / (time.perf_counter() - started))
+        print(f"{name:<28} JSONResponse {results[0]:>9.0f}/s   FastJSONResponse {results[1]:>9.0f}/s   "
+              f"x{results[1] / results[0]:.1f}")
+
+
+def _legacy_routes(api):
+    """Прежние версии маршрутов: словари вручную через float()/str(), response_model и JSONResponse.
+    Подключаются к тому же приложению под /api/bench-legacy/, чтобы проходить те же middleware."""
+    from fastapi import APIRouter, Request
+
+    router = APIRouter(prefix="/api/bench-legacy")
+
+    @router.get("/user/{telegram_id}", response_model=UserSummary, response_class=JSONResponse)
+    async def legacy_user(telegram_id: int, request: Request):
+        api.check_user_access(request, telegram_id)
+        user = await api.db.read_async('get_user_summary', telegram_id)
+        return {
+            'customer_code': user['customer_code'], 'balance': float(user['balance']),
+            'orders_count': user['orders_count'], 'delivered_count': user['delivered_count'],
+            'first_name': user['first_name'], 'phone_number': user['phone_number'],
+        }
+
+    @router.get("/orders/{telegram_id}", response_model=OrdersResponse, response_class=JSONResponse)
+    async def legacy_orders(telegram_id: int, request: Request):
+        api.check_user_access(request, telegram_id)
+        rows = await api.db.read_async('get_user_orders', telegram_id)
+        return {'orders': [{
+            'track_code': o['track_code'], 'description': o['description'], 'status': o['status'],
+            'date': str(o['date']), 'price': float(o['price']), 'exchange_rate': float(o['exchange_rate']),
+            'price_rub': float(o['price_rub']),
+        } for o in rows]}
+
+    @router.get("/exchange_rates", response_model=ExchangeRatesResponse, response_class=JSONResponse)
+    async def legacy_exchange_rates():
+        rates = await api.db.read_async('get_exchange_rates_brief')
+        return {'rates': [{
+            'code': r['code'], 'rate': float(r['rate']), 'flag': r['flag'], 'name': r['name'],
+        } for r in rates]}
+
+    return router
+
+
+def _bench_routes(requests, orders):
+    """Запросов в секунду через всё приложение: маршрутизация, limit_in_flight, CORS, ETag-кэш и
+    db.read_async. Вместо БД read_async сразу отдаёт строки _sample_rows, поэтому в цифрах только
+    накладные расходы API. Для новых маршрутов — с промахом кэша ответов (сборка и сериализация
+    каждый раз) и с попаданием (обычный повторный запрос)."""
+    import asyncio
+    import logging
+    import time
+    import httpx
+
+    import api
+    from auth import issue_session
+
+    # httpx пишет в лог каждый запрос — это мерили бы вместо API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    user, order_rows, rates = _sample_rows(orders)
+    rows = {
+        'get_user_summary': user, 'get_user_orders': order_rows, 'get_exchange_rates_brief': rates,
+        'get_user_version': "1", 'get_orders_version': "1", 'get_exchange_rates_version': "1",
+    }
+
+    async def read_async(method, *args):
+        return rows[method]
+
+    telegram_id = 900000000001
+    token, _ = issue_session(telegram_id, user['customer_code'], False)
+    headers = {"Authorization": f"Bearer {token}", "Origin": api.WEBAPP_ORIGINS[0]}
+
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def rate(path, before=None):
+                assert (await client.get(path, headers=headers)).status_code == 200
+                started = time.perf_counter()
+                for _ in range(requests):
+                    if before:
+                        before()
+                    await client.get(path, headers=headers)
+                return requests / (time.perf_counter() - started)
+
+            for name, path in (("/api/user/{id}", f"/user/{telegram_id}"),
+                               (f"/api/orders/{{id}}, {orders} orders", f"/orders/{telegram_id}"),
+                               ("/api/exchange_rates", "/exchange_rates")):
+                legacy = await rate("/api/bench-legacy" + path)
+                miss = await rate("/api" + path, before=api.response_cache.clear)
+                hit = await rate("/api" + path)
+                print(f"{name:<28} before {legacy:>6.0f} req/s   after, cache miss {miss:>6.0f} req/s "
+                      f"(x{miss / legacy:.1f})   after, cache hit {hit:>6.0f} req/s (x{hit / legacy:.1f})")
+
+    api.db.read_async = read_async
+    api.app.include_router(_legacy_routes(api))
+    try:
+        asyncio.run(run())
+    finally:
+        del api.db.read_async
+
+
+def _main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Сериализация ответов API")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench = sub.add_parser("bench", help="запросов в секунду до и после через TestClient, затем одна сериализация")
+    bench.add_argument("--requests", type=int, default=2000, help="запросов к каждому маршруту")
+    bench.add_argument("--iterations", type=int, default=20000, help="сериализаций каждого ответа")
+    bench.add_argument("--orders", type=int, default=50, help="заказов в ответе /api/orders")
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        _bench_routes(args.requests, args.orders)
+        print()
+        _bench_serialization(args.iterations, args.orders)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, BaseUpdateProcessor
+
+from outbox import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Входящие обновления от одного пользователя: ~1 в секунду, до 10 подряд
+USER_RATE = 1
+USER_BURST = 10
+# Сколько обновлений обрабатывается одновременно (обновления одного пользователя — строго по очереди)
+MAX_CONCURRENT_UPDATES = 16
+# Сколько обновлений одного пользователя может ждать своей очереди; лишние отбрасываются сразу,
+# чтобы один флудер не занял все слоты обработки ожиданием собственной блокировки
+MAX_QUEUED_PER_USER = 3
+# Сообщения, которые ждали обработки дольше, — признак перегрузки: отвечаем "попробуйте позже"
+MAX_UPDATE_AGE_SECONDS = 30
+# Как часто один пользователь может получить ответ "попробуйте позже"; остальное отбрасывается молча
+TRY_LATER_INTERVAL = 30
+# Корзины пользователей без активности дольше этого времени удаляются
+USER_BUCKET_IDLE_SECONDS = 300
+USER_BUCKET_PRUNE_SIZE = 10000
+
+TRY_LATER_TEXT = "⏳ Слишком много запросов. Попробуйте через минуту."
+
+
+class InboundThrottle:
+    """Ограничитель входящих обновлений: обработчик группы -1 (TypeHandler), до всех остальных.
+
+    Каждому пользователю — корзина токенов; превысившему лимит один раз отвечаем
+    "попробуйте позже", дальше обновления отбрасываются молча, пока корзина не наполнится.
+    Сообщения, простоявшие в очереди дольше MAX_UPDATE_AGE_SECONDS, тоже сбрасываются:
+    бот перегружен, и ответ на них уже никому не нужен. Отброшенное обновление не доходит
+    до обработчиков (ApplicationHandlerStop), поэтому не стоит ни одного запроса к БД.
+    """
+
+    def __init__(self, rate=USER_RATE, burst=USER_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._warned = {}
+        self._metrics = {"accepted": 0, "throttled": 0, "shed": 0, "replied": 0}
+
+    async def __call__(self, update: Update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        if update.inline_query:
+            # Инлайн-запросы приходят на каждую нажатую клавишу; их сдерживают пауза в наборе и кэш ответов
+            return
+        message = update.effective_message
+        if update.message and message.date:
+            age = (datetime.now(timezone.utc) - message.date).total_seconds()
+            if age > MAX_UPDATE_AGE_SECONDS:
+                self._metrics["shed"] += 1
+                await self._reject(update, user.id)
+        bucket = self._buckets.get(user.id)
+        if bucket is None:
+            if len(self._buckets) > USER_BUCKET_PRUNE_SIZE:
+                self._prune()
+            bucket = self._buckets[user.id] = TokenBucket(self.rate, self.burst)
+        if bucket.delay():
+            self._metrics["throttled"] += 1
+            await self._reject(update, user.id)
+        bucket.reserve()
+        self._metrics["accepted"] += 1
+
+    async def _reject(self, update, user_id):
+        """Дешёвый ответ не чаще раза в TRY_LATER_INTERVAL, иначе молча; дальше обработка не идёт"""
+        now = time.monotonic()
+        if now - self._warned.get(user_id, 0) >= TRY_LATER_INTERVAL:
+            self._warned[user_id] = now
+            self._metrics["replied"] += 1
+            try:
+                if update.callback_query:
+                    await update.callback_query.answer(TRY_LATER_TEXT)
+                elif update.effective_message:
+                    await update.effective_message.reply_text(TRY_LATER_TEXT)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить пользователю {user_id}: {e}")
+        elif update.callback_query:
+            # Без ответа у кнопки крутится индикатор загрузки
+            try:
+                await update.callback_query.answer()
+            except Exception:
+                pass
+        raise ApplicationHandlerStop
+
+    def _prune(self):
+        now = time.monotonic()
+        self._buckets = {user_id: bucket for user_id, bucket in self._buckets.items()
+                         if now - bucket.updated <= USER_BUCKET_IDLE_SECONDS}
+        self._warned = {user_id: at for user_id, at in self._warned.items()
+                        if now - at < TRY_LATER_INTERVAL}
+
+    def stats(self):
+        """Метрики входящих обновлений для админов"""
+        return {**self._metrics, "tracked_users": len(self._buckets)}
+
+
+class SerializedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает до max_concurrent_updates обновлений одновременно, но обновления
+    одного пользователя — строго по очереди (на этом держатся состояния ConversationHandler)."""
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.dropped = 0
+
+    async def do_process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            key = update.effective_user.id if update.effective_user else (
+                update.effective_chat.id if update.effective_chat else None
+            )
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if key is None:
+                await coroutine
+                return
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            if entry[1] >= MAX_QUEUED_PER_USER:
+                self.dropped += 1
+                coroutine.close()
+                return
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await coroutine
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._user_locks[key]
+        finally:
+            self.in_flight -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "limit": self.max_concurrent_updates,
+            "dropped": self.dropped,
+            "users_waiting": sum(1 for _, waiters in self._user_locks.values() if waiters > 1),
+        }
@@ -0,0 +1,52 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import PROCESS_WORKERS
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Общий пул процессов для CPU-тяжёлой работы: обработка фото, рендеринг документов.
+    Создаётся при первом использовании. Процессы запускаются через spawn, а не fork,
+    чтобы не наследовать соединения с БД и потоки родительского процесса."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool
+
+
+async def run_in_process(fn, *args, **kwargs):
+    """Выполняет fn в пуле процессов, не блокируя цикл событий.
+    fn должна быть функцией уровня модуля, а аргументы и результат — сериализуемыми pickle."""
+    global _pool
+    pool = get_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+    except BrokenProcessPool:
+        # Процесс пула упал (например, нехватка памяти): следующий вызов создаст пул заново
+        logger.error("Пул процессов сломан, будет пересоздан")
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None